@@ -337,6 +337,8 @@ register_transport_proto('svn://',
     help="Access using the Subversion smart server.")
 register_lazy_transport('svn://', __name__ + '.transport',
                         'SvnRaTransport')
+register_transport_proto('svn+replay://',
+    help="Replay a recorded trace of Subversion RA requests.")
 register_lazy_transport('svn+', __name__ + '.transport',
                         'SvnRaTransport')
 
@@ -391,6 +393,8 @@ plugin_cmds.register_lazy('cmd_svn_branches', [],
                           __name__ + '.commands')
 plugin_cmds.register_lazy('cmd_fix_svn_ancestry', [],
                           __name__ + '.commands')
+plugin_cmds.register_lazy('cmd_svn_precompute_fileids', [],
+                          __name__ + '.commands')
 
 
 try:
@@ -498,6 +502,12 @@ _mod_bzr_config.option_registry.register_lazy('push_merged_revisions',
     __name__ + '.config', 'svn_push_merged_revisions')
 _mod_bzr_config.option_registry.register_lazy('allow_metadata_in_file_properties',
     __name__ + '.config', 'svn_allow_metadata_in_fileprops')
+_mod_bzr_config.option_registry.register_lazy('svn-ra-trace',
+    __name__ + '.config', 'svn_ra_trace_option')
+_mod_bzr_config.option_registry.register_lazy('svn-replay-latency',
+    __name__ + '.config', 'svn_replay_latency_option')
+_mod_bzr_config.option_registry.register_lazy('svn-inventory-cache-size',
+    __name__ + '.config', 'svn_inventory_cache_size_option')
 
 def test_suite():
     """Returns the testsuite for bzr-svn."""
@@ -130,6 +130,10 @@ class RepositoryCache(object):
         from breezy.plugins.svn.fileids import FileIdMapCache
         return FileIdMapCache(self.open_transport())
 
+    def open_inventory_cache(self, max_size):
+        from breezy.plugins.svn.tree import InventoryCache
+        return InventoryCache(self.open_transport(), max_size)
+
     def open_revid_map(self):
         raise NotImplementedError(self.open_revid_map)
 
@@ -142,6 +146,9 @@ class RepositoryCache(object):
     def open_parents(self):
         raise NotImplementedError(self.open_parents)
 
+    def open_ra_cache(self):
+        raise NotImplementedError(self.open_ra_cache)
+
     def commit(self):
         pass
 
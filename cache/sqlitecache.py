@@ -48,6 +48,10 @@ from breezy.plugins.svn.logwalker import (
 from breezy.plugins.svn.parents import (
     ParentsCache,
     )
+from breezy.plugins.svn.transport import (
+    RA_CACHE_MAX_SIZE,
+    RemoteAccessCache,
+    )
 
 from subvertpy import NODE_UNKNOWN
 
@@ -160,6 +164,13 @@ class SqliteRevisionIdMapCache(RevisionIdMapCache, CacheTable):
             max_revnum int
             );
         create unique index if not exists layout on revids_seen (layout);
+        create table if not exists revid_filter (
+            layout text not null,
+            revnum integer,
+            count integer,
+            data blob
+            );
+        create unique index if not exists revid_filter_layout on revid_filter (layout);
         """)
         # Revisions ids are quite expensive
         self._commit_interval = 500
@@ -192,7 +203,7 @@ class SqliteRevisionIdMapCache(RevisionIdMapCache, CacheTable):
             "select path, min_revnum, max_revnum, mapping from revmap where revid=? order by abs(min_revnum-max_revnum) asc", (revid,)).fetchone()
         if ret is None:
             raise errors.NoSuchRevision(self, revid)
-        (path, min_revnum, max_revnum, mapping) = (ret[0].encode("utf-8"), int(ret[1]), int(ret[2]), ret[3].encode("utf-8"))
+        (path, min_revnum, max_revnum, mapping) = (ret[0], int(ret[1]), int(ret[2]), ret[3].encode("utf-8"))
         if min_revnum > max_revnum:
             return (path, max_revnum, min_revnum, mapping)
         else:
@@ -236,6 +247,41 @@ class SqliteRevisionIdMapCache(RevisionIdMapCache, CacheTable):
                 (revid, branch, min_revnum, max_revnum, mapping))
         self._commit_conditionally()
 
+    def count_revids(self):
+        """See RevisionIdMapCache.count_revids."""
+
+        # Rows are never removed, so the largest rowid is a cheap
+        # alternative to counting.
+        return self.execute(
+            "select coalesce(max(rowid), 0) from revmap").fetchone()[0]
+
+    def iter_revids(self):
+        """See RevisionIdMapCache.iter_revids."""
+
+        for (revid, ) in self.execute("select distinct revid from revmap"):
+            yield str(revid)
+
+    def get_revid_filter(self, layout):
+        """See RevisionIdMapCache.get_revid_filter."""
+
+        row = self.execute(
+            "select revnum, count, data from revid_filter where layout = ?",
+            (layout,)).fetchone()
+        if row is None:
+            return None
+        return (int(row[0]), int(row[1]), bytes(row[2]))
+
+    def set_revid_filter(self, layout, revnum, count, data):
+        """See RevisionIdMapCache.set_revid_filter."""
+
+        self.mutter("set revid filter for %r to %d entries up to %d",
+                    layout, count, revnum)
+        self.execute(
+            "replace into revid_filter (layout, revnum, count, data) "
+            "values (?, ?, ?, ?)",
+            (layout, revnum, count, sqlite3.Binary(data)))
+        self.commit()
+
 
 class SqliteRevisionInfoCache(RevisionInfoCache, CacheTable):
 
@@ -457,6 +503,75 @@ class SqliteParentsCache(ParentsCache, CacheTable):
         return tuple([row[0].encode("utf-8") for row in rows if row[0] is not None])
 
 
+class SqliteRemoteAccessCache(RemoteAccessCache, CacheTable):
+
+    def __init__(self, cache_db=None, max_size=RA_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        super(SqliteRemoteAccessCache, self).__init__(cache_db)
+        self._size = self._get_size()
+
+    def _create_table(self):
+        self.executescript("""
+        create table if not exists ra_response (
+            kind text not null,
+            path text not null,
+            revnum integer not null,
+            extra text not null,
+            value blob not null
+            );
+        create unique index if not exists ra_response_key on ra_response (kind, path, revnum, extra);
+        create table if not exists ra_response_size (
+            size integer not null
+            );
+        """)
+
+    def _get_size(self):
+        row = self.execute("select size from ra_response_size").fetchone()
+        if row is not None:
+            return row[0]
+        size = self._count_size()
+        self.execute("insert into ra_response_size (size) values (?)", (size,))
+        return size
+
+    def _count_size(self):
+        return self.execute(
+            "select coalesce(sum(length(value)), 0) from ra_response").fetchone()[0]
+
+    def lookup(self, kind, path, revnum, extra):
+        """See RemoteAccessCache.lookup."""
+
+        row = self.execute(
+            "select value from ra_response where kind = ? and path = ? and revnum = ? and extra = ?",
+            (kind, path, revnum, extra)).fetchone()
+        if row is None:
+            raise KeyError((kind, path, revnum, extra))
+        return bytes(row[0])
+
+    def insert(self, kind, path, revnum, extra, value):
+        """See RemoteAccessCache.insert."""
+
+        row = self.execute(
+            "select length(value) from ra_response where kind = ? and path = ? and revnum = ? and extra = ?",
+            (kind, path, revnum, extra)).fetchone()
+        if row is None:
+            added = len(value)
+        else:
+            added = len(value) - row[0]
+        self.execute(
+            "replace into ra_response (kind, path, revnum, extra, value) values (?, ?, ?, ?, ?)",
+            (kind, path, revnum, extra, sqlite3.Binary(value)))
+        self.execute("update ra_response_size set size = size + ?", (added,))
+        self._size = self._get_size()
+        if self._size > self.max_size:
+            # Evict the oldest half of the entries
+            self.mutter("evicting ra responses, size %d", self._size)
+            self.execute(
+                "delete from ra_response where rowid <= (select (min(rowid) + max(rowid)) / 2 from ra_response)")
+            self._size = self._count_size()
+            self.execute("update ra_response_size set size = ?", (self._size,))
+        self._commit_conditionally()
+
+
 class SqliteRepositoryCache(RepositoryCache):
     """Object that provides a cache related to a particular UUID."""
 
@@ -478,5 +593,8 @@ class SqliteRepositoryCache(RepositoryCache):
     def open_parents(self):
         return SqliteParentsCache(self._sqlite)
 
+    def open_ra_cache(self):
+        return SqliteRemoteAccessCache(self._sqlite)
+
     def commit(self):
         self._sqlite.commit()
@@ -49,6 +49,10 @@ from breezy.plugins.svn.logwalker import (
 from breezy.plugins.svn.parents import (
     ParentsCache,
     )
+from breezy.plugins.svn.transport import (
+    RA_CACHE_MAX_SIZE,
+    RemoteAccessCache,
+    )
 
 from subvertpy import NODE_UNKNOWN
 
@@ -110,10 +114,43 @@ class TdbRevisionIdMapCache(RevisionIdMapCache, CacheTable):
 
         mappingname = getattr(mapping, "name", mapping)
         encoded_branch_path = branch.encode('utf-8')
-        self.db[b"native-revid/" + revid] = b"%d %d %s %s" % (min_revnum, max_revnum, mappingname, encoded_branch_path)
+        key = b"native-revid/" + revid
+        if self.db.get(key) is None:
+            self.db[b"revidmap-count"] = b"%d" % (self.count_revids() + 1)
+        self.db[key] = b"%d %d %s %s" % (min_revnum, max_revnum, mappingname, encoded_branch_path)
         if min_revnum == max_revnum:
             self.db[b"foreign-revid/%d %s %s" % (min_revnum, mappingname, encoded_branch_path)] = revid
 
+    def count_revids(self):
+        """See RevisionIdMapCache.count_revids."""
+
+        count = self.db.get(b"revidmap-count")
+        if count is None:
+            return 0
+        return int(count)
+
+    def iter_revids(self):
+        """See RevisionIdMapCache.iter_revids."""
+
+        for key in self.db.iterkeys():
+            if key.startswith(b"native-revid/"):
+                yield key[len(b"native-revid/"):]
+
+    def get_revid_filter(self, layout):
+        """See RevisionIdMapCache.get_revid_filter."""
+
+        data = self.db.get(b"revidmap-filter/%s" % str(layout))
+        if data is None:
+            return None
+        (revnum, count, data) = data.split(b" ", 2)
+        return (int(revnum), int(count), data)
+
+    def set_revid_filter(self, layout, revnum, count, data):
+        """See RevisionIdMapCache.set_revid_filter."""
+
+        self.db[b"revidmap-filter/%s" % str(layout)] = b"%d %d %s" % (
+            revnum, count, data)
+
 
 class TdbRevisionInfoCache(RevisionInfoCache, CacheTable):
 
@@ -297,6 +334,49 @@ class TdbParentsCache(ParentsCache, CacheTable):
 TDB_HASH_SIZE = 10000
 
 
+class TdbRemoteAccessCache(RemoteAccessCache, CacheTable):
+
+    def __init__(self, db, max_size=RA_CACHE_MAX_SIZE):
+        super(TdbRemoteAccessCache, self).__init__(db)
+        self.max_size = max_size
+
+    def _key(self, kind, path, revnum, extra):
+        # NUL can't occur in Subversion paths or the other fields
+        return b"ra/%s\0%d\0%s\0%s" % (kind, revnum, extra,
+                                       path.encode('utf-8'))
+
+    def _get_size(self):
+        size = self.db.get(b"ra-size")
+        if size is None:
+            return 0
+        return int(size)
+
+    def lookup(self, kind, path, revnum, extra):
+        """See RemoteAccessCache.lookup."""
+
+        value = self.db.get(self._key(kind, path, revnum, extra))
+        if value is None:
+            raise KeyError((kind, path, revnum, extra))
+        return value
+
+    def insert(self, kind, path, revnum, extra, value):
+        """See RemoteAccessCache.insert."""
+
+        key = self._key(kind, path, revnum, extra)
+        size = self._get_size() + len(value)
+        old_value = self.db.get(key)
+        if old_value is not None:
+            size -= len(old_value)
+        if size > self.max_size:
+            # TDB doesn't keep track of insertion order, so just start over
+            self.mutter("evicting ra responses, size %d", size)
+            for key in [k for k in self.db.iterkeys() if k.startswith(b"ra/")]:
+                del self.db[key]
+            size = len(value)
+        self.db[key] = value
+        self.db[b"ra-size"] = b"%d" % size
+
+
 class TdbRepositoryCache(RepositoryCache):
     """Object that provides a cache related to a particular UUID."""
 
@@ -323,3 +403,6 @@ class TdbRepositoryCache(RepositoryCache):
 
     def open_parents(self):
         return TdbParentsCache(self._db)
+
+    def open_ra_cache(self):
+        return TdbRemoteAccessCache(self._db)
@@ -314,6 +314,38 @@ class cmd_svn_branches(Command):
             self.outf.write("%s (%s)\n" % (path, name))
 
 
+class cmd_svn_precompute_fileids(Command):
+    """Precompute the file id maps for the branches in a repository.
+
+    This fills the local cache of file id maps for the tip of every branch,
+    so that later operations on these branches don't have to generate them.
+    It is safe to run this in the background, e.g. from a cron job.
+    """
+
+    takes_args = ["location"]
+
+    takes_options = [
+        Option('layout', type=get_layout,
+               help='Repository layout (none, trunk, etc). '
+                    'Default: auto.')]
+
+    hidden = True
+
+    def run(self, location, layout=None):
+        from breezy import errors
+        from breezy.repository import Repository
+        from breezy.plugins.svn import gettext
+        from breezy.plugins.svn.repository import SvnRepository
+
+        repository = Repository.open(location)
+        if not isinstance(repository, SvnRepository):
+            raise errors.BzrCommandError(
+                gettext("Source repository is not a Subversion repository."))
+        count = repository.precompute_fileid_maps(layout=layout)
+        self.outf.write(gettext("Precomputed file id maps for %d branches.\n") %
+                        count)
+
+
 class cmd_fix_svn_ancestry(Command):
     """Fix the SVN ancestry of a repository.
 
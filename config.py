@@ -286,7 +286,8 @@ class SvnRepositoryConfig(Config):
                 ret = set([val])
             else:
                 ret = set(val)
-            if len(ret - set(["log", "fileids", "revids", "revinfo"])) != 0:
+            if len(ret - set(["log", "fileids", "revids", "revinfo", "ra",
+                              "inventories"])) != 0:
                 raise BzrError("Invalid setting 'use-cache': %r" % val)
             return ret
         except KeyError:
@@ -571,3 +572,25 @@ This is usually a bad idea, and not necessary with newer versions of Subversion,
 which support revision properties. This setting is present for compatibility with
 older versions of bzr-svn.
 ''')
+
+svn_ra_trace_option = _mod_bzr_config.Option('svn-ra-trace', default=None,
+    help='''\
+File to record all Subversion RA requests and responses to.
+
+The recorded trace can be replayed by opening svn+replay:// URLs.
+''')
+
+svn_replay_latency_option = _mod_bzr_config.Option('svn-replay-latency',
+    default=0, from_unicode=_mod_bzr_config.int_from_store,
+    help='''\
+Latency in milliseconds to add to each request when replaying a RA trace.
+''')
+
+svn_inventory_cache_size_option = _mod_bzr_config.Option(
+    'svn-inventory-cache-size', default=u'64M',
+    from_unicode=_mod_bzr_config.int_SI_from_store,
+    help='''\
+Maximum size of the on-disk cache of revision tree inventories.
+
+The cache is only used if "inventories" is included in use-cache.
+''')
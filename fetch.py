@@ -29,6 +29,9 @@ of the inventory delta.
 from __future__ import absolute_import
 
 from collections import defaultdict, deque
+import heapq
+import json
+import time
 
 import subvertpy
 from subvertpy import (
@@ -42,6 +45,7 @@ from subvertpy.delta import (
     )
 
 from breezy import (
+    bencode,
     debug,
     delta,
     lru_cache,
@@ -51,6 +55,7 @@ from breezy import (
     urlutils,
     )
 from breezy.errors import (
+    NoSuchFile,
     NoSuchId,
     NoSuchRevision,
     )
@@ -87,6 +92,7 @@ from breezy.plugins.svn.fileids import (
     )
 from breezy.plugins.svn.mapping import (
     SVN_PROP_BZR_PREFIX,
+    mapping_registry,
     )
 from breezy.plugins.svn.repository import (
     SvnRepository,
@@ -101,6 +107,105 @@ from breezy.plugins.svn.transport import (
 MAX_CHECK_PRESENT_INTERVAL = 1000
 # Size of the text cache to keep
 TEXT_CACHE_SIZE = 1024 * 1024 * 50
+# Number of revisions to fetch per write group
+FETCH_BATCH_SIZE = 100
+# Number of slowest revisions to report in a fetch profile
+PROFILE_SLOWEST_REVISIONS = 20
+
+class FetchProfile(object):
+    """Cumulative timings and byte counts for the phases of a fetch.
+
+    Phases don't overlap: time spent in a phase that runs inside another
+    one (e.g. text delta application during the editor drive) only counts
+    towards the inner phase.
+
+    Enabled with -Dsvn-fetch-profile.
+    """
+
+    def __init__(self, slowest_count=PROFILE_SLOWEST_REVISIONS):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.recorded = 0.0
+        self._slowest_count = slowest_count
+        self._slowest = []
+
+    def add(self, phase, elapsed, nbytes=0):
+        """Record time spent in a phase.
+
+        :param phase: Name of the phase
+        :param elapsed: Time spent, in seconds
+        :param nbytes: Number of bytes processed
+        """
+        self.times[phase] += elapsed
+        self.calls[phase] += 1
+        self.bytes[phase] += nbytes
+        self.recorded += elapsed
+
+    def add_outer(self, phase, elapsed, recorded_before, nbytes=0):
+        """Record time spent in a phase that contains other phases.
+
+        :param phase: Name of the phase
+        :param elapsed: Time spent, in seconds, including the inner phases
+        :param recorded_before: Value of recorded when the phase started
+        :param nbytes: Number of bytes processed
+        """
+        self.add(phase, elapsed - (self.recorded - recorded_before), nbytes)
+
+    def add_revision(self, foreign_revid, elapsed):
+        """Record the time spent fetching a single revision."""
+        entry = (elapsed, foreign_revid)
+        if len(self._slowest) < self._slowest_count:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+
+    def slowest_revisions(self):
+        """Return the slowest revisions, slowest first.
+
+        :return: List of (elapsed, foreign_revid) tuples
+        """
+        return sorted(self._slowest, reverse=True)
+
+    def as_dict(self):
+        phases = {}
+        for phase in self.calls:
+            phases[phase] = {
+                "seconds": self.times[phase],
+                "calls": self.calls[phase],
+                "bytes": self.bytes[phase]}
+        return {
+            "phases": phases,
+            "slowest_revisions": [
+                {"uuid": uuid, "branch_path": branch_path,
+                 "revnum": revnum, "seconds": elapsed}
+                for (elapsed, (uuid, branch_path, revnum))
+                in self.slowest_revisions()]}
+
+    def write(self, f):
+        """Write the profile as JSON to a file-like object."""
+        json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def profiled_txdelta_handler(profile, handler):
+    """Wrap a delta window handler to record time and bytes in a profile.
+
+    :param profile: FetchProfile
+    :param handler: Delta window handler to wrap
+    :return: New delta window handler
+    """
+    def wrapper(window):
+        start = time.time()
+        ret = handler(window)
+        if window is None:
+            nbytes = 0
+        else:
+            nbytes = len(window[5])
+        profile.add("textdelta", time.time() - start, nbytes)
+        return ret
+    return wrapper
+
 
 def tree_parent_id_basename_to_file_id(tree, parent_id, basename):
     if parent_id is None and basename == "":
@@ -598,9 +703,13 @@ class FileRevisionBuildEditor(FileBuildEditor):
                     self.editor.revmeta.metarev.branch_path,
                     self.editor.revmeta.metarev.revnum)
         self.chunks = []
-        return apply_txdelta_handler_chunks(self.base_chunks, self.chunks)
+        handler = apply_txdelta_handler_chunks(self.base_chunks, self.chunks)
+        if self.editor.profile is not None:
+            handler = profiled_txdelta_handler(self.editor.profile, handler)
+        return handler
 
     def _close(self, checksum=None):
+        start = time.time()
         if self.chunks is not None:
             chunks = self.chunks
         else:
@@ -663,11 +772,14 @@ class FileRevisionBuildEditor(FileBuildEditor):
         file_key = (self.file_id, text_revision)
         cf = ChunkedContentFactory(file_key, parent_keys, text_sha1, chunks)
 
-        self.editor._text_cache[file_key] = orig_chunks
+        if not self.is_symlink:
+            self.editor._text_cache[text_sha1] = orig_chunks
         self.editor.texts.insert_record_stream([cf])
         ie.revision = text_revision
         self.editor._inv_delta_append(
             self.bzr_base_path, self.path, self.file_id, ie)
+        if self.editor.profile is not None:
+            self.editor.profile.add("texts", time.time() - start, text_size)
 
 
 def ensure_inventories_in_repo(repo, trees):
@@ -690,8 +802,9 @@ class RevisionBuildEditor(DeltaBuildEditor):
             self.revid, self.target, self.source)
 
     def __init__(self, source, target, revid, bzr_parent_trees, svn_base_tree,
-            revmeta, lhs_parent_revmeta, mapping, text_cache):
+            revmeta, lhs_parent_revmeta, mapping, text_cache, profile=None):
         self.target = target
+        self.profile = profile
         self.source = source
         self.texts = target.texts
         self.revid = revid
@@ -794,11 +907,19 @@ class RevisionBuildEditor(DeltaBuildEditor):
     def _get_chunked(self, ie):
         if ie.kind == 'symlink':
             return ("link ", ie.symlink_target.encode("utf-8"))
+        # The text cache is keyed by sha1, so texts that were imported
+        # under a different file id (e.g. on the branch a copy was made
+        # from) can be reused.
+        if ie.text_sha1 is not None:
+            file_data = self._text_cache.get(ie.text_sha1)
+            if file_data is not None:
+                return file_data
         key = (ie.file_id, ie.revision)
-        file_data = self._text_cache.get(key)
-        if file_data is not None:
-            return file_data
-        return self.target.iter_files_bytes([key + (None,)]).next()[1]
+        file_data = list(
+            self.target.iter_files_bytes([key + (None,)]).next()[1])
+        if ie.text_sha1 is not None:
+            self._text_cache[ie.text_sha1] = file_data
+        return file_data
 
     def _add_merge_texts(self):
         def get_new_file_path(file_id):
@@ -843,7 +964,10 @@ class RevisionBuildEditor(DeltaBuildEditor):
 
     def _finish_commit(self):
         if len(self.bzr_parent_trees) > 1:
+            start = time.time()
             self._add_merge_texts()
+            if self.profile is not None:
+                self.profile.add("merge-texts", time.time() - start)
         rev = self.revmeta.get_revision(self.mapping, self.lhs_parent_revmeta)
         assert rev.revision_id != NULL_REVISION
         try:
@@ -857,12 +981,15 @@ class RevisionBuildEditor(DeltaBuildEditor):
             basis_id = NULL_REVISION
             basis_inv = None
         present_parent_ids = self.target.has_revisions(rev.parent_ids)
+        start = time.time()
         rev.inventory_sha1, self.root_inventory = \
             self.target.add_inventory_by_delta(basis_id, self._inv_delta,
             rev.revision_id,
             tuple([r for r in rev.parent_ids if r in present_parent_ids]),
             basis_inv)
         self.target.add_revision(self.revid, rev)
+        if self.profile is not None:
+            self.profile.add("inventory", time.time() - start)
 
         # Only fetch signature if it's cheap
         if self.source.svn_transport.has_capability("log-revprops"):
@@ -930,16 +1057,23 @@ class RevisionBuildEditor(DeltaBuildEditor):
         new_ie.file_id = self._get_new_file_id(path)
         new_ie.parent_id = self._get_new_file_id(urlutils.dirname(path))
         new_ie.revision = self._text_revisions_overrides.get(path, self.revid)
-        # FIXME: Use self._text_cache
-        record = self.texts.get_record_stream(
-                [(old_ie.file_id, old_ie.revision)],
-                'unordered', True).next()
-        self.texts.insert_record_stream(
-                [FulltextContentFactory(
-                    (new_ie.file_id, new_ie.revision),
-                    [], # New file id, so no parents
-                    record.sha1,
-                    record.get_bytes_as('fulltext'))])
+        if old_ie.kind == 'file':
+            self.texts.insert_record_stream(
+                    [ChunkedContentFactory(
+                        (new_ie.file_id, new_ie.revision),
+                        [], # New file id, so no parents
+                        old_ie.text_sha1,
+                        self._get_chunked(old_ie))])
+        else:
+            record = self.texts.get_record_stream(
+                    [(old_ie.file_id, old_ie.revision)],
+                    'unordered', True).next()
+            self.texts.insert_record_stream(
+                    [FulltextContentFactory(
+                        (new_ie.file_id, new_ie.revision),
+                        [], # New file id, so no parents
+                        record.sha1,
+                        record.get_bytes_as('fulltext'))])
         self._inv_delta_append(self.bzr_base_tree.path2id(new_ie.file_id),
             path, new_ie.file_id, new_ie)
 
@@ -1198,6 +1332,48 @@ def report_inventory_contents(reporter, revnum, start_empty):
         reporter.finish()
 
 
+class LazyHistory(object):
+    """List-like view of an iterator that is only consumed as far as needed.
+    """
+
+    __slots__ = ('_iter', '_items')
+
+    def __init__(self, iterator):
+        self._iter = iterator
+        self._items = []
+
+    def _fill(self, count):
+        while self._iter is not None and len(self._items) < count:
+            try:
+                self._items.append(self._iter.next())
+            except StopIteration:
+                self._iter = None
+
+    def has_index(self, index):
+        self._fill(index + 1)
+        return index < len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.stop is None:
+                len(self)
+            else:
+                self._fill(index.stop)
+        else:
+            self._fill(index + 1)
+        return self._items[index]
+
+    def __len__(self):
+        """Return the length, consuming the remainder of the iterator."""
+        while self._iter is not None:
+            self._fill(len(self._items) + 1)
+        return len(self._items)
+
+    def materialized(self):
+        """Return the items that have been retrieved so far."""
+        return list(self._items)
+
+
 class FetchRevisionFinder(object):
     """Simple object that can gather a list of revmeta, mapping tuples
     to fetch."""
@@ -1209,7 +1385,6 @@ class FetchRevisionFinder(object):
         self.needed = list()
         self.checked = set()
         self.extra = list()
-        self._check_present_interval = 1
 
     def get_missing(self, limit=None):
         """Return the revisions that should be fetched, children before parents.
@@ -1293,41 +1468,76 @@ class FetchRevisionFinder(object):
                     from_revnum=from_revnum, pb=pb)
             return self.find_iter_revisions(all_revs, mapping, lambda x: False)
 
+    def _is_present(self, revmeta, mapping):
+        """Check whether a single revision is present in the target."""
+        try:
+            revid = revmeta.get_revision_id(mapping)
+        except SubversionException, (_, num):
+            if num == ERR_FS_NOT_DIRECTORY:
+                return False
+            raise
+        return revid in self.target.has_revisions([revid])
+
+    def _find_first_present(self, history):
+        """Find the index of the newest revision present in the target.
+
+        Gallops back through history with exponentially growing steps
+        until a present revision is found, and then bisects the last
+        step. This relies on the ancestry of a present revision being
+        present as well.
+
+        :param history: LazyHistory with (revmeta, mapping) tuples,
+            newest first
+        :return: Index of the first present revision, or the length of
+            history if none of the revisions are present
+        """
+        lo = -1
+        hi = None
+        step = 1
+        while hi is None:
+            i = lo + step
+            if not history.has_index(i):
+                hi = len(history)
+            elif self._is_present(*history[i]):
+                hi = i
+            else:
+                lo = i
+                step = min(step * 2, MAX_CHECK_PRESENT_INTERVAL)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self._is_present(*history[mid]):
+                hi = mid
+            else:
+                lo = mid
+        return hi
+
     def find_mainline(self, foreign_revid, mapping, find_ghosts=False,
                       exclude_non_mainline=None):
         if (foreign_revid, mapping) in self.checked:
             return []
-        revmetas = deque()
         (uuid, branch_path, revnum) = foreign_revid
-        # TODO: Do binary search to find first revision to fetch if
-        # fetch_ghosts=False ?
-        needs_checking = []
         with ui.ui_factory.nested_progress_bar() as pb:
-            for revmeta, hidden, mapping in self.source._revmeta_provider._iter_reverse_revmeta_mapping_history(
-                branch_path, revnum, to_revnum=0, mapping=mapping):
-                if hidden:
-                    continue
-                if pb:
+            def iter_history():
+                for revmeta, hidden, m in self.source._revmeta_provider._iter_reverse_revmeta_mapping_history(
+                    branch_path, revnum, to_revnum=0, mapping=mapping):
+                    if hidden:
+                        continue
                     pb.update("determining revisions to fetch",
                               revnum-revmeta.metarev.revnum, revnum)
-                if (revmeta.metarev.get_foreign_revid(), mapping) in self.checked:
-                    # This revision (and its ancestry) has already been checked
-                    break
-                needs_checking.append((revmeta, mapping))
-                if (not find_ghosts and not self.target_is_empty and
-                    len(needs_checking) == self._check_present_interval):
-                    missing_revmetas = self.check_revmetas(needs_checking)
-                    for r in missing_revmetas:
-                        revmetas.appendleft(r)
-                    done = (len(missing_revmetas) != len(needs_checking))
-                    needs_checking = []
-                    if done:
-                        break
-                    self._check_present_interval = min(
-                        self._check_present_interval*2, MAX_CHECK_PRESENT_INTERVAL)
-                self.checked.add((revmeta.metarev.get_foreign_revid(), mapping))
-        for r in self.check_revmetas(needs_checking):
-            revmetas.appendleft(r)
+                    if (revmeta.metarev.get_foreign_revid(), m) in self.checked:
+                        # This revision (and its ancestry) has already been
+                        # checked
+                        return
+                    yield (revmeta, m)
+            history = LazyHistory(iter_history())
+            if find_ghosts or self.target_is_empty:
+                first_present = len(history)
+            else:
+                first_present = self._find_first_present(history)
+            missing = self.check_revmetas(history[:first_present])
+        for (revmeta, m) in history.materialized():
+            self.checked.add((revmeta.metarev.get_foreign_revid(), m))
+        revmetas = deque(reversed(missing))
         # Determine if there are any RHS parents to fetch
         if exclude_non_mainline is None:
             # FIXME JRV 2011-10-20: Fetching non-mainline revisions
@@ -1367,6 +1577,94 @@ class FetchRevisionFinder(object):
                 exclude_non_mainline=exclude_non_mainline))
 
 
+class FetchJournal(object):
+    """On-disk record of the progress of a fetch.
+
+    Stores the list of revisions that was found to be missing, and
+    separately the number of those that have already been committed, so
+    that an interrupted fetch can resume without rediscovering them.
+    """
+
+    def __init__(self, transport, name):
+        self.transport = transport
+        self.name = name
+
+    def _committed_name(self):
+        return self.name + ".committed"
+
+    def load(self, latest_revnum):
+        """Load the journal.
+
+        :param latest_revnum: Latest revision number in the source repository
+        :return: List of (foreign_revid, mapping, revid) tuples that still
+            need to be fetched, or None if there is no usable journal
+        """
+        try:
+            text = self.transport.get_bytes(self.name)
+        except NoSuchFile:
+            return None
+        try:
+            committed = int(self.transport.get_bytes(self._committed_name()))
+        except NoSuchFile:
+            committed = 0
+        except ValueError:
+            trace.mutter("ignoring corrupt fetch journal %s", self.name)
+            return None
+        try:
+            (revnum, entries) = bencode.bdecode(text)
+        except (ValueError, TypeError):
+            trace.mutter("ignoring corrupt fetch journal %s", self.name)
+            return None
+        if revnum != latest_revnum:
+            trace.mutter("fetch journal %s is for revnum %d, latest is %d",
+                         self.name, revnum, latest_revnum)
+            return None
+        ret = []
+        for (uuid, branch_path, entry_revnum, mapping_name, revid) in (
+                entries[committed:]):
+            try:
+                mapping = mapping_registry.parse_mapping_name(
+                    "svn-" + mapping_name)
+            except KeyError:
+                return None
+            ret.append(((uuid, branch_path.decode("utf-8"), entry_revnum),
+                        mapping, revid))
+        return ret
+
+    def save(self, latest_revnum, needed, revids=None):
+        """Write the journal.
+
+        :param latest_revnum: Latest revision number in the source repository
+            at the time needed was determined
+        :param needed: List of (revmeta, mapping) tuples to fetch
+        :param revids: Optional list with the revision ids of the entries
+            in needed
+        """
+        if revids is None:
+            revids = [revmeta.get_revision_id(mapping)
+                      for (revmeta, mapping) in needed]
+        entries = []
+        for ((revmeta, mapping), revid) in zip(needed, revids):
+            (uuid, branch_path, revnum) = revmeta.metarev.get_foreign_revid()
+            entries.append([uuid, branch_path.encode("utf-8"), revnum,
+                            mapping.name, revid])
+        self.transport.put_bytes(self._committed_name(), "0")
+        self.transport.put_bytes(self.name,
+            bencode.bencode([latest_revnum, entries]))
+
+    def set_committed(self, committed):
+        """Record the number of entries that have been committed."""
+        self.transport.put_bytes(self._committed_name(), "%d" % committed)
+
+    def remove(self):
+        """Remove the journal, e.g. after the fetch has finished."""
+        for name in (self.name, self._committed_name()):
+            try:
+                self.transport.delete(name)
+            except NoSuchFile:
+                pass
+
+
 class InterFromSvnToInventoryRepository(InterRepository):
     """Svn to any repository actions."""
 
@@ -1380,8 +1678,10 @@ class InterFromSvnToInventoryRepository(InterRepository):
         super(InterFromSvnToInventoryRepository, self).__init__(source, target)
         def chunks_to_size(chunks):
             return sum(map(len, chunks))
+        # Maps text sha1s to chunks
         self._text_cache = lru_cache.LRUSizeCache(TEXT_CACHE_SIZE,
                                                   compute_size=chunks_to_size)
+        self._profile = None
 
         self._use_replay_range = self.source.svn_transport.has_capability(
             "partial-replay") and False
@@ -1442,7 +1742,8 @@ class InterFromSvnToInventoryRepository(InterRepository):
             svn_base_tree = bzr_parent_trees[0]
             return RevisionBuildEditor(self.source, self.target, revid,
                 bzr_parent_trees, svn_base_tree,
-                revmeta, lhs_parent_revmeta, mapping, self._text_cache)
+                revmeta, lhs_parent_revmeta, mapping, self._text_cache,
+                self._profile)
         except NoSuchRevision:
             if revmeta.get_stored_lhs_parent_revid(mapping) not in (
                 None, svn_base_revid):
@@ -1502,16 +1803,18 @@ class InterFromSvnToInventoryRepository(InterRepository):
             if not conn.busy:
                 self.source.svn_transport.add_connection(conn)
 
-    def _fetch_revisions_nochunks(self, revs, pb=None, use_replay=False):
+    def _fetch_revisions_nochunks(self, revs, pb=None, use_replay=False,
+                                  journal=None):
         """Copy a set of related revisions using svn.ra.switch.
 
         :param revids: List of revision ids of revisions to copy,
                        newest first.
         :param pb: Optional progress bar.
+        :param journal: Optional FetchJournal to record progress in
         """
         accidental_file_revs = set()
         self._prev_tree = None
-        batch_size = 100
+        batch_size = FETCH_BATCH_SIZE
         total = len(revs)
         pack_hints = []
         for offset in range(0, total, batch_size):
@@ -1531,7 +1834,13 @@ class InterFromSvnToInventoryRepository(InterRepository):
                         accidental_file_revs.add(revmeta)
                         continue
 
+                    revision_start = time.time()
                     editor = self._get_editor(revmeta, mapping)
+                    drive_start = time.time()
+                    if self._profile is not None:
+                        self._profile.add("parent-trees",
+                                          drive_start - revision_start)
+                        recorded_before = self._profile.recorded
                     try:
                         if use_replay:
                             self._fetch_revision_replay(editor, revmeta,
@@ -1549,27 +1858,89 @@ class InterFromSvnToInventoryRepository(InterRepository):
                         raise
                     self._prev_tree = InventoryRevisionTree(self.target,
                         editor.root_inventory, revid)
+                    if self._profile is not None:
+                        end = time.time()
+                        # Excludes text, inventory and merge text handling,
+                        # which are recorded as separate phases
+                        self._profile.add_outer("editor-drive",
+                            end - drive_start, recorded_before)
+                        self._profile.add_revision(
+                            revmeta.metarev.get_foreign_revid(),
+                            end - revision_start)
             except:
                 self.target.abort_write_group()
                 raise
             else:
+                start = time.time()
                 hint = self.target.commit_write_group()
+                if self._profile is not None:
+                    self._profile.add("commit", time.time() - start)
                 if hint is not None:
                     pack_hints.extend(hint)
+                if journal is not None:
+                    journal.set_committed(min(offset + batch_size, total))
         return pack_hints
 
-    def _fetch_revisions(self, needed, pb):
+    def _fetch_revisions(self, needed, pb, journal=None):
         """Fetch a specified set of revisions.
 
         :param needed: Sequence of revision ids to fetch, topo-sorted
         :param pb: Progress bar to use for reporting progress
+        :param journal: Optional FetchJournal to record progress in
         :return: Pack hint
         """
         if self._use_replay_range:
             return self._fetch_revisions_chunks(needed, pb)
         else:
             return self._fetch_revisions_nochunks(needed, pb,
-                use_replay=self._use_replay)
+                use_replay=self._use_replay, journal=journal)
+
+    def _open_journal(self, revision_id=None, fetch_spec=None, project=None):
+        """Open the journal for a particular fetch.
+
+        :return: A FetchJournal, or None if there is no cache to store
+            it in
+        """
+        if self.source._cache_obj is None:
+            return None
+        if revision_id is not None:
+            heads = [revision_id]
+        elif fetch_spec is not None:
+            heads = sorted(fetch_spec.get_recipe()[1])
+        else:
+            heads = []
+        key = "\0".join(
+            [self.target.base, (project or u"").encode("utf-8")] + heads)
+        return FetchJournal(self.source._cache_obj.open_transport(),
+            "fetch-journal-%s" % osutils.sha_string(key))
+
+    def _resume_from_journal(self, journal, latest_revnum):
+        """Retrieve the revisions that still need to be fetched from a journal.
+
+        :param journal: FetchJournal to read
+        :param latest_revnum: Latest revision number in the source repository
+        :return: Tuple with list of (revmeta, mapping) tuples and list of
+            the matching revision ids, or None
+        """
+        entries = journal.load(latest_revnum)
+        if entries is None:
+            return None
+        if any(uuid != self.source.uuid
+               for ((uuid, branch_path, revnum), mapping, revid) in entries):
+            return None
+        trace.mutter("resuming fetch, %d revisions left", len(entries))
+        # Revisions may have been fetched by another process in the meantime
+        present_revids = self.target.has_revisions(
+            [revid for (foreign_revid, mapping, revid) in entries])
+        needed = []
+        revids = []
+        for ((uuid, branch_path, revnum), mapping, revid) in entries:
+            if revid in present_revids:
+                continue
+            needed.append((self.source._revmeta_provider.lookup_revision(
+                branch_path, revnum), mapping))
+            revids.append(revid)
+        return (needed, revids)
 
     def get_revision_finder(self, target_is_empty=False):
         return FetchRevisionFinder(self.source, self.target, target_is_empty)
@@ -1620,6 +1991,18 @@ class InterFromSvnToInventoryRepository(InterRepository):
         """Fetch revisions. """
         if revision_id == NULL_REVISION:
             return
+        if ("svn-fetch-profile" in debug.debug_flags and
+            self._profile is None):
+            self._profile = FetchProfile()
+            try:
+                return self.fetch(revision_id=revision_id, pb=pb,
+                    find_ghosts=find_ghosts, needed=needed, mapping=mapping,
+                    project=project, fetch_spec=fetch_spec,
+                    target_is_empty=target_is_empty,
+                    exclude_non_mainline=exclude_non_mainline)
+            finally:
+                self._write_profile(self._profile)
+                self._profile = None
         # Dictionary with paths as keys, revnums as values
 
         if pb:
@@ -1629,16 +2012,36 @@ class InterFromSvnToInventoryRepository(InterRepository):
         # (or youngest_revnum) and call self.target.add_revision()
         # or self.target.add_inventory() each time
         with self.target.lock_write():
+            start = time.time()
+            journal = None
+            revids = None
+            if needed is None:
+                journal = self._open_journal(revision_id=revision_id,
+                    fetch_spec=fetch_spec, project=project)
+            if journal is not None:
+                # Determined before discovery, so that the journal is not
+                # considered valid for revisions committed during it
+                latest_revnum = self.source.get_latest_revnum()
+                resumed = self._resume_from_journal(journal, latest_revnum)
+                if resumed is not None:
+                    (needed, revids) = resumed
             if needed is None:
                 needed = self._get_needed(target_is_empty=target_is_empty,
                     revision_id=revision_id, fetch_spec=fetch_spec,
                     find_ghosts=find_ghosts, project=project,
                     exclude_non_mainline=exclude_non_mainline)
+            if self._profile is not None:
+                self._profile.add("discovery", time.time() - start)
 
             if len(needed) == 0:
                 # Nothing to fetch
+                if journal is not None:
+                    journal.remove()
                 return
 
+            if journal is not None:
+                journal.save(latest_revnum, needed, revids)
+
             if pb:
                 pb.update("fetch phase", 1, 2)
 
@@ -1648,13 +2051,18 @@ class InterFromSvnToInventoryRepository(InterRepository):
             else:
                 nested_pb = None
             try:
-                pack_hint = self._fetch_revisions(needed, pb)
+                pack_hint = self._fetch_revisions(needed, pb, journal)
                 if (pack_hint is not None and
                     self.target._format.pack_compresses):
+                    start = time.time()
                     self.target.pack(hint=pack_hint)
+                    if self._profile is not None:
+                        self._profile.add("pack", time.time() - start)
             finally:
                 if nested_pb is not None:
                     nested_pb.finished()
+            if journal is not None:
+                journal.remove()
             # Double check that we can actually find the revision that we
             # attempted to fetch.
             # This uses 'assert' rather than raising AssertionError
@@ -1662,6 +2070,16 @@ class InterFromSvnToInventoryRepository(InterRepository):
             assert revision_id is None or self.target.has_revision(
                 revision_id)
 
+    def _write_profile(self, profile):
+        """Write a fetch profile to a JSON file in the current directory."""
+        path = "svn-fetch-profile-%s.json" % time.strftime("%Y%m%d%H%M%S")
+        f = open(path, 'w')
+        try:
+            profile.write(f)
+        finally:
+            f.close()
+        trace.note("Fetch profile written to %s.", path)
+
     def _fetch_revisions_chunks(self, revs, pb=None):
         """Copy a set of related revisions using svn.ra.replay.
 
@@ -17,59 +17,129 @@
 
 from __future__ import absolute_import
 
+from breezy.errors import NoSuchRevision
+from breezy.lru_cache import LRUCache
 from breezy.revision import NULL_REVISION
 
+# Number of revisions to keep revision metadata and parents for
+REVMETA_CACHE_SIZE = 1000
+# Number of revisions to keep file id maps for
+FILEIDMAP_CACHE_SIZE = 10
+
 
 class PerFileParentProvider(object):
-    """Subversion texts backend."""
+    """Subversion texts backend.
+
+    Revision metadata and file id maps are kept for the most recently
+    used revisions.
+    """
 
     def __init__(self, repository):
         self.repository = repository
+        # revid -> (revmeta, mapping), or None for ghosts
+        self._revmetas = LRUCache(REVMETA_CACHE_SIZE)
+        # revid -> file id map
+        self._fileidmaps = LRUCache(FILEIDMAP_CACHE_SIZE)
+        # revid -> list of (revid, revmeta, mapping) tuples for parents
+        self._parents = LRUCache(REVMETA_CACHE_SIZE)
 
-    def _get_parent(self, fileid, revid):
-        revmeta, mapping = self.repository._get_revmeta(revid)
-        parentrevmeta = revmeta.get_lhs_parent_revmeta(mapping)
-        fileidmap = self.repository.get_fileid_map(revmeta, mapping)
+    def _get_revmeta(self, revid):
         try:
-            path = fileidmap.reverse_lookup(mapping, fileid)
+            return self._revmetas[revid]
         except KeyError:
-            return None
+            pass
+        try:
+            ret = self.repository._get_revmeta(revid)
+        except NoSuchRevision:
+            ret = None
+        self._revmetas[revid] = ret
+        return ret
 
-        text_parents = revmeta.get_text_parents(mapping)
-        if path in text_parents:
-            return tuple([
-                (fileid, tp) for tp in text_parents[path]
-                if tp != NULL_REVISION])
+    def _get_fileidmap(self, revid, revmeta, mapping):
+        try:
+            return self._fileidmaps[revid]
+        except KeyError:
+            fileidmap = self.repository.get_fileid_map(revmeta, mapping)
+            self._fileidmaps[revid] = fileidmap
+            return fileidmap
 
-        # Not explicitly recorded - so just return the text revisions 
-        # present in the parents of the mentioned revision.
+    def _get_parent_revmetas(self, revid, revmeta, mapping):
+        try:
+            return self._parents[revid]
+        except KeyError:
+            pass
+        parentrevmeta = revmeta.get_lhs_parent_revmeta(mapping)
         ret = []
-        rev_parent_revids = revmeta.get_parent_ids(mapping, parentrevmeta)
-        for (revid, revmeta, mapping) in self.repository._iter_revmetas(
-                rev_parent_revids):
-            if revmeta is None:
+        for parent_revid in revmeta.get_parent_ids(mapping, parentrevmeta):
+            if parent_revid == NULL_REVISION:
+                continue # Nothing exists in NULL_REVISION
+            parent = self._get_revmeta(parent_revid)
+            if parent is None:
                 # Parent is missing, let's just ignore it..
                 continue
-            if revid == NULL_REVISION:
-                continue # Nothing exists in NULL_REVISION
-            fileidmap = self.repository.get_fileid_map(revmeta, mapping)
+            ret.append((parent_revid, ) + parent)
+        self._parents[revid] = ret
+        return ret
+
+    def _get_parents(self, revid, fileids):
+        """Determine the text parents for a set of files in a revision.
+
+        :param revid: Revision id
+        :param fileids: File ids
+        :return: Dictionary mapping file ids to tuples of parent keys, or
+            None if the file is not present
+        """
+        ret = {}
+        revision = self._get_revmeta(revid)
+        if revision is None:
+            for fileid in fileids:
+                ret[fileid] = None
+            return ret
+        (revmeta, mapping) = revision
+        fileidmap = self._get_fileidmap(revid, revmeta, mapping)
+        text_parents = None
+        for fileid in fileids:
             try:
                 path = fileidmap.reverse_lookup(mapping, fileid)
             except KeyError:
-                pass # File didn't exist here
-            else:
-                text_parent = fileidmap.lookup(mapping, path)[:2]
-                assert len(text_parent) == 2
-                if text_parent not in ret and text_parent[1] != NULL_REVISION:
-                    ret.append(text_parent)
+                ret[fileid] = None
+                continue
 
-        return tuple(ret)
+            if text_parents is None:
+                text_parents = revmeta.get_text_parents(mapping)
+            if path in text_parents:
+                ret[fileid] = tuple([
+                    (fileid, tp) for tp in text_parents[path]
+                    if tp != NULL_REVISION])
+                continue
 
-    def get_parent_map(self, keys):
-        invs = {}
+            # Not explicitly recorded - so just return the text revisions
+            # present in the parents of the mentioned revision.
+            parents = []
+            for (parent_revid, parent_revmeta, parent_mapping) in (
+                    self._get_parent_revmetas(revid, revmeta, mapping)):
+                parent_fileidmap = self._get_fileidmap(parent_revid,
+                    parent_revmeta, parent_mapping)
+                try:
+                    parent_path = parent_fileidmap.reverse_lookup(
+                        parent_mapping, fileid)
+                except KeyError:
+                    pass # File didn't exist here
+                else:
+                    text_parent = parent_fileidmap.lookup(parent_mapping,
+                        parent_path)[:2]
+                    assert len(text_parent) == 2
+                    if (text_parent not in parents and
+                        text_parent[1] != NULL_REVISION):
+                        parents.append(text_parent)
+            ret[fileid] = tuple(parents)
+        return ret
 
-        # First, figure out the revision number/path
+    def get_parent_map(self, keys):
         ret = {}
+        # Group the keys by revision, so every revision is only processed
+        # once.
+        todo = {}
         for k in keys:
             if k == NULL_REVISION:
                 ret[k] = ()
@@ -77,7 +147,10 @@ class PerFileParentProvider(object):
                 if k[1] == NULL_REVISION:
                     ret[k] = None
                 else:
-                    ret[k] = self._get_parent(*k)
+                    todo.setdefault(k[1], set()).add(k[0])
             else:
                 ret[k] = None
+        for revid, fileids in todo.iteritems():
+            for fileid, parents in self._get_parents(revid, fileids).iteritems():
+                ret[(fileid, revid)] = parents
         return ret
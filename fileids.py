@@ -22,6 +22,7 @@ from __future__ import absolute_import
 import urllib
 
 from breezy import (
+    osutils,
     ui,
     )
 from breezy.errors import (
@@ -30,6 +31,7 @@ from breezy.errors import (
 from breezy.bzr.knit import (
     make_file_factory,
     )
+from breezy.lru_cache import LRUSizeCache
 from breezy.revision import (
     NULL_REVISION,
     )
@@ -91,10 +93,10 @@ def idmap_lookup(get, mapping, path):
         raise KeyError("Unable to determine file id for %r" % path)
 
 
-def idmap_reverse_lookup(idmap, mapping, fileid):
+def idmap_reverse_lookup(items, mapping, fileid):
     """Lookup a file id in an idmap.
 
-    :param idmap: The idmap to lookup in.
+    :param items: Iterable over the (path, entry) items of the idmap
     :param mapping: Mapping
     :param fileid: The file id to look up
     :return: Path
@@ -107,21 +109,25 @@ def idmap_reverse_lookup(idmap, mapping, fileid):
             uuid = None
     else:
         uuid = None
-    # Unfortunately, the map is the other way around
-    for k in sorted(idmap.iterkeys()):
-        (v, ck, child_create_foreign_revid) = idmap[k]
+    # Unfortunately, the map is the other way around. If there are
+    # several matches, the one for the lowest path wins.
+    found = None
+    for (k, (v, ck, child_create_foreign_revid)) in items:
+        if found is not None and k >= found[0]:
+            continue
         if v == fileid:
-            return k
-        if (child_create_foreign_revid is not None and
+            found = (k, k)
+        elif (child_create_foreign_revid is not None and
             child_create_foreign_revid[0] == uuid and
             child_create_foreign_revid[2] == revnum and
             path.startswith("%s/" % child_create_foreign_revid[1])):
             inv_p = path[len(child_create_foreign_revid[1]):].strip("/").decode("utf-8")
             foreign_revid = (uuid, child_create_foreign_revid[1], revnum)
             if mapping.generate_file_id(foreign_revid, inv_p) == fileid:
-                return inv_p
-
-    raise KeyError(fileid)
+                found = (k, inv_p)
+    if found is None:
+        raise KeyError(fileid)
+    return found[1]
 
 
 def determine_text_revisions(changes, default_revid, specific_revids):
@@ -169,8 +175,33 @@ def get_local_changes(paths, branch):
     return new_paths
 
 
-FILEIDMAP_VERSION = 3
+FILEIDMAP_VERSION = 4
+# Maximum number of revisions to replay before saving a file id map
 FILEID_MAP_SAVE_INTERVAL = 1000
+# Minimum number of revisions to replay before saving a file id map
+FILEID_MAP_MIN_SAVE_INTERVAL = 50
+# Number of map entries that cost about as much to save as replaying a
+# single revision costs
+FILEID_MAP_SAVE_COST = 100
+# Maximum number of entries in a leaf node of a cached file id map
+FILEIDMAP_LEAF_SIZE = 256
+# Maximum total number of entries in the file id map nodes kept in memory
+FILEIDMAP_NODE_CACHE_SIZE = 1024 * 1024
+
+def fileid_map_checkpoint_interval(map_size):
+    """Determine after how many replayed revisions a file id map is saved.
+
+    Saving a large map is more expensive than saving a small one, so large
+    maps are saved less often. The interval is bounded, so that building a
+    map from the nearest saved map never takes more than
+    FILEID_MAP_SAVE_INTERVAL revisions.
+
+    :param map_size: Number of entries in the map
+    :return: Number of revisions
+    """
+    return max(FILEID_MAP_MIN_SAVE_INTERVAL,
+               min(FILEID_MAP_SAVE_INTERVAL, map_size // FILEID_MAP_SAVE_COST))
+
 
 def simple_apply_changes(new_file_id, changes):
     """Simple function that generates a dictionary with file id changes.
@@ -209,11 +240,59 @@ class FileIdMap(object):
 
 
 class DictFileIdMap(FileIdMap):
+    """File id map backed by a dictionary.
 
-    __slots__ = ('data')
+    A reverse index (file id to paths, and the paths with implicit children
+    per creating revision) is built on first use and updated by apply_delta.
+    """
+
+    __slots__ = ('data', '_reverse', '_child_creates')
 
     def __init__(self, data):
         self.data = data
+        self._reverse = None
+        self._child_creates = None
+
+    def _build_index(self):
+        self._reverse = {}
+        self._child_creates = {}
+        for path, entry in self.data.iteritems():
+            self._index_entry(path, entry)
+
+    def _index_entry(self, path, entry):
+        (fileid, changed_revid, child_create_revid) = entry
+        self._reverse.setdefault(fileid, set()).add(path)
+        if child_create_revid is not None:
+            (uuid, bp, revnum) = child_create_revid
+            bps = self._child_creates.setdefault((uuid, revnum), {})
+            bps.setdefault(bp, set()).add(path)
+
+    def _unindex_entry(self, path, entry):
+        (fileid, changed_revid, child_create_revid) = entry
+        paths = self._reverse[fileid]
+        paths.discard(path)
+        if not paths:
+            del self._reverse[fileid]
+        if child_create_revid is not None:
+            (uuid, bp, revnum) = child_create_revid
+            bps = self._child_creates[(uuid, revnum)]
+            bps[bp].discard(path)
+            if not bps[bp]:
+                del bps[bp]
+            if not bps:
+                del self._child_creates[(uuid, revnum)]
+
+    def _set_entry(self, path, entry):
+        if self._reverse is not None:
+            if path in self.data:
+                self._unindex_entry(path, self.data[path])
+            self._index_entry(path, entry)
+        self.data[path] = entry
+
+    def _del_entry(self, path):
+        if self._reverse is not None:
+            self._unindex_entry(path, self.data[path])
+        del self.data[path]
 
     def apply_delta(self, text_revisions, delta, changes, default_revid,
                       mapping, foreign_revid):
@@ -229,7 +308,7 @@ class DictFileIdMap(FileIdMap):
                 for xp in self.data.keys():
                     if ((p == xp or xp.startswith(u"%s/" % p)) and
                         not xp in delta):
-                        del self.data[xp]
+                        self._del_entry(xp)
 
         for x in sorted(text_revisions.keys() + delta.keys()):
             if not isinstance(x, text_type):
@@ -243,8 +322,8 @@ class DictFileIdMap(FileIdMap):
                     child_create_revid = foreign_revid
                 else:
                     child_create_revid = None
-                self.data[x] = (delta[x],
-                    text_revisions.get(x, default_revid), child_create_revid)
+                self._set_entry(x, (delta[x],
+                    text_revisions.get(x, default_revid), child_create_revid))
             else:
                 # Entry already existed
                 try:
@@ -252,18 +331,17 @@ class DictFileIdMap(FileIdMap):
                 except KeyError:
                     raise AssertionError("Unable to find old fileid for %s "
                         "in %r" % (x, foreign_revid))
-                self.data[x] = (prev_entry[0],
-                    text_revisions.get(x, default_revid), prev_entry[2])
+                self._set_entry(x, (prev_entry[0],
+                    text_revisions.get(x, default_revid), prev_entry[2]))
 
         if not "" in self.data:
             raise AssertionError("root no longer exists after %r in %r" %
                 (foreign_revid, self.data))
 
     def has_fileid(self, fileid):
-        for fid, _ in self.data.itervalues():
-            if fid == fileid:
-                return True
-        return False
+        if self._reverse is None:
+            self._build_index()
+        return fileid in self._reverse
 
     def as_dict(self):
         return self.data
@@ -272,7 +350,26 @@ class DictFileIdMap(FileIdMap):
         return idmap_lookup(self.data.__getitem__, mapping, path)
 
     def reverse_lookup(self, mapping, fileid):
-        return idmap_reverse_lookup(self.data, mapping, fileid)
+        assert type(fileid) is str
+        if self._reverse is None:
+            self._build_index()
+        try:
+            return min(self._reverse[fileid])
+        except KeyError:
+            pass
+        if not mapping.parseable_file_ids:
+            raise KeyError(fileid)
+        try:
+            (uuid, revnum, path) = mapping.parse_file_id(fileid)
+        except errors.InvalidFileId:
+            raise KeyError(fileid)
+        # The file id may be that of an implicit child of a copied directory
+        for bp in sorted(self._child_creates.get((uuid, revnum), {})):
+            if bp == u"" or path.startswith("%s/" % bp):
+                inv_p = path[len(bp):].strip("/").decode("utf-8")
+                if mapping.generate_file_id((uuid, bp, revnum), inv_p) == fileid:
+                    return inv_p
+        raise KeyError(fileid)
 
 
 class FileIdMapStore(object):
@@ -344,60 +441,200 @@ class FileIdMapStore(object):
                 self.update_idmap(map, revmeta, mapping)
         return map
 
+    def precompute(self, tips):
+        """Make sure the file id maps for a set of revisions are cached.
+
+        Without a cache there is nothing to precompute.
+
+        :param tips: Iterable over (foreign_revid, mapping) tuples
+        """
+
+
+def _serialize_idmap_entry(path, entry):
+    (id, changed_revid, created_revid) = entry
+    if not isinstance(path, text_type):
+        raise TypeError(path)
+    if not isinstance(id, bytes):
+        raise TypeError(id)
+    if not isinstance(changed_revid, bytes):
+        raise TypeError(changed_revid)
+    assert created_revid is None or isinstance(created_revid, tuple)
+    if created_revid is None:
+        optional_child_create_revid = b""
+    else:
+        optional_child_create_revid = b"\t%s:%d:%s" % (
+            created_revid[0], created_revid[2], created_revid[1].encode('utf-8'))
+    return b"%s\t%s\t%s%s\n" % (
+        urllib.quote(path.encode("utf-8")),
+        urllib.quote(id),
+        urllib.quote(changed_revid),
+        optional_child_create_revid)
+
+
+def _parse_idmap_entry(line):
+    entries = line.rstrip("\n").split("\t", 4)
+    if len(entries) == 3:
+        (filename, id, changed_revid) = entries
+        child_create_revid = None
+    else:
+        (filename, id, changed_revid, child_create_text) = entries
+        (uuid, revnum, bp) = child_create_text.split(":", 3)
+        child_create_revid = (uuid, bp, int(revnum))
+    return (urllib.unquote(filename).decode("utf-8"),
+            (urllib.unquote(id), urllib.unquote(changed_revid),
+             child_create_revid))
+
+
+def _idmap_search_key(path):
+    return osutils.sha_string(path.encode("utf-8"))
+
+
+class ChkFileIdMap(FileIdMap):
+    """File id map stored as a hash trie in a FileIdMapCache.
+
+    Nodes are only read from the cache when a lookup needs them. Reverse
+    lookups that can't be answered from the file id itself scan the
+    nodes of the trie.
+    """
+
+    __slots__ = ('_cache', '_root_key')
+
+    def __init__(self, cache, root_key):
+        self._cache = cache
+        self._root_key = root_key
+
+    def _get(self, path):
+        search_key = _idmap_search_key(path)
+        (kind, items) = self._cache._get_node(self._root_key)
+        depth = 0
+        while kind == "internal":
+            (kind, items) = self._cache._get_node(items[search_key[depth]])
+            depth += 1
+        return items[path]
+
+    def _iter_node(self, key):
+        (kind, items) = self._cache._get_node(key)
+        if kind == "internal":
+            for child_key in items.itervalues():
+                for item in self._iter_node(child_key):
+                    yield item
+        else:
+            for item in items.iteritems():
+                yield item
+
+    def has_fileid(self, fileid):
+        for (path, entry) in self._iter_node(self._root_key):
+            if entry[0] == fileid:
+                return True
+        return False
+
+    def as_dict(self):
+        return dict(self._iter_node(self._root_key))
+
+    def lookup(self, mapping, path):
+        return idmap_lookup(self._get, mapping, path)
+
+    def reverse_lookup(self, mapping, fileid):
+        if mapping.parseable_file_ids:
+            try:
+                (uuid, revnum, path) = mapping.parse_file_id(fileid)
+            except errors.InvalidFileId:
+                pass
+            else:
+                # The file id contains the full path the file was
+                # introduced at, so one of its suffixes is likely to be the
+                # current path.
+                if not isinstance(path, text_type):
+                    path = path.decode("utf-8")
+                parts = path.split(u"/")
+                for i in range(len(parts)+1):
+                    candidate = u"/".join(parts[i:])
+                    try:
+                        if self.lookup(mapping, candidate)[0] == fileid:
+                            return candidate
+                    except KeyError:
+                        pass
+        return idmap_reverse_lookup(self._iter_node(self._root_key), mapping,
+            fileid)
+
 
 class FileIdMapCache(object):
+    """Cache of file id maps.
 
-    __slots__ = ('idmap_knit')
+    Every map is stored as a hash trie, keyed by the sha1 of the paths. Nodes
+    are stored by the sha1 of their contents, so maps of related revisions
+    share the nodes for unchanged parts of the tree.
+    """
+
+    __slots__ = ('idmap_knit', 'node_knit', '_node_cache')
 
     def __init__(self, cache_transport):
         mapper = ConstantMapper("fileidmap-v%d" % FILEIDMAP_VERSION)
         self.idmap_knit = make_file_factory(True, mapper)(cache_transport)
+        mapper = ConstantMapper("fileidmap-nodes-v%d" % FILEIDMAP_VERSION)
+        self.node_knit = make_file_factory(False, mapper)(cache_transport)
+        self._node_cache = LRUSizeCache(FILEIDMAP_NODE_CACHE_SIZE,
+            compute_size=lambda node: len(node[1]))
+
+    def _get_lines(self, knit, key):
+        record = knit.get_record_stream([key], 'unordered', True).next()
+        if record.storage_kind == 'absent':
+            raise RevisionNotPresent(key, knit)
+        return osutils.split_lines(record.get_bytes_as('fulltext'))
+
+    def _get_node(self, key):
+        try:
+            return self._node_cache[key]
+        except KeyError:
+            pass
+        lines = self._get_lines(self.node_knit, (key,))
+        kind = lines[0].rstrip("\n")
+        if kind == "internal":
+            items = dict(line.rstrip("\n").split("\t", 1)
+                         for line in lines[1:])
+        elif kind == "leaf":
+            items = dict(_parse_idmap_entry(line) for line in lines[1:])
+        else:
+            raise AssertionError("invalid file id map node %r" % kind)
+        self._node_cache[key] = (kind, items)
+        return (kind, items)
+
+    def _save_node(self, items, depth):
+        if len(items) <= FILEIDMAP_LEAF_SIZE or depth == len(items[0][0]):
+            lines = ["leaf\n"] + [_serialize_idmap_entry(path, entry)
+                                  for (search_key, path, entry) in items]
+        else:
+            children = {}
+            for item in items:
+                children.setdefault(item[0][depth], []).append(item)
+            lines = ["internal\n"] + [
+                "%s\t%s\n" % (c, self._save_node(children[c], depth+1))
+                for c in sorted(children)]
+        key = "sha1:%s" % osutils.sha_strings(lines)
+        if (not key in self._node_cache and
+            not self.node_knit.get_parent_map([(key,)])):
+            self.node_knit.add_lines((key,), [], lines)
+        return key
 
     def save(self, revid, parent_revids, _map):
         mutter('saving file id map for %r', revid)
+        items = sorted((_idmap_search_key(path), path, entry)
+                       for (path, entry) in _map.iteritems())
+        root_key = self._save_node(items, 0)
+        self.idmap_knit.add_lines((revid,), [(r, ) for r in parent_revids],
+                                  ["%s\n" % root_key])
 
-        lines = []
-
-        for path in sorted(_map.keys()):
-            (id, changed_revid, created_revid) = _map[path]
-            if not isinstance(path, text_type):
-                raise TypeError(path)
-            if not isinstance(id, bytes):
-                raise TypeError(id)
-            if not isinstance(changed_revid, bytes):
-                raise TypeError(changed_revid)
-            assert created_revid is None or isinstance(created_revid, tuple)
-            if created_revid is None:
-                optional_child_create_revid = b""
-            else:
-                optional_child_create_revid = b"\t%s:%d:%s" % (
-                    created_revid[0], created_revid[2], created_revid[1].encode('utf-8'))
-            lines.append(b"%s\t%s\t%s%s\n" % (
-                urllib.quote(path.encode("utf-8")),
-                urllib.quote(id),
-                urllib.quote(changed_revid),
-                optional_child_create_revid))
+    def load_map(self, revid):
+        """Open the file id map for a revision.
 
-        self.idmap_knit.add_lines((revid,), [(r, ) for r in parent_revids],
-                                  lines)
+        :param revid: Revision id
+        :return: A FileIdMap, reading its contents from the cache on demand
+        """
+        (root_key,) = self._get_lines(self.idmap_knit, (revid,))
+        return ChkFileIdMap(self, root_key.rstrip("\n"))
 
     def load(self, revid):
-        map = {}
-        for ((from_revid,), line) in self.idmap_knit.annotate((revid,)):
-            entries = line.rstrip("\n").split("\t", 4)
-            if len(entries) == 3:
-                (filename, id, changed_revid) = entries
-                child_create_revid = None
-            else:
-                (filename, id, changed_revid, child_create_text) = entries
-                (uuid, revnum, bp) = child_create_text.split(":", 3)
-                child_create_revid = (uuid, bp, int(revnum))
-            map[urllib.unquote(filename).decode("utf-8")] = (
-                urllib.unquote(id), urllib.unquote(changed_revid),
-                child_create_revid)
-            assert isinstance(map[urllib.unquote(filename).decode("utf-8")][0], str)
-
-        return map
+        return self.load_map(revid).as_dict()
 
 
 class CachingFileIdMapStore(object):
@@ -424,17 +661,23 @@ class CachingFileIdMapStore(object):
                     continue
                 revid = revmeta.get_revision_id(mapping)
                 try:
-                    map = DictFileIdMap(self.cache.load(revid))
+                    map = self.cache.load_map(revid)
                     # found the nearest cached map
                     next_parent_revs = [revid]
                     break
                 except RevisionNotPresent:
                     todo.append((revmeta, mapping))
 
-        # target revision was present
         if len(todo) == 0:
+            if len(next_parent_revs) > 0:
+                # target revision was present
+                return map
             return self.actual.get_map((uuid, branch, revnum), mapping)
 
+        if len(next_parent_revs) > 0:
+            # The map will be modified, so load all of it
+            map = DictFileIdMap(map.as_dict())
+
         if len(next_parent_revs) == 0:
             if mapping.is_branch("") and branch == "":
                 map = DictFileIdMap({
@@ -443,15 +686,38 @@ class CachingFileIdMapStore(object):
             else:
                 map = DictFileIdMap({})
 
+        todo.reverse()
+        # Number of revisions replayed since the last saved map
+        replayed = 0
         with ui.ui_factory.nested_progress_bar() as pb:
-            for i, (revmeta, mapping) in enumerate(reversed(todo)):
+            for i, (revmeta, mapping) in enumerate(todo):
                 pb.update('generating file id map', i, len(todo))
                 revid = revmeta.get_revision_id(mapping)
                 self.actual.update_idmap(map, revmeta, mapping)
-                parent_revs = next_parent_revs
-                if (revnum % FILEID_MAP_SAVE_INTERVAL == 0 or
-                    revnum == revmeta.metarev.revnum):
-                    self.cache.save(revid, parent_revs, map.as_dict())
-                next_parent_revs = [revid]
+                replayed += 1
+                # Always save the map at the point a branch was copied from,
+                # so that other branches copied from the same revision can
+                # start from it. Since the cache shares unchanged nodes
+                # between maps, the maps of the copies only take up space
+                # for the paths that differ.
+                if (i == len(todo) - 1 or
+                    todo[i+1][0].metarev.branch_path !=
+                        revmeta.metarev.branch_path or
+                    replayed >= fileid_map_checkpoint_interval(
+                        len(map.as_dict()))):
+                    self.cache.save(revid, next_parent_revs, map.as_dict())
+                    next_parent_revs = [revid]
+                    replayed = 0
         return map
 
+    def precompute(self, tips):
+        """Make sure the file id maps for a set of revisions are cached.
+
+        :param tips: Iterable over (foreign_revid, mapping) tuples
+        """
+        tips = list(tips)
+        with ui.ui_factory.nested_progress_bar() as pb:
+            for i, (foreign_revid, mapping) in enumerate(tips):
+                pb.update('precomputing file id maps', i, len(tips))
+                self.get_map(foreign_revid, mapping)
+
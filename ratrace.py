@@ -0,0 +1,461 @@
+# Copyright (C) 2005-2009 Jelmer Vernooij <jelmer@samba.org>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Recording and replaying of Subversion RA sessions.
+
+When the svn-ra-trace option is set, all RA requests and their responses
+(including editor drives and callbacks) are written to a trace file.
+Opening svn+replay:///path/to/trace URLs serves the requests from such a
+trace, optionally adding the latency set in the svn-replay-latency
+option to every request. Paths inside the repository can be appended
+to the path of the trace file.
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import gzip
+import marshal
+import os
+import struct
+import threading
+import time
+import urlparse
+
+import subvertpy
+
+from breezy import (
+    config as _mod_bzr_config,
+    errors,
+    trace,
+    )
+
+
+TRACE_HEADER = "bzr-svn ra trace v1\n"
+
+REPLAY_SCHEME = "svn+replay"
+
+# RA methods that return a reporter, which drives the editor when finished
+REPORTER_METHODS = set(["do_update", "do_switch", "do_diff"])
+
+# RA methods that are passed through without being recorded
+UNRECORDED_METHODS = set(["reparent", "get_commit_editor", "change_rev_prop",
+    "get_repos_root"])
+
+# Marker for objects created during an editor drive in recorded arguments
+_OBJECT_MARKER = "\0object"
+
+
+class ReplayMissingResponse(errors.BzrError):
+
+    _fmt = "No response for %(request)s in RA trace %(path)s"
+
+    def __init__(self, path, request):
+        errors.BzrError.__init__(self)
+        self.path = path
+        self.request = request
+
+
+def _is_plain(obj):
+    """Check whether an object can be stored in a trace as is."""
+    if obj is None or isinstance(obj, (bool, int, long, float, str, unicode)):
+        return True
+    if isinstance(obj, (list, tuple)):
+        return all(_is_plain(x) for x in obj)
+    if isinstance(obj, dict):
+        return all(_is_plain(k) and _is_plain(v) for (k, v) in obj.iteritems())
+    return False
+
+
+def _request_key(name, relurl, args, kwargs, root_url):
+    """Create a hashable key for a RA request.
+
+    Objects passed in by the caller (editors, callbacks, streams) are left
+    out and URLs are made relative to the repository root.
+    """
+    def freeze(obj):
+        if isinstance(obj, (list, tuple)):
+            return tuple(freeze(x) for x in obj)
+        if isinstance(obj, dict):
+            return tuple(sorted((k, freeze(v)) for (k, v) in obj.iteritems()))
+        if isinstance(obj, (str, unicode)) and obj.startswith(root_url):
+            return "^/" + obj[len(root_url):].strip("/")
+        if not _is_plain(obj):
+            return None
+        return obj
+    return (name, relurl, freeze(args), freeze(sorted(kwargs.items())))
+
+
+class _RecordingDrive(object):
+    """Records the calls made by a RA request on objects of the caller."""
+
+    def __init__(self):
+        self.events = []
+        self._next_id = 0
+
+    def wrap(self, obj):
+        ret = _RecordingProxy(self, obj, self._next_id)
+        self._next_id += 1
+        return ret
+
+    def wrap_args(self, args):
+        return [a if _is_plain(a) else self.wrap(a) for a in args]
+
+    def call(self, obj_id, name, fn, args):
+        event = [obj_id, name, [], None]
+        real_args = []
+        for a in args:
+            if isinstance(a, _RecordingProxy):
+                event[2].append((_OBJECT_MARKER, a._id))
+                real_args.append(a._obj)
+            else:
+                event[2].append(a)
+                real_args.append(a)
+        self.events.append(event)
+        ret = fn(*real_args)
+        if _is_plain(ret):
+            return ret
+        proxy = self.wrap(ret)
+        event[3] = proxy._id
+        return proxy
+
+
+class _RecordingProxy(object):
+
+    def __init__(self, drive, obj, obj_id):
+        self._drive = drive
+        self._obj = obj
+        self._id = obj_id
+
+    def __getattr__(self, name):
+        fn = getattr(self._obj, name)
+        if not callable(fn):
+            return fn
+        return lambda *args: self._drive.call(self._id, name, fn, args)
+
+    def __call__(self, *args):
+        return self._drive.call(self._id, "__call__", self._obj, args)
+
+
+class RaTraceWriter(object):
+    """Writes RA requests and responses to a trace file.
+
+    Records can be written from multiple threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._f = gzip.GzipFile(path, 'wb')
+        self._f.write(TRACE_HEADER)
+
+    def record(self, key, result, events):
+        try:
+            data = marshal.dumps((key, result, events))
+        except ValueError:
+            trace.mutter("unable to record response for %r", key)
+            return
+        with self._lock:
+            self._f.write(struct.pack(">L", len(data)))
+            self._f.write(data)
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+class RecordingRemoteAccess(object):
+    """RemoteAccess wrapper that records all requests to a trace."""
+
+    busy = property(lambda self: self.actual.busy)
+    url = property(lambda self: self.actual.url)
+
+    def __init__(self, actual, writer):
+        self.actual = actual
+        self.writer = writer
+        self._root_url = None
+
+    def get_repos_root(self):
+        if self._root_url is None:
+            self._root_url = self.actual.get_repos_root()
+        return self._root_url
+
+    def _request_key(self, name, args, kwargs):
+        root_url = self.get_repos_root()
+        relurl = self.actual.url[len(root_url):].strip("/")
+        return _request_key(name, relurl, args, kwargs, root_url)
+
+    def __getattr__(self, name):
+        fn = getattr(self.actual, name)
+        if name in UNRECORDED_METHODS or not callable(fn):
+            return fn
+        def wrapper(*args, **kwargs):
+            key = self._request_key(name, args, kwargs)
+            drive = _RecordingDrive()
+            args = drive.wrap_args(args)
+            if name in REPORTER_METHODS:
+                return _RecordingReporter(self.writer, key, drive,
+                                          fn(*args, **kwargs))
+            try:
+                ret = fn(*args, **kwargs)
+            except subvertpy.SubversionException as e:
+                self.writer.record(key, ("raise", e.args), drive.events)
+                raise
+            if name == "iter_log":
+                return self._record_iter(key, drive, ret)
+            self.writer.record(key, ("return", ret), drive.events)
+            return ret
+        return wrapper
+
+    def _record_iter(self, key, drive, iterator):
+        """Record the items of an iterator as they are consumed.
+
+        The response is written once the iterator is exhausted or
+        abandoned by the caller.
+        """
+        items = []
+        try:
+            for item in iterator:
+                items.append(item)
+                yield item
+        except subvertpy.SubversionException as e:
+            self.writer.record(key, ("raise", e.args), drive.events)
+            raise
+        except GeneratorExit:
+            self.writer.record(key, ("return", items), drive.events)
+            raise
+        self.writer.record(key, ("return", items), drive.events)
+
+
+class _RecordingReporter(object):
+    """Reporter wrapper that records the editor drive on finish."""
+
+    def __init__(self, writer, key, drive, actual):
+        self.writer = writer
+        self.key = key
+        self.drive = drive
+        self.actual = actual
+        self.calls = []
+
+    def _record_call(self, name, *args):
+        self.calls.append((name, _request_key(name, "", args, {}, "\0")[2]))
+        return getattr(self.actual, name)(*args)
+
+    def set_path(self, *args):
+        return self._record_call("set_path", *args)
+
+    def delete_path(self, *args):
+        return self._record_call("delete_path", *args)
+
+    def link_path(self, *args):
+        return self._record_call("link_path", *args)
+
+    def finish(self):
+        key = self.key + (tuple(self.calls), )
+        try:
+            ret = self.actual.finish()
+        except subvertpy.SubversionException as e:
+            self.writer.record(key, ("raise", e.args), self.drive.events)
+            raise
+        self.writer.record(key, ("return", ret), self.drive.events)
+        return ret
+
+    def abort(self):
+        return self.actual.abort()
+
+
+class RaTrace(object):
+    """Responses recorded in a trace file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.root_url = "%s://%s" % (REPLAY_SCHEME, path)
+        self._responses = {}
+        f = gzip.GzipFile(path, 'rb')
+        try:
+            if f.read(len(TRACE_HEADER)) != TRACE_HEADER:
+                raise errors.BzrError("%s is not a RA trace" % path)
+            while True:
+                header = f.read(4)
+                if not header:
+                    break
+                (size, ) = struct.unpack(">L", header)
+                (key, result, events) = marshal.loads(f.read(size))
+                self._responses.setdefault(key, []).append((result, events))
+        finally:
+            f.close()
+
+    def lookup(self, key):
+        """Find the response for a request.
+
+        Responses for requests that were made more than once are returned
+        in the order they were recorded; the last one is repeated after
+        that.
+        """
+        try:
+            responses = self._responses[key]
+        except KeyError:
+            raise ReplayMissingResponse(self.path, key)
+        if len(responses) > 1:
+            return responses.pop(0)
+        return responses[0]
+
+
+def _replay_events(events, objs):
+    """Replay the calls made on objects of the caller during a request.
+
+    :param events: Recorded events
+    :param objs: Dictionary mapping ids to the objects passed in by
+        the caller; extended with the objects created while replaying
+    """
+    for (obj_id, name, args, new_id) in events:
+        args = [objs[a[1]] if (isinstance(a, tuple) and len(a) == 2 and
+                               a[0] == _OBJECT_MARKER) else a
+                for a in args]
+        target = objs[obj_id]
+        if name == "__call__":
+            ret = target(*args)
+        else:
+            ret = getattr(target, name)(*args)
+        if new_id is not None:
+            objs[new_id] = ret
+
+
+class ReplayRemoteAccess(object):
+    """RemoteAccess implementation that serves requests from a trace."""
+
+    busy = False
+
+    def __init__(self, ratrace, url, latency=0):
+        self.ratrace = ratrace
+        self.url = url
+        self.latency = latency
+
+    def get_repos_root(self):
+        return self.ratrace.root_url
+
+    def reparent(self, url):
+        self.url = url
+
+    def get_commit_editor(self, *args, **kwargs):
+        raise errors.TransportNotPossible("replayed sessions are read-only")
+
+    def change_rev_prop(self, revnum, name, value):
+        raise errors.TransportNotPossible("replayed sessions are read-only")
+
+    def _request_key(self, name, args, kwargs):
+        root_url = self.ratrace.root_url
+        relurl = self.url[len(root_url):].strip("/")
+        return _request_key(name, relurl, args, kwargs, root_url)
+
+    def _replay(self, name, args, kwargs, key=None):
+        if key is None:
+            key = self._request_key(name, args, kwargs)
+        objs = {}
+        for a in args:
+            if not _is_plain(a):
+                objs[len(objs)] = a
+        if self.latency:
+            time.sleep(self.latency / 1000.0)
+        ((kind, value), events) = self.ratrace.lookup(key)
+        _replay_events(events, objs)
+        if kind == "raise":
+            raise subvertpy.SubversionException(*value)
+        if name == "iter_log":
+            return iter(value)
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        def wrapper(*args, **kwargs):
+            if name in REPORTER_METHODS:
+                return _ReplayReporter(self, name, args, kwargs)
+            return self._replay(name, args, kwargs)
+        return wrapper
+
+
+class _ReplayReporter(object):
+
+    def __init__(self, conn, name, args, kwargs):
+        self.conn = conn
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.calls = []
+
+    def _record_call(self, name, *args):
+        self.calls.append((name, _request_key(name, "", args, {}, "\0")[2]))
+
+    def set_path(self, *args):
+        self._record_call("set_path", *args)
+
+    def delete_path(self, *args):
+        self._record_call("delete_path", *args)
+
+    def link_path(self, *args):
+        self._record_call("link_path", *args)
+
+    def finish(self):
+        key = self.conn._request_key(self.name, self.args, self.kwargs)
+        return self.conn._replay(self.name, self.args, self.kwargs,
+                                 key + (tuple(self.calls), ))
+
+    def abort(self):
+        pass
+
+
+_writer = None
+_writer_checked = False
+def get_trace_writer():
+    """Return the trace writer for this process, if recording is enabled.
+
+    The svn-ra-trace option is only read the first time.
+
+    :return: RaTraceWriter, or None
+    """
+    global _writer, _writer_checked
+    if not _writer_checked:
+        _writer_checked = True
+        path = _mod_bzr_config.GlobalStack().get('svn-ra-trace')
+        if path:
+            _writer = RaTraceWriter(path)
+            atexit.register(_writer.close)
+            trace.note("Recording Subversion RA requests to %s.", path)
+    return _writer
+
+
+_traces = {}
+def open_replay_connection(url):
+    """Open a connection that replays a trace.
+
+    :param url: svn+replay URL, with the path of the trace file optionally
+        followed by a path inside the repository
+    :return: ReplayRemoteAccess
+    """
+    path = urlparse.urlsplit(url)[2]
+    trace_path = path
+    while not os.path.isfile(trace_path):
+        parent = os.path.dirname(trace_path)
+        if parent == trace_path:
+            raise errors.NoSuchFile(path)
+        trace_path = parent
+    try:
+        ratrace = _traces[trace_path]
+    except KeyError:
+        ratrace = _traces[trace_path] = RaTrace(trace_path)
+    latency = _mod_bzr_config.GlobalStack().get('svn-replay-latency')
+    return ReplayRemoteAccess(ratrace, url.rstrip("/"), latency)
@@ -17,6 +17,7 @@
 
 from __future__ import absolute_import
 
+from collections import deque
 from itertools import chain
 import subvertpy
 
@@ -431,6 +432,16 @@ class SvnRepository(ForeignRepository):
         else:
             self.revinfo_cache = None
 
+        if "ra" in use_cache:
+            self.svn_transport.set_response_cache(
+                self._cache_obj.open_ra_cache())
+
+        if "inventories" in use_cache:
+            self.inventory_cache = self._cache_obj.open_inventory_cache(
+                self.get_config_stack().get('svn-inventory-cache-size'))
+        else:
+            self.inventory_cache = None
+
         self._parents_provider = graph.CachingParentsProvider(
             self._real_parents_provider)
         self._parents_provider.disable_cache()
@@ -559,6 +570,7 @@ class SvnRepository(ForeignRepository):
         self._cached_revnum = None
         self._layout = None
         self._layout_source = None
+        self.revmap.flush()
         if self._cache_obj is not None:
             self._cache_obj.commit()
 
@@ -838,6 +850,26 @@ class SvnRepository(ForeignRepository):
     def get_fileid_map(self, revmeta, mapping):
         return self.fileid_map.get_map(revmeta.metarev.get_foreign_revid(), mapping)
 
+    def precompute_fileid_maps(self, layout=None, mapping=None):
+        """Make sure the file id maps for all branch tips are cached.
+
+        This can be run ahead of time, so that opening a revision tree
+        on any of the branches later doesn't have to build its file id map.
+
+        :param layout: Layout to use to find branches
+        :param mapping: Mapping to use
+        :return: Number of branches processed
+        """
+        with self.lock_read():
+            tips = []
+            for branch in self.find_branches(layout=layout, mapping=mapping):
+                revmeta, branch_mapping = branch.last_revmeta(skip_hidden=True)
+                if revmeta is not None:
+                    tips.append((revmeta.metarev.get_foreign_revid(),
+                                 branch_mapping))
+            self.fileid_map.precompute(tips)
+            return len(tips)
+
     def all_revision_ids(self, layout=None, mapping=None):
         """Find all revision ids in this repository, using the specified or
         default mapping.
@@ -928,19 +960,39 @@ class SvnRepository(ForeignRepository):
             return (kind == subvertpy.NODE_DIR)
 
     def iter_files_bytes(self, desired_files):
-        per_revision = {}
-        for (file_id, revision_id, identifier) in desired_files:
-            per_revision.setdefault(revision_id, []).append(
-                (file_id, identifier))
-        for revid, files in per_revision.iteritems():
-            try:
-                tree = self.revision_tree(revid)
-            except bzr_errors.NoSuchRevision:
-                raise bzr_errors.RevisionNotPresent(revid, self)
-            for identifier, curfile in tree.iter_files_bytes(
-                    [(tree.id2path(file_id), identifier)
-                        for (file_id, identifier) in files]):
-                yield identifier, curfile
+        # Map file ids to paths using just the file id maps, without
+        # building the inventories of the revisions involved
+        revisions = {}
+        identifiers = deque()
+        def iter_requests():
+            for (file_id, revision_id, identifier) in desired_files:
+                try:
+                    (revmeta, mapping, fileidmap) = revisions[revision_id]
+                except KeyError:
+                    try:
+                        revmeta, mapping = self._get_revmeta(revision_id)
+                    except bzr_errors.NoSuchRevision:
+                        raise bzr_errors.RevisionNotPresent(revision_id, self)
+                    fileidmap = self.get_fileid_map(revmeta, mapping)
+                    revisions[revision_id] = (revmeta, mapping, fileidmap)
+                try:
+                    path = fileidmap.reverse_lookup(mapping, file_id)
+                except KeyError:
+                    raise bzr_errors.NoSuchId(self, file_id)
+                identifiers.append(identifier)
+                # Paths aren't URL-escaped, so don't use urlutils.join
+                yield ((u"%s/%s" % (revmeta.metarev.branch_path, path)).strip(u"/"),
+                       revmeta.metarev.revnum)
+        for (path, revnum, props, stream) in self.svn_transport.iter_files(
+                iter_requests()):
+            identifier = identifiers.popleft()
+            if (subvertpy.properties.PROP_SPECIAL in props and
+                stream.read(5) == b"link "):
+                # Symlinks have no contents
+                yield identifier, (b"", )
+            else:
+                stream.seek(0)
+                yield identifier, (stream.read(), )
 
     def revision_trees(self, revids):
         """See Repository.revision_trees()."""
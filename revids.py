@@ -21,6 +21,7 @@ from __future__ import absolute_import
 import subvertpy
 
 from breezy import (
+    osutils,
     ui,
     )
 from breezy.errors import (
@@ -46,11 +47,85 @@ from breezy.plugins.svn.mapping import (
     )
 
 
+# Number of revision ids found while walking history to buffer before
+# writing them to the cache
+REVID_CACHE_BATCH_SIZE = 100
+# Minimum size in bits of the filter of known revision ids
+REVID_FILTER_MIN_BITS = 1 << 16
+# Size in bits per revision id of the filter of known revision ids
+REVID_FILTER_BITS_PER_ENTRY = 10
+# Number of hash functions used by the filter of known revision ids
+REVID_FILTER_HASHES = 7
+
+
+class RevidFilter(object):
+    """Bloom filter of revision ids.
+
+    Can tell with certainty that a revision id was never added.
+    """
+
+    __slots__ = ('_bits', '_num_hashes')
+
+    def __init__(self, bits=None, num_hashes=REVID_FILTER_HASHES):
+        if bits is None:
+            bits = bytearray(REVID_FILTER_MIN_BITS // 8)
+        self._bits = bits
+        self._num_hashes = num_hashes
+
+    @classmethod
+    def for_count(cls, count):
+        """Create a filter large enough for a number of revision ids."""
+        size = max(REVID_FILTER_MIN_BITS, count * REVID_FILTER_BITS_PER_ENTRY)
+        return cls(bytearray((size + 7) // 8))
+
+    def capacity(self):
+        """Return the number of revision ids the filter is sized for."""
+        return len(self._bits) * 8 // REVID_FILTER_BITS_PER_ENTRY
+
+    @classmethod
+    def from_bytes(cls, data):
+        (num_hashes, bits) = data.split(b"\n", 1)
+        return cls(bytearray(bits), int(num_hashes))
+
+    def as_bytes(self):
+        return b"%d\n%s" % (self._num_hashes, str(self._bits))
+
+    def _positions(self, revid):
+        digest = osutils.sha_string(revid)
+        size = len(self._bits) * 8
+        # Double hashing, using two halves of the sha1
+        h1 = int(digest[:20], 16)
+        h2 = int(digest[20:], 16)
+        for i in range(self._num_hashes):
+            yield (h1 + i * h2) % size
+
+    def add(self, revid):
+        for pos in self._positions(revid):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, revid):
+        for pos in self._positions(revid):
+            if not self._bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
 class RevidMap(object):
 
     def __init__(self, repos):
         self.repos = repos
 
+    def remember_revid(self, revid, foreign_revid, mapping):
+        """Record the location of a revision id found while walking history.
+
+        :param revid: Revision id
+        :param foreign_revid: Foreign revision id
+        :param mapping: Mapping the revision id was found with
+        """
+
+    def flush(self):
+        """Write any pending entries to the cache."""
+
     def get_branch_revnum(self, revid, layout, project=None):
         """Find the (branch, revnum) tuple for a revision id.
 
@@ -140,6 +215,110 @@ class RevidMap(object):
                     yield (entry_revid, revmeta.metarev.branch_path, 0,
                            revmeta.metarev.revnum, mapping)
 
+    def _get_branch_fileprops(self, branch_path, revnum):
+        """Retrieve the file properties set on a branch root.
+
+        :return: Dictionary with properties, empty if the branch root
+            does not exist in revnum
+        """
+        try:
+            return dict(self.repos.branchprop_list.get_properties(
+                branch_path, revnum).iteritems())
+        except subvertpy.SubversionException as e:
+            msg, num = e.args
+            if num in (subvertpy.ERR_FS_NOT_FOUND,
+                       subvertpy.ERR_FS_NOT_DIRECTORY):
+                return {}
+            raise
+
+    def _find_revid_fileprop_line(self, revid, fileprops):
+        """Find the revision id property line for a revision id.
+
+        :return: Tuple with property name and line, or None
+        """
+        for propname, propvalue in fileprops.iteritems():
+            if not propname.startswith(SVN_PROP_BZR_REVISION_ID):
+                continue
+            for line in propvalue.splitlines():
+                try:
+                    (entry_revno, entry_revid) = parse_revid_property(line)
+                except InvalidPropertyValue:
+                    continue
+                if entry_revid == revid:
+                    return (propname, line)
+        return None
+
+    def _check_revmeta_adds_revid(self, revmeta, revid):
+        """Check whether a revision added a revision id to the branch root.
+
+        :return: Mapping for the revision id, or None
+        """
+        for propname, (oldpropvalue, propvalue) in revmeta.get_changed_fileprops().iteritems():
+            if not propname.startswith(SVN_PROP_BZR_REVISION_ID):
+                continue
+            try:
+                new_lines = find_new_lines(oldpropvalue, propvalue)
+                if len(new_lines) != 1:
+                    continue
+            except ValueError:
+                # Don't warn about encountering an invalid property,
+                # that will already have happened earlier
+                continue
+            try:
+                (entry_revno, entry_revid) = parse_revid_property(
+                    new_lines[0])
+            except InvalidPropertyValue:
+                # Don't warn about encountering an invalid property,
+                # that will already have happened earlier
+                continue
+            if entry_revid == revid:
+                mapping_name = propname[len(SVN_PROP_BZR_REVISION_ID):]
+                mapping = mapping_registry.parse_mapping_name("svn-" + mapping_name)
+                assert mapping.is_branch_or_tag(revmeta.metarev.branch_path)
+                return mapping
+        return None
+
+    def _bisect_fileprop_revid_revnum_fast(self, revid, branch_path,
+                                           min_revnum, max_revnum):
+        """Binary search for the revision that added a revid to a branch.
+
+        Revision id properties are only ever appended to, so the first
+        revision whose branch root properties contain the line for revid
+        is the one that introduced it. This only works if the branch
+        lived at branch_path for the whole range; the result is checked
+        against the changed file properties of the revision found.
+
+        :return: Tuple with foreign revision id and mapping, or None
+        """
+        found = self._find_revid_fileprop_line(revid,
+            self._get_branch_fileprops(branch_path, max_revnum))
+        if found is None:
+            return None
+        (propname, line) = found
+        lo = min_revnum
+        hi = max_revnum
+        while lo < hi:
+            mid = (lo + hi) // 2
+            propvalue = self._get_branch_fileprops(
+                branch_path, mid).get(propname)
+            if propvalue is not None and line in propvalue.splitlines():
+                hi = mid
+            else:
+                lo = mid + 1
+        try:
+            revmeta = self.repos._revmeta_provider.get_revision(
+                branch_path, lo)
+            mapping = self._check_revmeta_adds_revid(revmeta, revid)
+        except subvertpy.SubversionException as e:
+            msg, num = e.args
+            if num in (subvertpy.ERR_FS_NOT_FOUND,
+                       subvertpy.ERR_FS_NOT_DIRECTORY):
+                return None
+            raise
+        if mapping is None:
+            return None
+        return (revmeta.metarev.get_foreign_revid(), mapping)
+
     def bisect_fileprop_revid_revnum(self, revid, branch_path, min_revnum, max_revnum):
         """Find out what the actual revnum was that corresponds to a revid.
 
@@ -150,33 +329,17 @@ class RevidMap(object):
         :return: Tuple with foreign revision id and mapping
         """
         assert min_revnum <= max_revnum
+        ret = self._bisect_fileprop_revid_revnum_fast(revid, branch_path,
+            min_revnum, max_revnum)
+        if ret is not None:
+            return ret
         # Find the branch property between min_revnum and max_revnum that
         # added revid
         for revmeta in self.repos._revmeta_provider.iter_reverse_branch_changes(
                 branch_path, max_revnum, min_revnum):
-            for propname, (oldpropvalue, propvalue) in revmeta.get_changed_fileprops().iteritems():
-                if not propname.startswith(SVN_PROP_BZR_REVISION_ID):
-                    continue
-                try:
-                    new_lines = find_new_lines(oldpropvalue, propvalue)
-                    if len(new_lines) != 1:
-                        continue
-                except ValueError:
-                    # Don't warn about encountering an invalid property,
-                    # that will already have happened earlier
-                    continue
-                try:
-                    (entry_revno, entry_revid) = parse_revid_property(
-                        new_lines[0])
-                except InvalidPropertyValue:
-                    # Don't warn about encountering an invalid property,
-                    # that will already have happened earlier
-                    continue
-                if entry_revid == revid:
-                    mapping_name = propname[len(SVN_PROP_BZR_REVISION_ID):]
-                    mapping = mapping_registry.parse_mapping_name("svn-" + mapping_name)
-                    assert mapping.is_branch_or_tag(revmeta.metarev.branch_path)
-                    return (revmeta.metarev.get_foreign_revid(), mapping)
+            mapping = self._check_revmeta_adds_revid(revmeta, revid)
+            if mapping is not None:
+                return (revmeta.metarev.get_foreign_revid(), mapping)
         raise InvalidBzrSvnRevision(revid)
 
 
@@ -210,6 +373,13 @@ class MemoryCachingRevidMap(object):
             self._cache[revid] = ret
             return ret
 
+    def remember_revid(self, revid, foreign_revid, mapping):
+        self._cache[revid] = (foreign_revid, mapping)
+        self._nonexistant.discard(revid)
+
+    def flush(self):
+        pass
+
 
 class DiskCachingRevidMap(object):
 
@@ -217,6 +387,95 @@ class DiskCachingRevidMap(object):
         self.cache = cache
         self.actual = actual
         self.revid_seen = set()
+        self._remembered = set()
+        self._pending = []
+        self._filters = {}
+
+    def _build_filter(self, count):
+        revid_filter = RevidFilter.for_count(count)
+        for revid in self.cache.iter_revids():
+            revid_filter.add(revid)
+        return revid_filter
+
+    def _get_filter(self, key):
+        """Return the filter of known revision ids for a layout.
+
+        The filter contains every revision id in the cache. A miss is
+        therefore definitive for the revisions up to the last revnum
+        checked for the layout, as their revision ids have all been
+        discovered.
+
+        :param key: Layout key, as used for the last revnum checked
+        :return: Tuple with the last revnum checked for the layout and the
+            filter
+        """
+        last_checked = self.cache.last_revnum_checked(key)
+        count = self.cache.count_revids()
+        try:
+            (revnum, filter_count, revid_filter) = self._filters[key]
+        except KeyError:
+            pass
+        else:
+            if (revnum, filter_count) == (last_checked, count):
+                return (revnum, revid_filter)
+        stored = self.cache.get_revid_filter(key)
+        if stored is not None and stored[:2] == (last_checked, count):
+            revid_filter = RevidFilter.from_bytes(stored[2])
+        else:
+            # The filter is missing or revision ids have been added since
+            # it was stored
+            revid_filter = self._build_filter(count)
+            self.cache.set_revid_filter(key, last_checked, count,
+                                        revid_filter.as_bytes())
+        self._filters[key] = (last_checked, count, revid_filter)
+        return (last_checked, revid_filter)
+
+    def _update_filters(self, count, revids, key=None, last_checked=None):
+        """Add revision ids inserted into the cache to the loaded filters.
+
+        :param count: Number of cache entries before the revision ids were
+            inserted
+        :param revids: Inserted revision ids
+        :param key: Layout for which the last revnum checked was updated
+        :param last_checked: New last revnum checked for key
+        """
+        new_count = self.cache.count_revids()
+        for (filter_key, (revnum, filter_count, revid_filter)) in (
+                self._filters.items()):
+            if (filter_count != count or
+                    new_count > revid_filter.capacity()):
+                # Another process has added revision ids or the filter is
+                # full; rebuild it when it is next used
+                del self._filters[filter_key]
+                continue
+            for revid in revids:
+                revid_filter.add(revid)
+            if filter_key == key:
+                revnum = last_checked
+            self._filters[filter_key] = (revnum, new_count, revid_filter)
+            self.cache.set_revid_filter(filter_key, revnum, new_count,
+                                        revid_filter.as_bytes())
+
+    def remember_revid(self, revid, foreign_revid, mapping):
+        (uuid, branch_path, revnum) = foreign_revid
+        entry = (revid, branch_path, revnum, mapping.name)
+        if entry in self._remembered:
+            return
+        self._remembered.add(entry)
+        self._pending.append(entry)
+        if len(self._pending) >= REVID_CACHE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        pending = self._pending
+        if not pending:
+            return
+        self._pending = []
+        count = self.cache.count_revids()
+        for (revid, branch_path, revnum, mapping_name) in pending:
+            self.cache.insert_revid(revid, branch_path, revnum, revnum,
+                                    mapping_name)
+        self._update_filters(count, [entry[0] for entry in pending])
 
     def remember_entry(self, entry_revid, branch, min_revnum, max_revnum,
                        mappingname):
@@ -232,8 +491,17 @@ class DiskCachingRevidMap(object):
         return self.actual.repos.get_latest_revnum()
 
     def get_branch_revnum(self, revid, layout, project=None):
+        self.flush()
+        key = repr((layout, project))
+        (filter_revnum, revid_filter) = self._get_filter(key)
+        last_revnum = None
         # Check the record out of the cache, if it exists
         try:
+            if revid not in revid_filter:
+                last_revnum = self._get_last_revnum()
+                if filter_revnum == last_revnum:
+                    # Not discovered in any revision of the layout
+                    raise NoSuchRevision(self, revid)
             (branch_path, min_revnum, max_revnum, \
                     mapping) = self.cache.lookup_revid(revid)
             assert isinstance(branch_path, text_type)
@@ -244,7 +512,8 @@ class DiskCachingRevidMap(object):
                 return ((self.actual.repos.uuid, branch_path, min_revnum),
                         mapping_registry.parse_mapping_name("svn-" + mapping))
         except NoSuchRevision as e:
-            last_revnum = self._get_last_revnum()
+            if last_revnum is None:
+                last_revnum = self._get_last_revnum()
             last_checked = self._get_last_checked(layout, project)
             if last_checked > last_revnum:
                 warn_uuid_reuse(self.actual.repos.uuid, self.actual.repos.base)
@@ -254,6 +523,8 @@ class DiskCachingRevidMap(object):
                 # check again.
                 raise e
             found = None
+            count = self.cache.count_revids()
+            discovered = []
             fileprops_to_revnum = last_revnum
             with ui.ui_factory.nested_progress_bar() as pb:
                 for entry_revid, branch, revnum, mapping in self.actual.discover_revprop_revids(
@@ -261,6 +532,7 @@ class DiskCachingRevidMap(object):
                     fileprops_to_revnum = min(fileprops_to_revnum, revnum)
                     if entry_revid == revid:
                         found = (branch, revnum, revnum, mapping)
+                    discovered.append(entry_revid)
                     self.remember_entry(entry_revid, branch, revnum,
                                             revnum, mapping.name)
 
@@ -271,13 +543,19 @@ class DiskCachingRevidMap(object):
                         min_revno = max(last_checked, min_revno)
                         if entry_revid == revid:
                             found = (branch, min_revno, max_revno, mapping)
+                        discovered.append(entry_revid)
                         self.remember_entry(entry_revid, branch, min_revno,
                                             max_revno, mapping.name)
 
             # We've added all the revision ids for this layout in the
             # repository, so no need to check again unless new revisions got
             # added
-            self.cache.set_last_revnum_checked(repr((layout, project)), last_revnum)
+            self.cache.set_last_revnum_checked(key, last_revnum)
+            if last_checked != filter_revnum:
+                # Another process has discovered revision ids since the
+                # filter was loaded
+                self._filters.pop(key, None)
+            self._update_filters(count, discovered, key, last_revnum)
             if found is None:
                 raise e
             (branch_path, min_revnum, max_revnum, mapping) = found
@@ -289,7 +567,9 @@ class DiskCachingRevidMap(object):
         ((uuid, branch_path, revnum), mapping) = self.actual.bisect_fileprop_revid_revnum(revid,
             branch_path, min_revnum, max_revnum)
         assert isinstance(branch_path, text_type)
+        count = self.cache.count_revids()
         self.remember_entry(revid, branch_path, revnum, revnum, mapping.name)
+        self._update_filters(count, [revid])
         return (uuid, branch_path, revnum), mapping
 
 
@@ -347,3 +627,34 @@ class RevisionIdMapCache(object):
                        was found
         """
         raise NotImplementedError(self.insert_revid)
+
+    def count_revids(self):
+        """Return the number of entries in the revision id cache.
+
+        :return: Number of entries; changes whenever a revision id is added
+        """
+        raise NotImplementedError(self.count_revids)
+
+    def iter_revids(self):
+        """Iterate over all revision ids in the cache."""
+        raise NotImplementedError(self.iter_revids)
+
+    def get_revid_filter(self, layout):
+        """Retrieve the stored filter of known revision ids of a layout.
+
+        :param layout: Layout key, as used for the last revnum checked
+        :return: Tuple with the last revnum checked and the number of
+            entries in the cache when the filter was stored, and the
+            serialized filter, or None
+        """
+        raise NotImplementedError(self.get_revid_filter)
+
+    def set_revid_filter(self, layout, revnum, count, data):
+        """Store the filter of known revision ids of a layout.
+
+        :param layout: Layout key, as used for the last revnum checked
+        :param revnum: Last revnum checked the filter was built for
+        :param count: Number of entries in the cache the filter covers
+        :param data: Serialized filter
+        """
+        raise NotImplementedError(self.set_revid_filter)
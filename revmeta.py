@@ -151,8 +151,13 @@ class BzrMetaRevision(object):
         else:
             revid = None
 
-        # Or generate it
-        if revid is None:
+        if revid is not None:
+            # Revision ids that can't be parsed can only be found by scanning
+            # the repository, so record where this one lives.
+            self.provider.repository.revmap.remember_revid(revid,
+                self.metarev.get_foreign_revid(), mapping)
+        else:
+            # Or generate it
             revid = mapping.revision_id_foreign_to_bzr(self.metarev.get_foreign_revid())
             if not isinstance(revid, bytes):
                 raise TypeError(
@@ -24,6 +24,7 @@ import subvertpy.tests
 
 from breezy import osutils
 from breezy.config import GlobalStack
+from breezy.errors import NoSuchRevision
 from breezy.controldir import (
     ControlDir,
     )
@@ -39,6 +40,8 @@ from breezy.plugins.svn import (
     config,
     transport as _mod_svn_transport,
     )
+from breezy.plugins.svn.fileids import DictFileIdMap
+from breezy.plugins.svn.mapping import mapping_registry
 
 from subvertpy.ra import RemoteAccess
 
@@ -151,6 +154,86 @@ class RecordingRemoteAccess(object):
         return self.actual.replay(revision, low_water_mark, editor, send_deltas)
 
 
+class DummyMetaRevision(object):
+    """Meta revision for a fixed foreign revision id."""
+
+    def __init__(self, uuid, branch_path, revnum):
+        self.uuid = uuid
+        self.branch_path = branch_path
+        self.revnum = revnum
+
+    def get_foreign_revid(self):
+        return (self.uuid, self.branch_path, self.revnum)
+
+
+class DummyRevisionMetadata(object):
+    """Revision metadata with fixed parents.
+
+    The revision id is derived from the meta revision unless one is
+    specified.
+    """
+
+    def __init__(self, metarev=None, revid=None, parent_ids=(),
+                 text_parents={}):
+        self.metarev = metarev
+        self._revid = revid
+        self._parent_ids = parent_ids
+        self._text_parents = text_parents
+
+    def get_revision_id(self, mapping):
+        if self._revid is not None:
+            return self._revid
+        return mapping.revision_id_foreign_to_bzr(
+            self.metarev.get_foreign_revid())
+
+    def get_lhs_parent_revmeta(self, mapping):
+        return None
+
+    def get_parent_ids(self, mapping, parentrevmeta):
+        return self._parent_ids
+
+    def get_text_parents(self, mapping):
+        return self._text_parents
+
+
+class DummyRepository(object):
+    """Repository that only knows about revisions added to it.
+
+    Looking up revisions and file id maps is recorded, so tests can check
+    what was retrieved.
+    """
+
+    def __init__(self, revids=()):
+        self.mapping = mapping_registry.get_default()()
+        self.revids = set(revids)
+        self.revmetas = {}
+        self.fileid_maps = {}
+        self.checked = []
+        self.fileid_map_loads = []
+
+    def add_revision(self, revid, parent_ids, fileid_map, text_parents={}):
+        self.revids.add(revid)
+        self.revmetas[revid] = DummyRevisionMetadata(revid=revid,
+            parent_ids=parent_ids, text_parents=text_parents)
+        self.fileid_maps[revid] = DictFileIdMap(fileid_map)
+
+    def has_revisions(self, revids):
+        self.checked.extend(revids)
+        return self.revids.intersection(revids)
+
+    def _get_revmeta(self, revid):
+        try:
+            return self.revmetas[revid], self.mapping
+        except KeyError:
+            raise NoSuchRevision(self, revid)
+
+    def get_fileid_map(self, revmeta, mapping):
+        revid = revmeta.get_revision_id(mapping)
+        if self.revmetas.get(revid) is not revmeta:
+            raise AssertionError("unknown revmeta %r" % revmeta)
+        self.fileid_map_loads.append(revid)
+        return self.fileid_maps[revid]
+
 
 class SubversionTestCase(subvertpy.tests.SubversionTestCase,TestCaseInTempDir):
 
@@ -244,6 +327,7 @@ def test_suite():
             'test_convert',
             'test_errors',
             'test_fetch',
+            'test_filegraph',
             'test_fileids',
             'test_keywords',
             'layout.test_guess',
@@ -253,6 +337,7 @@ def test_suite():
             'test_metagraph',
             'test_parents',
             'test_push',
+            'test_ratrace',
             'test_remote',
             'test_repository',
             'test_revmeta',
@@ -53,6 +53,9 @@ from breezy.plugins.svn.mapping3.scheme import (
     ListBranchingScheme,
     NoBranchingScheme,
     )
+from breezy.plugins.svn.revids import (
+    RevidMap,
+    )
 from breezy.plugins.svn.tests import (
     SubversionTestCase,
     )
@@ -256,6 +259,66 @@ class RepositoryTests(SubversionTestCase):
         self.assertEqual(((repository.uuid, u"", 1), mapping),
                 repository.lookup_bzr_revision_id("myid")[:2])
 
+    def commit_overridden_revids(self):
+        value = ""
+        for i in range(5):
+            dc = self.get_commit_editor(self.repos_url)
+            dc.add_dir("bloe%d" % i)
+            value += "%d myid%d\n" % (i + 2, i)
+            dc.change_prop(SVN_PROP_BZR_REVISION_ID+"v3-none", value)
+            dc.close()
+
+    def track_revid_bisect(self):
+        bisected = []
+        checked = []
+        orig_bisect = RevidMap._bisect_fileprop_revid_revnum_fast
+        orig_check = RevidMap._check_revmeta_adds_revid
+        def bisect(revidmap, *args):
+            ret = orig_bisect(revidmap, *args)
+            bisected.append(ret)
+            return ret
+        def check(revidmap, revmeta, revid):
+            checked.append(revmeta.metarev.revnum)
+            return orig_check(revidmap, revmeta, revid)
+        self.overrideAttr(RevidMap, "_bisect_fileprop_revid_revnum_fast",
+            bisect)
+        self.overrideAttr(RevidMap, "_check_revmeta_adds_revid", check)
+        return (bisected, checked)
+
+    def test_lookup_revision_id_overridden_older(self):
+        self.commit_overridden_revids()
+        (bisected, checked) = self.track_revid_bisect()
+        repository = Repository.open(self.repos_url)
+        mapping = repository.get_mapping()
+        self.assertEqual(((repository.uuid, u"", 2), mapping),
+                repository.lookup_bzr_revision_id("myid1")[:2])
+        self.assertEqual(((repository.uuid, u"", 4), mapping),
+                repository.lookup_bzr_revision_id("myid3")[:2])
+        # Both were found by bisecting; the linear scan would have
+        # checked more than one revision per lookup.
+        self.assertEqual(
+            [(repository.uuid, u"", 2), (repository.uuid, u"", 4)],
+            [ret[0] for ret in bisected])
+        self.assertEqual([2, 4], checked)
+
+    def test_lookup_revision_id_overridden_older_bisect_fails(self):
+        self.commit_overridden_revids()
+        (bisected, checked) = self.track_revid_bisect()
+        # Pretend the property already had its final value in every
+        # revision, so the bisect ends up at a revision that did not
+        # add the revision id.
+        orig_fileprops = RevidMap._get_branch_fileprops
+        self.overrideAttr(RevidMap, "_get_branch_fileprops",
+            lambda revidmap, branch_path, revnum: orig_fileprops(
+                revidmap, branch_path, 5))
+        repository = Repository.open(self.repos_url)
+        mapping = repository.get_mapping()
+        self.assertEqual(((repository.uuid, u"", 4), mapping),
+                repository.lookup_bzr_revision_id("myid3")[:2])
+        self.assertEqual([None], bisected)
+        # The linear scan walks back from the newest revision.
+        self.assertEqual([5, 4], checked[-2:])
+
     def test_lookup_revision_id_overridden_invalid(self):
         dc = self.get_commit_editor(self.repos_url)
         dc.add_dir("bloe")
@@ -627,6 +627,23 @@ if len(sys.argv) == 2:
             'tags/release-1.0 (release-1.0)\n',
             self.run_bzr('svn-branches --layout trunk %s' % svn_url)[0])
 
+    def test_svn_precompute_fileids(self):
+        svn_url = self.make_repository('d')
+
+        dc = self.get_commit_editor(svn_url)
+        dc.add_dir("trunk")
+        dc.close()
+
+        dc = self.get_commit_editor(svn_url)
+        branches = dc.add_dir("branches")
+        branches.add_dir("branches/somebranch", "trunk")
+        dc.close()
+
+        self.assertEquals(
+            'Precomputed file id maps for 2 branches.\n',
+            self.run_bzr('svn-precompute-fileids --layout trunk %s' %
+                         svn_url)[0])
+
     def test_diff(self):
         self.make_svn_branch_and_tree('d', 'dc')
         self.build_tree_contents([("dc/file", "bar")])
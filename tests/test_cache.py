@@ -147,6 +147,26 @@ class RevidMapCacheTests(object):
         self.assertEquals(None,
                 self.cache.lookup_branch_revnum(42, u"mypath", "brainslug"))
 
+    def test_count_revids(self):
+        self.assertEquals(0, self.cache.count_revids())
+        self.cache.insert_revid("bla", u"mypath", 42, 42, "brainslug")
+        count = self.cache.count_revids()
+        self.assertNotEquals(0, count)
+        self.cache.insert_revid("blie", u"mypath", 43, 43, "brainslug")
+        self.assertNotEquals(count, self.cache.count_revids())
+
+    def test_iter_revids(self):
+        self.cache.insert_revid("bla", u"mypath", 42, 42, "brainslug")
+        self.cache.insert_revid("blie", u"mypath", 43, 43, "brainslug")
+        self.assertEquals(set(["bla", "blie"]), set(self.cache.iter_revids()))
+
+    def test_revid_filter(self):
+        self.assertIs(None, self.cache.get_revid_filter("layout"))
+        self.cache.set_revid_filter("layout", 42, 3, "\x00\xff\n data")
+        self.assertEquals((42, 3, "\x00\xff\n data"),
+                          self.cache.get_revid_filter("layout"))
+        self.assertIs(None, self.cache.get_revid_filter("other"))
+
 
 class SqliteRevidMapCacheTests(TestCase,RevidMapCacheTests):
 
@@ -166,6 +186,177 @@ class TdbRevidMapCacheTests(TestCaseInTempDir,RevidMapCacheTests):
         self.cache = TdbRevisionIdMapCache(tdb_open("cache.tdb", 0, tdb.DEFAULT, os.O_RDWR|os.O_CREAT))
 
 
+class RemoteAccessCacheTests(object):
+
+    def test_lookup_nonexistant(self):
+        self.assertRaises(KeyError, self.cache.lookup, "get_dir", u"trunk",
+                          1, "0")
+
+    def test_insert(self):
+        self.cache.insert("get_dir", u"trunk", 1, "0", "\x00data")
+        self.assertEquals("\x00data",
+            self.cache.lookup("get_dir", u"trunk", 1, "0"))
+        self.assertRaises(KeyError, self.cache.lookup, "get_dir", u"trunk",
+                          1, "1")
+        self.assertRaises(KeyError, self.cache.lookup, "get_dir", u"trunk",
+                          2, "0")
+
+    def test_ambiguous_fields(self):
+        self.cache.insert("get_locations", u"3 foo", 1, "1 2", "a")
+        self.cache.insert("get_locations", u"foo", 1, "1 2 3", "b")
+        self.assertEquals("a",
+            self.cache.lookup("get_locations", u"3 foo", 1, "1 2"))
+        self.assertEquals("b",
+            self.cache.lookup("get_locations", u"foo", 1, "1 2 3"))
+
+    def test_replace_size(self):
+        self.cache.max_size = 10
+        for i in range(5):
+            self.cache.insert("check_path", u"trunk", 1, "", "12345")
+        self.assertEquals("12345",
+            self.cache.lookup("check_path", u"trunk", 1, ""))
+
+    def test_evict(self):
+        self.cache.max_size = 10
+        self.cache.insert("check_path", u"trunk", 1, "", "12345")
+        self.cache.insert("check_path", u"trunk", 2, "", "12345")
+        self.cache.insert("check_path", u"trunk", 3, "", "12345")
+        self.assertRaises(KeyError, self.cache.lookup, "check_path",
+                          u"trunk", 1, "")
+        self.assertEquals("12345",
+            self.cache.lookup("check_path", u"trunk", 3, ""))
+
+
+class SqliteRemoteAccessCacheTests(TestCase,RemoteAccessCacheTests):
+
+    def setUp(self):
+        super(SqliteRemoteAccessCacheTests, self).setUp()
+        from breezy.plugins.svn.cache.sqlitecache import SqliteRemoteAccessCache
+        self.cache = SqliteRemoteAccessCache()
+
+
+class TdbRemoteAccessCacheTests(TestCaseInTempDir,RemoteAccessCacheTests):
+
+    def setUp(self):
+        super(TdbRemoteAccessCacheTests, self).setUp()
+        self.requireFeature(tdb_feature)
+        from breezy.plugins.svn.cache.tdbcache import TdbRemoteAccessCache, tdb_open
+        import tdb
+        self.cache = TdbRemoteAccessCache(tdb_open("cache.tdb", 0, tdb.DEFAULT, os.O_RDWR|os.O_CREAT))
+
+
+class DummyRepository(object):
+
+    uuid = "myuuid"
+
+    def get_latest_revnum(self):
+        return 42
+
+
+class DummyRevidMap(object):
+
+    def __init__(self):
+        self.repos = DummyRepository()
+        self.discovered = []
+
+    def discover_revprop_revids(self, from_revnum, to_revnum, pb=None):
+        self.discovered.append((from_revnum, to_revnum))
+        return iter([])
+
+    def discover_fileprop_revids(self, layout, from_revnum, to_revnum,
+                                 project=None, pb=None):
+        return iter([])
+
+
+class DiskCachingRevidMapTests(TestCase):
+
+    def setUp(self):
+        super(DiskCachingRevidMapTests, self).setUp()
+        from breezy.plugins.svn.cache.sqlitecache import SqliteRevisionIdMapCache
+        from breezy.plugins.svn.revids import DiskCachingRevidMap
+        self.cache = SqliteRevisionIdMapCache()
+        self.revmap = DiskCachingRevidMap(DummyRevidMap(), self.cache)
+
+    def test_remember_revid(self):
+        mapping = BzrSvnMappingv4()
+        self.revmap.remember_revid("bla", ("myuuid", u"trunk", 42), mapping)
+        self.assertEquals(
+            (("myuuid", u"trunk", 42), mapping),
+            self.revmap.get_branch_revnum("bla", None))
+        self.assertEquals(0, self.cache.last_revnum_checked(repr((None, None))))
+
+    def test_flush(self):
+        mapping = BzrSvnMappingv4()
+        self.revmap.remember_revid("bla", ("myuuid", u"trunk", 42), mapping)
+        self.assertRaises(NoSuchRevision, self.cache.lookup_revid, "bla")
+        self.revmap.flush()
+        self.assertEquals((u"trunk", 42, 42, "v4"),
+                          self.cache.lookup_revid("bla"))
+
+    def test_filter_miss(self):
+        self.cache.set_last_revnum_checked(repr((None, None)), 42)
+        self.assertRaises(NoSuchRevision,
+                          self.revmap.get_branch_revnum, "bla", None)
+        self.assertEquals((42, 0),
+            self.cache.get_revid_filter(repr((None, None)))[:2])
+        # A miss is answered by the filter alone
+        self.overrideAttr(self.cache, "lookup_revid", None)
+        self.assertRaises(NoSuchRevision,
+                          self.revmap.get_branch_revnum, "bla", None)
+        self.assertEquals([], self.revmap.actual.discovered)
+
+    def test_filter_miss_new_revisions(self):
+        self.cache.set_last_revnum_checked(repr((None, None)), 40)
+        self.assertRaises(NoSuchRevision,
+                          self.revmap.get_branch_revnum, "bla", None)
+        # Revisions after the last one checked are scanned
+        self.assertEquals([(42, 40)], self.revmap.actual.discovered)
+        self.assertEquals(42,
+            self.cache.get_revid_filter(repr((None, None)))[0])
+
+    def test_filter_stale(self):
+        from breezy.plugins.svn.revids import DiskCachingRevidMap
+        self.cache.set_last_revnum_checked(repr((None, None)), 42)
+        self.assertRaises(NoSuchRevision,
+                          self.revmap.get_branch_revnum, "bla", None)
+        # Another process adds the revision id
+        other = DiskCachingRevidMap(DummyRevidMap(), self.cache)
+        mapping = BzrSvnMappingv4()
+        other.remember_revid("bla", ("myuuid", u"trunk", 42), mapping)
+        other.flush()
+        self.assertEquals(
+            (("myuuid", u"trunk", 42), mapping),
+            self.revmap.get_branch_revnum("bla", None))
+
+
+class RevidFilterTests(TestCase):
+
+    def test_empty(self):
+        from breezy.plugins.svn.revids import RevidFilter
+        self.assertFalse("bla" in RevidFilter())
+
+    def test_add(self):
+        from breezy.plugins.svn.revids import RevidFilter
+        f = RevidFilter()
+        f.add("bla")
+        self.assertTrue("bla" in f)
+        self.assertFalse("blie" in f)
+
+    def test_for_count(self):
+        from breezy.plugins.svn.revids import RevidFilter
+        self.assertTrue(RevidFilter.for_count(1000000).capacity() >= 1000000)
+        self.assertEquals(RevidFilter().capacity(),
+                          RevidFilter.for_count(0).capacity())
+
+    def test_roundtrip(self):
+        from breezy.plugins.svn.revids import RevidFilter
+        f = RevidFilter()
+        f.add("bla")
+        f = RevidFilter.from_bytes(f.as_bytes())
+        self.assertTrue("bla" in f)
+        self.assertFalse("blie" in f)
+
+
 class RevInfoCacheTests(object):
 
     def test_get_unknown_revision(self):
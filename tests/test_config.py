@@ -175,6 +175,10 @@ class ReposConfigTests(SubversionTestCase):
         self.assertEquals(set(["log", "revids", "fileids", "revinfo"]), c.get_use_cache())
         c.set_user_option("use-cache", ["log", "revids"])
         self.assertEquals(set(["log", "revids"]), c.get_use_cache())
+        c.set_user_option("use-cache", ["revids", "ra"])
+        self.assertEquals(set(["revids", "ra"]), c.get_use_cache())
+        c.set_user_option("use-cache", ["revids", "inventories"])
+        self.assertEquals(set(["revids", "inventories"]), c.get_use_cache())
         c.set_user_option("use-cache", "False")
         self.assertEquals(set([]), c.get_use_cache())
 
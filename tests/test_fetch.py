@@ -18,12 +18,17 @@
 
 """Subversion fetch tests."""
 
+from cStringIO import StringIO
+import json
 import os
 import shutil
 import sys
 
 from subvertpy import NODE_DIR, NODE_FILE
 
+from breezy import (
+    debug,
+    )
 from breezy.branch import (
     Branch,
     )
@@ -42,6 +47,7 @@ from breezy.revision import (
 from breezy.tests import (
     KnownFailure,
     TestCase,
+    TestCaseWithMemoryTransport,
     TestSkipped,
     )
 from breezy.tests.features import (
@@ -52,6 +58,7 @@ from breezy.trace import (
     )
 
 from breezy.plugins.svn import (
+    fetch,
     remote,
     )
 from breezy.plugins.svn.convert import (
@@ -62,7 +69,10 @@ from breezy.plugins.svn.errors import (
     SymlinkTargetContainsNewline,
     )
 from breezy.plugins.svn.fetch import (
+   FetchJournal,
+   FetchProfile,
    FetchRevisionFinder,
+   LazyHistory,
    InterFromSvnToInventoryRepository,
    check_filename,
    chunks_start_with_link,
@@ -75,7 +85,13 @@ from breezy.plugins.svn.mapping import (
     SVN_REVPROP_BZR_MAPPING_VERSION,
     SVN_REVPROP_BZR_ROOT,
     )
+from breezy.plugins.svn.mapping4 import (
+    BzrSvnMappingv4,
+    )
 from breezy.plugins.svn.tests import (
+    DummyMetaRevision,
+    DummyRepository,
+    DummyRevisionMetadata,
     SubversionTestCase,
     )
 from breezy.plugins.svn.transport import (
@@ -220,6 +236,71 @@ class TestFetchWorks(FetchTestCase):
         newrepos = dir.create_repository()
         self.copy_content(oldrepos, newrepos)
 
+    def test_fetch_resumes_from_journal(self):
+        repos_url = self.make_svn_repository('d')
+        dc = self.get_commit_editor(repos_url)
+        dc.add_file("foo").modify("data 0")
+        dc.close()
+        for i in range(1, 5):
+            dc = self.get_commit_editor(repos_url)
+            dc.open_file("foo").modify("data %d" % i)
+            dc.close()
+        oldrepos = Repository.open(repos_url)
+        newrepos = ControlDir.create("f").create_repository()
+        self.overrideAttr(fetch, "FETCH_BATCH_SIZE", 2)
+        # Interrupt the fetch once the first batch has been committed
+        class Interrupted(Exception):
+            pass
+        orig_set_committed = FetchJournal.set_committed
+        def set_committed(journal, committed):
+            orig_set_committed(journal, committed)
+            raise Interrupted()
+        self.overrideAttr(FetchJournal, "set_committed", set_committed)
+        self.assertRaises(Interrupted, self.fetch, oldrepos, newrepos)
+        self.assertEquals(2, len(newrepos.all_revision_ids()))
+        self.overrideAttr(FetchJournal, "set_committed", orig_set_committed)
+        # The second fetch picks up the rest without rediscovering revisions
+        inter = self.get_inter(oldrepos, newrepos)
+        def get_needed(*args, **kwargs):
+            self.fail("revision discovery was not skipped")
+        inter._get_needed = get_needed
+        inter.fetch()
+        self.assertEquals(set(oldrepos.all_revision_ids()),
+                          set(newrepos.all_revision_ids()))
+        # The journal is removed once the fetch has finished
+        self.assertIs(None, inter._open_journal().load(
+            oldrepos.get_latest_revnum()))
+
+    def test_fetch_profile_phases_add_up(self):
+        repos_url = self.make_svn_repository('d')
+        dc = self.get_commit_editor(repos_url)
+        dc.add_file("foo").modify("data 0")
+        dc.close()
+        for i in range(1, 3):
+            dc = self.get_commit_editor(repos_url)
+            dc.open_file("foo").modify("data %d" % i)
+            dc.close()
+        oldrepos = Repository.open(repos_url)
+        newrepos = ControlDir.create("f").create_repository()
+        self.overrideAttr(debug, "debug_flags",
+                          set(debug.debug_flags) | set(["svn-fetch-profile"]))
+        profiles = []
+        inter = self.get_inter(oldrepos, newrepos)
+        inter._write_profile = profiles.append
+        inter.fetch()
+        phases = profiles[0].as_dict()["phases"]
+        for phase in phases.values():
+            self.assertTrue(phase["seconds"] >= 0)
+        # The phases within revisions add up to the time spent on them
+        revision_phases = set(phases) - set(["discovery", "commit", "pack"])
+        self.assertTrue("editor-drive" in revision_phases)
+        self.assertTrue("parent-trees" in revision_phases)
+        self.assertAlmostEqual(
+            sum(elapsed for (elapsed, foreign_revid) in
+                profiles[0].slowest_revisions()),
+            sum(phases[phase]["seconds"] for phase in revision_phases),
+            places=3)
+
     def test_fetch_special_char(self):
         repos_url = self.make_svn_repository('d')
 
@@ -537,6 +618,37 @@ class TestFetchWorks(FetchTestCase):
         newrepos = dir.create_repository()
         self.copy_content(oldrepos, newrepos)
 
+    def test_fetch_copy_modify_shared_text(self):
+        repos_url = self.make_svn_repository('d')
+
+        dc = self.get_commit_editor(repos_url)
+        trunk = dc.add_dir("trunk")
+        trunk.add_file("trunk/a").modify("data\n")
+        trunk.add_file("trunk/b").modify("data\n")
+        dc.close()
+
+        dc = self.get_commit_editor(repos_url)
+        branches = dc.add_dir("branches")
+        branches.add_dir("branches/foo", "trunk")
+        dc.close()
+
+        dc = self.get_commit_editor(repos_url)
+        branches = dc.open_dir("branches")
+        foo = branches.open_dir("branches/foo")
+        foo.open_file("branches/foo/b").modify("data\nmore data\n")
+        dc.close()
+
+        oldrepos = Repository.open(repos_url)
+        oldrepos.set_layout(TrunkLayout(0))
+        dir = ControlDir.create("f")
+        newrepos = dir.create_repository()
+        self.copy_content(oldrepos, newrepos)
+        mapping = oldrepos.get_mapping()
+        tree = newrepos.revision_tree(
+            oldrepos.generate_revision_id(3, u"branches/foo", mapping))
+        self.assertEquals("data\n", tree.get_file_text("a"))
+        self.assertEquals("data\nmore data\n", tree.get_file_text("b"))
+
     def test_fetch_replace_nordic(self):
         filename = os.path.join(self.test_dir, "dumpfile")
         open(filename, 'w').write("""SVN-fs-dump-format-version: 2
@@ -2309,3 +2421,145 @@ class TestCheckFilename(TestCase):
 
     def test_backspace(self):
         self.assertRaises(InvalidFileName, check_filename, u"foo\\bar")
+
+
+class FetchJournalTests(TestCaseWithMemoryTransport):
+
+    def setUp(self):
+        super(FetchJournalTests, self).setUp()
+        self.journal = FetchJournal(self.get_transport(), "journal")
+        self.mapping = BzrSvnMappingv4()
+        self.needed = [
+            (DummyRevisionMetadata(DummyMetaRevision("uuid", u"trunk", 1)),
+             self.mapping),
+            (DummyRevisionMetadata(DummyMetaRevision("uuid", u"trunk", 3)),
+             self.mapping)]
+
+    def test_nonexistent(self):
+        self.assertIs(None, self.journal.load(42))
+
+    def revid(self, foreign_revid):
+        return self.mapping.revision_id_foreign_to_bzr(foreign_revid)
+
+    def test_roundtrip(self):
+        self.journal.save(42, self.needed)
+        self.assertEquals(
+            [(("uuid", u"trunk", 1), self.mapping,
+              self.revid(("uuid", u"trunk", 1))),
+             (("uuid", u"trunk", 3), self.mapping,
+              self.revid(("uuid", u"trunk", 3)))],
+            self.journal.load(42))
+
+    def test_committed(self):
+        self.journal.save(42, self.needed)
+        self.journal.set_committed(1)
+        self.assertEquals([(("uuid", u"trunk", 3), self.mapping,
+                            self.revid(("uuid", u"trunk", 3)))],
+            self.journal.load(42))
+
+    def test_committed_does_not_rewrite_list(self):
+        self.journal.save(42, self.needed)
+        text = self.journal.transport.get_bytes("journal")
+        self.journal.set_committed(2)
+        self.assertEquals(text, self.journal.transport.get_bytes("journal"))
+        self.assertEquals([], self.journal.load(42))
+
+    def test_revnum_changed(self):
+        self.journal.save(42, self.needed)
+        self.assertIs(None, self.journal.load(43))
+
+    def test_remove(self):
+        self.journal.save(42, self.needed)
+        self.journal.remove()
+        self.assertIs(None, self.journal.load(42))
+        self.journal.remove()
+
+
+class LazyHistoryTests(TestCase):
+
+    def test_lazy(self):
+        consumed = []
+        def gen():
+            for i in range(10):
+                consumed.append(i)
+                yield i
+        history = LazyHistory(gen())
+        self.assertEquals(2, history[2])
+        self.assertEquals([0, 1, 2], consumed)
+        self.assertEquals([0, 1], history[:2])
+        self.assertEquals([0, 1, 2], history.materialized())
+        self.assertTrue(history.has_index(9))
+        self.assertFalse(history.has_index(10))
+        self.assertEquals(10, len(history))
+
+
+class FindFirstPresentTests(TestCase):
+
+    def make_history(self, count):
+        return LazyHistory(iter(
+            [(DummyRevisionMetadata(revid="rev%d" % i), None)
+             for i in reversed(range(count))]))
+
+    def test_none_present(self):
+        target = DummyRepository([])
+        finder = FetchRevisionFinder(None, target)
+        self.assertEquals(10, finder._find_first_present(self.make_history(10)))
+
+    def test_all_present(self):
+        target = DummyRepository(["rev%d" % i for i in range(10)])
+        finder = FetchRevisionFinder(None, target)
+        self.assertEquals(0, finder._find_first_present(self.make_history(10)))
+        self.assertEquals(["rev9"], target.checked)
+
+    def test_few_missing(self):
+        target = DummyRepository(["rev%d" % i for i in range(9995)])
+        finder = FetchRevisionFinder(None, target)
+        self.assertEquals(5,
+            finder._find_first_present(self.make_history(10000)))
+        self.assertTrue(len(target.checked) < 10)
+
+
+class FetchProfileTests(TestCase):
+
+    def test_phases(self):
+        profile = FetchProfile()
+        profile.add("textdelta", 0.5, 100)
+        profile.add("textdelta", 0.25, 20)
+        profile.add("inventory", 1.0)
+        self.assertEquals({
+            "textdelta": {"seconds": 0.75, "calls": 2, "bytes": 120},
+            "inventory": {"seconds": 1.0, "calls": 1, "bytes": 0}},
+            profile.as_dict()["phases"])
+
+    def test_outer_phase(self):
+        profile = FetchProfile()
+        recorded_before = profile.recorded
+        profile.add("textdelta", 0.5, 100)
+        profile.add("inventory", 1.0)
+        profile.add_outer("editor-drive", 2.0, recorded_before)
+        self.assertEquals(
+            {"seconds": 0.5, "calls": 1, "bytes": 0},
+            profile.as_dict()["phases"]["editor-drive"])
+        self.assertEquals(2.0, profile.recorded)
+
+    def test_slowest_revisions(self):
+        profile = FetchProfile(slowest_count=2)
+        profile.add_revision(("uuid", u"trunk", 1), 0.1)
+        profile.add_revision(("uuid", u"trunk", 2), 3.0)
+        profile.add_revision(("uuid", u"trunk", 3), 2.0)
+        self.assertEquals([
+            (3.0, ("uuid", u"trunk", 2)),
+            (2.0, ("uuid", u"trunk", 3))],
+            profile.slowest_revisions())
+
+    def test_write(self):
+        profile = FetchProfile()
+        profile.add("commit", 2.0)
+        profile.add_revision(("uuid", u"trunk", 1), 0.5)
+        f = StringIO()
+        profile.write(f)
+        self.assertEquals({
+            "phases": {"commit": {"seconds": 2.0, "calls": 1, "bytes": 0}},
+            "slowest_revisions": [{"uuid": "uuid", "branch_path": "trunk",
+                                   "revnum": 1, "seconds": 0.5}]},
+            json.loads(f.getvalue()))
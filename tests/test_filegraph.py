@@ -0,0 +1,75 @@
+# Copyright (C) 2005-2009 Jelmer Vernooij <jelmer@samba.org>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-file graph tests."""
+
+from breezy.revision import NULL_REVISION
+from breezy.tests import TestCase
+
+from breezy.plugins.svn import filegraph
+from breezy.plugins.svn.filegraph import PerFileParentProvider
+from breezy.plugins.svn.tests import DummyRepository
+
+
+class PerFileParentProviderTests(TestCase):
+
+    def setUp(self):
+        super(PerFileParentProviderTests, self).setUp()
+        self.repository = DummyRepository()
+        self.repository.add_revision("rev1", (NULL_REVISION,), {
+            u"": ("rootid", "rev1", None),
+            u"foo": ("fooid", "rev1", None),
+            u"bar": ("barid", "rev1", None)})
+        self.repository.add_revision("rev2", ("rev1",), {
+            u"": ("rootid", "rev1", None),
+            u"foo": ("fooid", "rev2", None),
+            u"bar": ("barid", "rev1", None)})
+        self.provider = PerFileParentProvider(self.repository)
+
+    def test_null(self):
+        self.assertEquals({NULL_REVISION: (), ("fooid", NULL_REVISION): None},
+            self.provider.get_parent_map([NULL_REVISION,
+                                          ("fooid", NULL_REVISION)]))
+
+    def test_parents(self):
+        self.assertEquals({
+            ("fooid", "rev2"): (("fooid", "rev1"),),
+            ("barid", "rev2"): (("barid", "rev1"),),
+            ("fooid", "rev1"): (),
+            ("unknownid", "rev2"): None,
+            ("fooid", "unknownrev"): None},
+            self.provider.get_parent_map([("fooid", "rev2"),
+                ("barid", "rev2"), ("fooid", "rev1"), ("unknownid", "rev2"),
+                ("fooid", "unknownrev")]))
+
+    def test_text_parents(self):
+        self.repository.add_revision("rev3", ("rev2",), {
+            u"": ("rootid", "rev1", None),
+            u"foo": ("fooid", "rev3", None)},
+            {u"foo": ("rev1", )})
+        self.assertEquals({("fooid", "rev3"): (("fooid", "rev1"),)},
+            self.provider.get_parent_map([("fooid", "rev3")]))
+
+    def test_loads_maps_once(self):
+        self.provider.get_parent_map([("fooid", "rev2"), ("barid", "rev2")])
+        self.provider.get_parent_map([("fooid", "rev1"), ("rootid", "rev2")])
+        self.assertEquals(["rev1", "rev2"],
+                          sorted(self.repository.fileid_map_loads))
+
+    def test_bounded_fileid_maps(self):
+        self.overrideAttr(filegraph, "FILEIDMAP_CACHE_SIZE", 1)
+        provider = PerFileParentProvider(self.repository)
+        provider.get_parent_map([("fooid", "rev2"), ("fooid", "rev1")])
+        self.assertTrue(len(provider._fileidmaps) <= 1)
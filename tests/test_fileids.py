@@ -27,7 +27,13 @@ from breezy.tests import (
 from breezy.workingtree import WorkingTree
 
 from breezy.plugins.svn.fileids import (
+    FILEIDMAP_LEAF_SIZE,
+    FILEID_MAP_MIN_SAVE_INTERVAL,
+    FILEID_MAP_SAVE_INTERVAL,
+    CachingFileIdMapStore,
+    DictFileIdMap,
     FileIdMapCache,
+    fileid_map_checkpoint_interval,
     get_local_changes,
     idmap_lookup,
     idmap_reverse_lookup,
@@ -40,7 +46,12 @@ from breezy.plugins.svn.layout.standard import (
     RootLayout,
     TrunkLayout,
     )
-from breezy.plugins.svn.tests import SubversionTestCase
+from breezy.plugins.svn.tests import (
+    DummyMetaRevision,
+    DummyRepository,
+    DummyRevisionMetadata,
+    SubversionTestCase,
+    )
 
 class MockRepo(object):
 
@@ -530,6 +541,135 @@ class FileIdMapCacheTests(TestCaseWithMemoryTransport):
         self.cache.save("bla", [], data)
         self.assertEquals(data, self.cache.load("bla"))
 
+    def make_large_map(self, revid):
+        return dict((u"dir/file%d" % i, ("fileid%d" % i, revid, None))
+                    for i in range(FILEIDMAP_LEAF_SIZE * 4))
+
+    def test_large(self):
+        data = self.make_large_map("myrev")
+        self.cache.save("bla", [], data)
+        self.assertEquals(data, self.cache.load("bla"))
+
+    def test_load_map_lookup(self):
+        data = self.make_large_map("myrev")
+        self.cache.save("bla", [], data)
+        idmap = self.cache.load_map("bla")
+        mapping = mapping_registry.get_default()()
+        self.assertEquals(("fileid42", "myrev", None),
+                          idmap.lookup(mapping, u"dir/file42"))
+        self.assertRaises(KeyError, idmap.lookup, mapping, u"dir/nonexistent")
+        self.assertEquals(u"dir/file42",
+                          idmap.reverse_lookup(mapping, "fileid42"))
+        self.assertRaises(KeyError, idmap.reverse_lookup, mapping, "otherid")
+        self.assertTrue(idmap.has_fileid("fileid42"))
+        self.assertFalse(idmap.has_fileid("otherid"))
+
+    def test_load_map_reverse_lookup_parsed(self):
+        mapping = mapping_registry.get_default()()
+        fileid = mapping.generate_file_id(("myuuid", u"trunk", 3), u"dir/file")
+        data = {u"": ("rootid", "myrev", None),
+                u"dir/file": (fileid, "myrev", None)}
+        self.cache.save("bla", [], data)
+        idmap = self.cache.load_map("bla")
+        self.assertEquals(u"dir/file", idmap.reverse_lookup(mapping, fileid))
+
+    def test_load_map_reverse_lookup_scans_nodes(self):
+        data = self.make_large_map("myrev")
+        data[u"dir/afile2"] = ("fileid2", "myrev", None)
+        self.cache.save("bla", [], data)
+        idmap = self.cache.load_map("bla")
+        mapping = mapping_registry.get_default()()
+        nodes_read = []
+        orig_get_node = FileIdMapCache._get_node
+        def get_node(cache, key):
+            nodes_read.append(key)
+            return orig_get_node(cache, key)
+        self.overrideAttr(FileIdMapCache, "_get_node", get_node)
+        self.assertEquals(u"dir/file1",
+                          idmap.reverse_lookup(mapping, "fileid1"))
+        # The lowest path wins
+        self.assertEquals(u"dir/afile2",
+                          idmap.reverse_lookup(mapping, "fileid2"))
+        # No copy of the map is kept; every lookup walks the trie
+        del nodes_read[:]
+        self.assertTrue(idmap.has_fileid("fileid3"))
+        self.assertNotEquals([], nodes_read)
+        self.assertFalse(idmap.has_fileid("otherid"))
+
+    def test_shares_unchanged_nodes(self):
+        data = self.make_large_map("myrev")
+        self.cache.save("bla1", [], data)
+        nodes = len(self.cache.node_knit.keys())
+        data[u"dir/file42"] = ("fileid42", "mynewrev", None)
+        self.cache.save("bla2", ["bla1"], data)
+        # Only the leaf containing the changed path and its ancestors
+        # should have been added
+        self.assertTrue(len(self.cache.node_knit.keys()) - nodes <= 3)
+        self.assertEquals(data, self.cache.load("bla2"))
+
+
+class DummyRevisionMetadataProvider(object):
+
+    def __init__(self, history):
+        self.history = history
+
+    def _iter_reverse_revmeta_mapping_history(self, branch, revnum, to_revnum,
+                                              mapping):
+        for (bp, rev) in reversed(self.history[branch]):
+            if rev <= revnum:
+                revid = b"%s:%d" % (bp.encode("utf-8"), rev)
+                yield (DummyRevisionMetadata(
+                    DummyMetaRevision("uuid", bp, rev), revid=revid),
+                    False, mapping)
+
+
+class DummyFileIdMapStore(object):
+
+    def __init__(self, history):
+        self.repos = DummyRepository()
+        self.repos._revmeta_provider = DummyRevisionMetadataProvider(history)
+        self.get_idmap_delta = None
+        self.replayed = []
+
+    def update_idmap(self, map, revmeta, mapping):
+        revid = revmeta.get_revision_id(mapping)
+        self.replayed.append(revid)
+        map.as_dict()[u"file%d" % revmeta.metarev.revnum] = (
+            "fileid%d" % revmeta.metarev.revnum, revid, None)
+
+
+class CachingFileIdMapStoreTests(TestCaseWithMemoryTransport):
+
+    def setUp(self):
+        super(CachingFileIdMapStoreTests, self).setUp()
+        self.mapping = mapping_registry.get_default()()
+        trunk = [(u"trunk", i) for i in range(1, 6)]
+        self.actual = DummyFileIdMapStore({
+            u"trunk": trunk,
+            u"branches/a": trunk[:3] + [(u"branches/a", 6)],
+            u"branches/b": trunk[:3] + [(u"branches/b", 7)]})
+        self.cache = FileIdMapCache(self.get_transport())
+        self.store = CachingFileIdMapStore(self.cache, self.actual)
+
+    def test_saves_target(self):
+        idmap = self.store.get_map(("uuid", u"trunk", 5), self.mapping)
+        self.assertEquals(idmap.as_dict(), self.cache.load("trunk:5"))
+        self.assertEquals(idmap.as_dict(),
+            self.store.get_map(("uuid", u"trunk", 5), self.mapping).as_dict())
+        self.assertEquals(5, len(self.actual.replayed))
+
+    def test_reuses_copy_source(self):
+        self.store.get_map(("uuid", u"branches/a", 6), self.mapping)
+        self.assertEquals(["trunk:1", "trunk:2", "trunk:3", "branches/a:6"],
+                          self.actual.replayed)
+        # The map of the revision branches/a was copied from was saved
+        self.cache.load("trunk:3")
+        del self.actual.replayed[:]
+        idmap = self.store.get_map(("uuid", u"branches/b", 7), self.mapping)
+        self.assertEquals(["branches/b:7"], self.actual.replayed)
+        self.assertEquals(set([u"file1", u"file2", u"file3", u"file7"]),
+                          set(idmap.as_dict().keys()))
+
 
 class LookupTests(TestCase):
 
@@ -559,31 +699,100 @@ class LookupTests(TestCase):
 
 class ReverseLookupTests(TestCase):
 
+    def test_lowest_path(self):
+        idmap = {"b": ("myfileid", "myrev", None),
+                 "a": ("myfileid", "myrev", None)}
+        mapping = mapping_registry.get_default()()
+        self.assertEquals("a", idmap_reverse_lookup(idmap.iteritems(),
+                          mapping, "myfileid"))
+
     def test_simple(self):
         idmap = {"filename": ("myfileid", "myrev", None)}
         mapping = mapping_registry.get_default()()
-        self.assertEquals("filename", idmap_reverse_lookup(idmap, mapping, "myfileid"))
+        self.assertEquals("filename", idmap_reverse_lookup(idmap.iteritems(), mapping, "myfileid"))
 
     def test_nonexistant(self):
         idmap = {}
         mapping = mapping_registry.get_default()()
-        self.assertRaises(KeyError, idmap_reverse_lookup, idmap, mapping, "myfileid")
+        self.assertRaises(KeyError, idmap_reverse_lookup, idmap.iteritems(),
+                          mapping, "myfileid")
 
     def test_implicit(self):
         idmap = {"parent": ("parentfileid", "parentrev", ("someuuid", u"somebp", 42))}
         mapping = mapping_registry.get_default()()
         self.assertEquals(u"parent/foo",
-                          idmap_reverse_lookup(idmap, mapping,
+                          idmap_reverse_lookup(idmap.iteritems(), mapping,
                           mapping.generate_file_id(("someuuid", u"somebp", 42), u"parent/foo")))
 
     def test_not_implicit(self):
         idmap = {"parent": ("parentfileid", "parentrev", None)}
         mapping = mapping_registry.get_default()()
         self.assertRaises(KeyError,
-                          idmap_reverse_lookup, idmap, mapping,
+                          idmap_reverse_lookup, idmap.iteritems(), mapping,
                           mapping.generate_file_id(("someuuid", u"somebp", 42), u"parent/foo"))
 
 
+class DictFileIdMapTests(TestCase):
+
+    def setUp(self):
+        super(DictFileIdMapTests, self).setUp()
+        self.mapping = mapping_registry.get_default()()
+
+    def test_reverse_lookup(self):
+        idmap = DictFileIdMap({u"": ("rootid", "rev1", None),
+                               u"foo": ("fooid", "rev1", None)})
+        self.assertEquals(u"foo", idmap.reverse_lookup(self.mapping, "fooid"))
+        self.assertRaises(KeyError, idmap.reverse_lookup, self.mapping,
+                          "barid")
+
+    def test_reverse_lookup_implicit(self):
+        idmap = DictFileIdMap({u"": ("rootid", "rev1", None),
+            u"parent": ("parentfileid", "parentrev", ("someuuid", u"somebp", 42))})
+        fileid = self.mapping.generate_file_id(("someuuid", u"somebp", 42),
+                                               u"parent/foo")
+        self.assertEquals(u"parent/foo",
+                          idmap.reverse_lookup(self.mapping, fileid))
+
+    def test_has_fileid(self):
+        idmap = DictFileIdMap({u"": ("rootid", "rev1", None),
+                               u"foo": ("fooid", "rev1", None)})
+        self.assertTrue(idmap.has_fileid("fooid"))
+        self.assertFalse(idmap.has_fileid("barid"))
+
+    def test_apply_delta_updates_index(self):
+        idmap = DictFileIdMap({u"": ("rootid", "rev1", None),
+                               u"foo": ("fooid", "rev1", None)})
+        self.assertEquals(u"foo", idmap.reverse_lookup(self.mapping, "fooid"))
+        idmap.apply_delta({}, {u"bar": "fooid"},
+            {u"foo": ('D', None), u"bar": ('A', (u"foo", 1))}, "rev2",
+            self.mapping, ("someuuid", u"", 2))
+        self.assertEquals(u"bar", idmap.reverse_lookup(self.mapping, "fooid"))
+        fileid = self.mapping.generate_file_id(("someuuid", u"", 2),
+                                               u"bar/blie")
+        self.assertEquals(u"bar/blie",
+                          idmap.reverse_lookup(self.mapping, fileid))
+        idmap.apply_delta({}, {}, {u"bar": ('D', None)}, "rev3",
+            self.mapping, ("someuuid", u"", 3))
+        self.assertFalse(idmap.has_fileid("fooid"))
+        self.assertRaises(KeyError, idmap.reverse_lookup, self.mapping,
+                          fileid)
+
+
+class CheckpointIntervalTests(TestCase):
+
+    def test_small_map(self):
+        self.assertEquals(FILEID_MAP_MIN_SAVE_INTERVAL,
+                          fileid_map_checkpoint_interval(1))
+
+    def test_large_map(self):
+        self.assertEquals(FILEID_MAP_SAVE_INTERVAL,
+                          fileid_map_checkpoint_interval(10 ** 9))
+
+    def test_grows_with_size(self):
+        self.assertTrue(fileid_map_checkpoint_interval(10000) <
+                        fileid_map_checkpoint_interval(50000))
+
+
 class LocalChangesTests(TestCase):
 
     def _generate_revid(self, revnum, path):
@@ -0,0 +1,196 @@
+# Copyright (C) 2005-2009 Jelmer Vernooij <jelmer@samba.org>
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""RA trace recording and replaying tests."""
+
+import os
+import threading
+
+import subvertpy
+
+from breezy.tests import TestCaseInTempDir
+from breezy.transport import get_transport_from_url
+
+from breezy.plugins.svn.ratrace import (
+    RaTrace,
+    RaTraceWriter,
+    RecordingRemoteAccess,
+    ReplayMissingResponse,
+    ReplayRemoteAccess,
+    open_replay_connection,
+    )
+from breezy.plugins.svn.transport import SvnRaTransport
+
+
+class DummyRemoteAccess(object):
+
+    busy = False
+
+    def __init__(self):
+        self.url = "svn://example.com/repo/trunk"
+        self.log_yielded = []
+
+    def get_repos_root(self):
+        return "svn://example.com/repo"
+
+    def check_path(self, path, revnum):
+        if path == "missing":
+            raise subvertpy.SubversionException("Not found", 160013)
+        return subvertpy.NODE_DIR
+
+    def get_log(self, callback, paths, from_revnum, to_revnum, limit):
+        for revnum in range(from_revnum, to_revnum - 1, -1):
+            callback({"/trunk": ("M", None, -1)}, revnum,
+                     {"svn:log": "r%d" % revnum})
+
+    def iter_log(self, paths, from_revnum, to_revnum, limit, **kwargs):
+        for revnum in range(from_revnum, to_revnum - 1, -1):
+            self.log_yielded.append(revnum)
+            yield ({"/trunk": ("M", None, -1)}, revnum,
+                   {"svn:log": "r%d" % revnum})
+
+    def replay(self, revision, low_water_mark, editor, send_deltas=True):
+        root = editor.open_root(revision - 1)
+        f = root.add_file("trunk/foo", None, -1)
+        handler = f.apply_textdelta(None)
+        handler((0, 0, 4, 0, [(2, 0, 4)], "data"))
+        handler(None)
+        f.close()
+        root.close()
+        editor.close()
+
+
+class LoggingEditor(object):
+
+    def __init__(self, log):
+        self.log = log
+
+    def open_root(self, base_revnum):
+        self.log.append(("open-root", base_revnum))
+        return self
+
+    def add_file(self, path, copyfrom_path, copyfrom_rev):
+        self.log.append(("add-file", path))
+        return self
+
+    def apply_textdelta(self, base_checksum):
+        def handler(window):
+            self.log.append(("window", window))
+        return handler
+
+    def close(self):
+        self.log.append(("close", ))
+
+
+def iter_log(conn):
+    return conn.iter_log(None, 2, 1, 0, discover_changed_paths=True,
+        strict_node_history=False, include_merged_revisions=False,
+        revprops=["svn:log"])
+
+
+class RecordReplayTests(TestCaseInTempDir):
+
+    def record(self):
+        writer = RaTraceWriter("ra.trace")
+        conn = RecordingRemoteAccess(DummyRemoteAccess(), writer)
+        list(iter_log(conn))
+        self.assertEquals(subvertpy.NODE_DIR, conn.check_path("", 1))
+        self.assertRaises(subvertpy.SubversionException, conn.check_path,
+                          "missing", 1)
+        log = []
+        conn.get_log(lambda *args: log.append(args), ["trunk"], 2, 1, 0)
+        editor_log = []
+        conn.replay(1, 0, LoggingEditor(editor_log))
+        writer.close()
+        return log, editor_log
+
+    def replay_connection(self, relpath=""):
+        return open_replay_connection("svn+replay://%s/%s" % (
+            os.path.abspath("ra.trace"), relpath))
+
+    def test_check_path(self):
+        self.record()
+        conn = self.replay_connection("trunk")
+        self.assertEquals(subvertpy.NODE_DIR, conn.check_path("", 1))
+        self.assertRaises(subvertpy.SubversionException, conn.check_path,
+                          "missing", 1)
+        self.assertRaises(ReplayMissingResponse, conn.check_path, "", 2)
+
+    def test_reparent(self):
+        self.record()
+        conn = self.replay_connection()
+        self.assertRaises(ReplayMissingResponse, conn.check_path, "", 1)
+        conn.reparent(conn.get_repos_root() + "/trunk")
+        self.assertEquals(subvertpy.NODE_DIR, conn.check_path("", 1))
+
+    def test_get_log(self):
+        (expected, _) = self.record()
+        conn = self.replay_connection("trunk")
+        log = []
+        conn.get_log(lambda *args: log.append(args), ["trunk"], 2, 1, 0)
+        self.assertEquals(expected, log)
+
+    def test_iter_log(self):
+        writer = RaTraceWriter("ra.trace")
+        actual = DummyRemoteAccess()
+        conn = RecordingRemoteAccess(actual, writer)
+        log = iter_log(conn)
+        self.assertEquals([], actual.log_yielded)
+        expected = [next(log)]
+        self.assertEquals([2], actual.log_yielded)
+        expected.extend(log)
+        self.assertEquals([2, 1], actual.log_yielded)
+        writer.close()
+        conn = self.replay_connection("trunk")
+        self.assertEquals(expected, list(iter_log(conn)))
+
+    def test_transport(self):
+        self.record()
+        t = get_transport_from_url("svn+replay://%s/trunk" %
+            os.path.abspath("ra.trace"))
+        self.assertIsInstance(t, SvnRaTransport)
+        self.assertEquals(subvertpy.NODE_DIR, t.check_path("", 1))
+        self.assertEquals([2, 1], [revnum for (paths, revnum, revprops) in
+            t.iter_log(None, 2, 1, 0, True, False, False, ["svn:log"])])
+
+    def test_replay(self):
+        (_, expected) = self.record()
+        conn = self.replay_connection("trunk")
+        log = []
+        conn.replay(1, 0, LoggingEditor(log))
+        self.assertEquals(expected, log)
+
+    def test_latency(self):
+        self.record()
+        conn = ReplayRemoteAccess(RaTrace(os.path.abspath("ra.trace")),
+            "svn+replay://%s/trunk" % os.path.abspath("ra.trace"), 1)
+        self.assertEquals(subvertpy.NODE_DIR, conn.check_path("", 1))
+
+    def test_record_from_threads(self):
+        writer = RaTraceWriter("ra.trace")
+        def record(thread):
+            for i in range(200):
+                writer.record(("check_path", thread, i), ("return", i), [])
+        threads = [threading.Thread(target=record, args=(t, ))
+                   for t in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()
+        ratrace = RaTrace("ra.trace")
+        self.assertEquals((("return", 199), []),
+                          ratrace.lookup(("check_path", 3, 199)))
@@ -131,6 +131,18 @@ class TestSubversionRepositoryWorks(SubversionTestCase):
 
         self.assertFalse(repos.seen_bzr_revprops())
 
+    def test_iter_files_bytes_special_names(self):
+        dc = self.get_commit_editor(self.repos_url)
+        d = dc.add_dir("a dir")
+        d.add_file("a dir/100%25 file:1").modify("data")
+        dc.close()
+
+        repos = Repository.open(self.repos_url)
+        revid = Branch.open(self.repos_url).last_revision()
+        fileid = repos.revision_tree(revid).path2id(u"a dir/100%25 file:1")
+        self.assertEquals([("myfile", ("data", ))],
+            list(repos.iter_files_bytes([(fileid, revid, "myfile")])))
+
 
 class SvnRepositoryFormatTests(TestCase):
 
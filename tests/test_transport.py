@@ -19,6 +19,7 @@
 import stat
 import subvertpy
 from subvertpy import ra
+import threading
 from unittest import TestCase
 import urlparse
 
@@ -31,10 +32,16 @@ from breezy.errors import (
 
 from breezy.plugins.svn.tests import SubversionTestCase
 from breezy.plugins.svn.transport import (
+    CONNECTION_HEALTH_CHECK_AGE,
     Connection,
+    ConnectionPool,
+    InstrumentedRemoteAccess,
+    RemoteAccessCache,
+    RemoteAccessStats,
     SvnRaTransport,
     bzr_to_svn_url,
     url_join_unescaped_path,
+    _ra_subsystem,
     _url_escape_uri,
     _url_unescape_uri,
     )
@@ -229,6 +236,105 @@ class SvnRaTest(SubversionTestCase):
         self.assertEquals(urlutils.join(self.test_dir, "a"), t.local_abspath('.'))
 
 
+class DictRemoteAccessCache(RemoteAccessCache):
+
+    def __init__(self):
+        self.entries = {}
+
+    def lookup(self, kind, path, revnum, extra):
+        return self.entries[kind, path, revnum, extra]
+
+    def insert(self, kind, path, revnum, extra, value):
+        self.entries[kind, path, revnum, extra] = value
+
+
+class ResponseCacheTests(SubversionTestCase):
+
+    def setUp(self):
+        super(ResponseCacheTests, self).setUp()
+        self.repos_url = self.make_svn_repository('a')
+        dc = self.get_commit_editor(self.repos_url)
+        trunk = dc.add_dir("trunk")
+        trunk.add_file("trunk/foo").modify()
+        dc.close()
+        self.cache = DictRemoteAccessCache()
+        self.transport = SvnRaTransport(self.repos_url)
+        self.transport.set_response_cache(self.cache)
+
+    def test_check_path(self):
+        t = self.transport.clone("trunk")
+        self.assertEquals(subvertpy.NODE_FILE, t.check_path("foo", 1))
+        self.assertEquals([("check_path", u"trunk/foo", 1, "")],
+                          self.cache.entries.keys())
+        self.assertEquals(subvertpy.NODE_FILE, t.check_path("foo", 1))
+
+    def test_get_dir(self):
+        (dirents, fetched_rev, props) = self.transport.get_dir("trunk", 1)
+        self.assertEquals(["foo"], dirents.keys())
+        self.assertEquals((dirents, fetched_rev, props),
+                          self.transport.get_dir("trunk", 1))
+        self.assertEquals([("get_dir", u"trunk", 1, "0")],
+                          self.cache.entries.keys())
+
+    def test_head_not_cached(self):
+        self.transport.check_path("trunk", -1)
+        self.transport.get_dir("trunk", -1)
+        self.assertEquals({}, self.cache.entries)
+
+
+class IterFilesTests(SubversionTestCase):
+
+    def setUp(self):
+        super(IterFilesTests, self).setUp()
+        self.repos_url = self.make_svn_repository('a')
+        dc = self.get_commit_editor(self.repos_url)
+        trunk = dc.add_dir("trunk")
+        for i in range(10):
+            trunk.add_file("trunk/file%d" % i).modify("contents %d" % i)
+        dc.close()
+        dc = self.get_commit_editor(self.repos_url)
+        trunk = dc.open_dir("trunk")
+        trunk.open_file("trunk/file3").modify("new contents")
+        dc.close()
+        self.transport = SvnRaTransport(self.repos_url)
+
+    def test_order(self):
+        requests = [("trunk/file%d" % i, 1) for i in range(10)]
+        requests.append(("trunk/file3", 2))
+        result = list(self.transport.iter_files(requests))
+        self.assertEquals(requests,
+            [(path, revnum) for (path, revnum, props, stream) in result])
+        self.assertEquals(
+            ["contents %d" % i for i in range(10)] + ["new contents"],
+            [stream.read() for (path, revnum, props, stream) in result])
+
+    def test_serial(self):
+        self.assertEquals(["contents 1", "contents 2"],
+            [stream.read() for (path, revnum, props, stream) in
+                self.transport.iter_files(
+                    [("trunk/file1", 1), ("trunk/file2", 1)],
+                    concurrency=1)])
+
+    def test_single_file_single_connection(self):
+        conns = []
+        orig_get_connection = self.transport.get_connection
+        def get_connection(*args, **kwargs):
+            conn = orig_get_connection(*args, **kwargs)
+            conns.append(conn)
+            return conn
+        self.overrideAttr(self.transport, "get_connection", get_connection)
+        self.assertEquals(["contents 1"],
+            [stream.read() for (path, revnum, props, stream) in
+                self.transport.iter_files([("trunk/file1", 1)])])
+        self.assertEquals(1, len(conns))
+
+    def test_missing(self):
+        files = self.transport.iter_files(
+            [("trunk/file1", 1), ("trunk/nonexistent", 1)])
+        self.assertEquals("contents 1", files.next()[3].read())
+        self.assertRaises(subvertpy.SubversionException, files.next)
+
+
 class UrlConversionTest(TestCase):
 
     def test_bzr_to_svn_url(self):
@@ -301,3 +407,169 @@ class ReadonlyConnectionTests(SubversionTestCase):
         self.assertRaises(TransportNotPossible, conn.get_commit_editor,
                 { "svn:log": "msg" } )
         self.assertRemoteAccessCalls([])
+
+
+class DummyConnection(object):
+
+    busy = False
+
+    def __init__(self, url, healthy=True):
+        self.url = url
+        self.healthy = healthy
+
+    def reparent(self, url):
+        self.url = url
+
+    def get_latest_revnum(self):
+        if not self.healthy:
+            raise subvertpy.SubversionException("Connection closed", 0)
+        return 42
+
+
+class DummyConnectionPool(ConnectionPool):
+
+    def __init__(self, *args, **kwargs):
+        super(DummyConnectionPool, self).__init__(*args, **kwargs)
+        self.now = 0
+
+    def _now(self):
+        return self.now
+
+    def _connect(self, url):
+        self.stats["created"] += 1
+        return DummyConnection(url)
+
+
+class ConnectionPoolTests(TestCase):
+
+    def setUp(self):
+        super(ConnectionPoolTests, self).setUp()
+        self.pool = DummyConnectionPool(u"svn://example.com/repo",
+                                        max_size=2, idle_timeout=300)
+
+    def test_get_reuses(self):
+        c = self.pool.get(u"svn://example.com/repo")
+        self.pool.add(c)
+        self.assertIs(c, self.pool.get(u"svn://example.com/repo"))
+        self.assertEquals(1, self.pool.stats["created"])
+        self.assertEquals(1, self.pool.stats["reused"])
+
+    def test_get_reparents(self):
+        c = self.pool.get(u"svn://example.com/repo")
+        self.pool.add(c)
+        self.assertIs(c, self.pool.get(u"svn://example.com/repo/trunk"))
+        self.assertEquals(u"svn://example.com/repo/trunk", c.url)
+        self.assertEquals(1, self.pool.stats["reparented"])
+
+    def test_get_parent(self):
+        c = self.pool.get(u"svn://example.com/repo")
+        self.pool.add(c)
+        self.assertEquals((c, u"trunk/foo"),
+            self.pool.get_parent(u"svn://example.com/repo/trunk/foo"))
+        self.assertEquals(0, self.pool.stats["reparented"])
+
+    def test_evicts_oldest(self):
+        conns = [DummyConnection(u"svn://example.com/repo/%d" % i)
+                 for i in range(3)]
+        for c in conns:
+            self.pool.add(c)
+        self.assertEquals(1, self.pool.stats["evicted"])
+        self.assertEquals(conns[1:], list(self.pool.connections))
+
+    def test_idle_timeout(self):
+        c = DummyConnection(u"svn://example.com/repo")
+        self.pool.add(c)
+        self.pool.now = 301
+        self.assertIsNot(c, self.pool.get(u"svn://example.com/repo"))
+        self.assertEquals(1, self.pool.stats["expired"])
+
+    def test_health_check(self):
+        c = DummyConnection(u"svn://example.com/repo", healthy=False)
+        self.pool.add(c)
+        self.pool.now = CONNECTION_HEALTH_CHECK_AGE + 1
+        self.assertIsNot(c, self.pool.get(u"svn://example.com/repo"))
+        self.assertEquals(1, self.pool.stats["expired"])
+
+
+class RemoteAccessStatsTests(TestCase):
+
+    def test_add(self):
+        stats = RemoteAccessStats(buckets=[1, 10])
+        stats.add("tags", "check_path", 0.0005)
+        stats.add("tags", "check_path", 0.005, 20)
+        stats.add("tags", "check_path", 1)
+        self.assertEquals({"tags": {"check_path": {
+            "calls": 3, "bytes": 20,
+            "latency_ms": {"<=1": 1, "<=10": 1, ">10": 1}}}},
+            stats.as_dict())
+
+
+class DummyProgress(object):
+
+    transferred = 0
+
+
+class InstrumentedRemoteAccessTests(TestCase):
+
+    def test_check_path(self):
+        progress = DummyProgress()
+        class Actual(object):
+            url = "svn://example.com/repo"
+            def check_path(self, path, revnum):
+                progress.transferred += 10
+                return subvertpy.NODE_DIR
+        stats = RemoteAccessStats()
+        conn = InstrumentedRemoteAccess(Actual(), stats, progress)
+        self.assertEquals(subvertpy.NODE_DIR, conn.check_path("trunk", 1))
+        self.assertEquals("svn://example.com/repo", conn.url)
+        self.assertEquals(1, stats.calls["other", "check_path"])
+        self.assertEquals(10, stats.bytes["other", "check_path"])
+
+    def test_worker_subsystem(self):
+        class Actual(object):
+            def check_path(self, path, revnum):
+                return subvertpy.NODE_DIR
+        stats = RemoteAccessStats()
+        conn = InstrumentedRemoteAccess(Actual(), stats)
+        def worker():
+            _ra_subsystem.name = "repository"
+            conn.check_path("trunk", 1)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self.assertEquals(1, stats.calls["repository", "check_path"])
+
+    def test_do_update_recorded_on_finish(self):
+        progress = DummyProgress()
+        class Reporter(object):
+            def set_path(self, *args):
+                pass
+            def finish(self):
+                progress.transferred += 100
+        class Actual(object):
+            def do_update(self, revnum, path, start_empty, editor):
+                return Reporter()
+        stats = RemoteAccessStats()
+        conn = InstrumentedRemoteAccess(Actual(), stats, progress)
+        reporter = conn.do_update(1, "", True, None)
+        reporter.set_path("", 1, True)
+        self.assertEquals(0, stats.calls["other", "do_update"])
+        reporter.finish()
+        self.assertEquals(1, stats.calls["other", "do_update"])
+        self.assertEquals(100, stats.bytes["other", "do_update"])
+
+    def test_iter_log_recorded_when_exhausted(self):
+        progress = DummyProgress()
+        class Actual(object):
+            def iter_log(self, *args):
+                for i in range(3):
+                    progress.transferred += 10
+                    yield i
+        stats = RemoteAccessStats()
+        conn = InstrumentedRemoteAccess(Actual(), stats, progress)
+        it = conn.iter_log(None, 0, 2, 0, True, False, False, None)
+        self.assertEquals(0, it.next())
+        self.assertEquals(0, stats.calls["other", "iter_log"])
+        self.assertEquals([1, 2], list(it))
+        self.assertEquals(1, stats.calls["other", "iter_log"])
+        self.assertEquals(30, stats.bytes["other", "iter_log"])
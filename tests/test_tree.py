@@ -15,10 +15,15 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 """Basis and revision tree tests."""
 
+import errno
 import os
 import subvertpy
 
-from breezy import osutils
+from breezy import (
+    atomicfile,
+    osutils,
+    urlutils,
+    )
 from breezy.bzr.inventory import (
     Inventory,
     TreeReference,
@@ -27,6 +32,8 @@ from breezy.revision import (
     CURRENT_REVISION,
     )
 from breezy.tests import (
+    TestCaseInTempDir,
+    TestCaseWithMemoryTransport,
     TestSkipped,
     )
 from breezy.tests.features import (
@@ -36,6 +43,8 @@ from breezy.workingtree import WorkingTree
 
 from breezy.plugins.svn.tests import SubversionTestCase
 from breezy.plugins.svn.tree import (
+    InventoryCache,
+    PristineSha1Cache,
     SvnBasisTree,
     inventory_add_external,
     )
@@ -57,6 +66,44 @@ class TestBasisTree(SubversionTestCase):
         self.assertEquals(tree.get_file_verifier("file"),
             ("MD5", osutils.md5("new contents").hexdigest()))
 
+    def test_pristine_sha1_cache(self):
+        tree = self.make_svn_branch_and_tree("d", "dc")
+
+        dc = self.get_commit_editor(tree.branch.base)
+        f = dc.add_file("file")
+        f.modify("new contents")
+        dc.close()
+
+        self.client_update("dc")
+
+        basis = SvnBasisTree(tree)
+        ie = basis.root_inventory.get_entry(basis.path2id("file"))
+        self.assertEquals(osutils.sha_string("new contents"), ie.text_sha1)
+        cache = PristineSha1Cache(tree._pristine_sha1_cache.path)
+        self.assertEquals((ie.text_sha1, len("new contents")),
+            cache.lookup(osutils.md5("new contents").hexdigest()))
+        # A new basis tree doesn't hash the pristine text again
+        self.overrideAttr(osutils, "fingerprint_file", None)
+        basis = SvnBasisTree(tree)
+        self.assertEquals(ie, basis.root_inventory.get_entry(ie.file_id))
+
+    def test_pristine_sha1_cache_readonly(self):
+        tree = self.make_svn_branch_and_tree("d", "dc")
+
+        dc = self.get_commit_editor(tree.branch.base)
+        f = dc.add_file("file")
+        f.modify("new contents")
+        dc.close()
+
+        self.client_update("dc")
+
+        def write(self):
+            raise IOError(errno.EACCES, "Permission denied")
+        self.overrideAttr(PristineSha1Cache, "write", write)
+        basis = SvnBasisTree(tree)
+        ie = basis.root_inventory.get_entry(basis.path2id("file"))
+        self.assertEquals(osutils.sha_string("new contents"), ie.text_sha1)
+
     def test_root_id(self):
         tree = self.make_svn_branch_and_tree("d", "dc")
         tree = SvnBasisTree(tree)
@@ -352,3 +399,200 @@ class TestSvnRevisionTree(SubversionTestCase):
 
     def test_not_executable(self):
         self.assertFalse(self.tree.is_executable("foo/bla"))
+
+    def test_get_file_size(self):
+        self.assertEqual(4, self.tree.get_file_size("foo/bla"))
+        self.assertIs(None, self.tree._bzr_inventory)
+
+    def test_iter_entries_by_dir_specific_files(self):
+        entries = list(self.tree.iter_entries_by_dir(
+            specific_files=["foo/bla", "nonexistent", "foo"]))
+        self.assertEqual([("foo", "directory"), ("foo/bla", "file")],
+            [(path, ie.kind) for (path, ie) in entries])
+        self.assertEqual(self.tree.path2id("foo"), entries[1][1].parent_id)
+        self.assertIs(None, self.tree._bzr_inventory)
+        self.assertEqual(
+            [(path, ie.kind, ie.file_id) for (path, ie) in entries],
+            [(path, ie.kind, ie.file_id) for (path, ie) in
+                self.tree.root_inventory.iter_entries_by_dir(
+                    specific_file_ids=[ie.file_id for (p, ie) in entries])])
+
+    def test_list_files_from_dir(self):
+        self.assertEqual([("bla", "V", "file", self.tree.path2id("foo/bla"))],
+            [(path, c, kind, file_id) for (path, c, kind, file_id, ie) in
+                self.tree.list_files(from_dir="foo", recursive=False)])
+        self.assertEqual([], list(self.tree.list_files(from_dir="nonexistent",
+            recursive=False)))
+        self.assertIs(None, self.tree._bzr_inventory)
+
+    def describe_entries(self, entries):
+        return [(path, ie.kind, ie.file_id, ie.parent_id, ie.revision,
+                 ie.text_sha1, getattr(ie, 'reference_revision', None))
+                for (path, ie) in entries]
+
+    def test_lazy_entries_match_inventory(self):
+        # Externals are not part of the tree, so the unreachable one
+        # here is never opened
+        self.client_set_prop("dc/foo", "svn:externals",
+            "ext %s\n" % urlutils.local_path_to_url("nonexistent"))
+        self.client_commit("dc", "My Message") #3
+        revid = self.repos.generate_revision_id(3,
+            self.branch.get_branch_path(), self.repos.get_mapping())
+        self.repos.inventory_cache = InventoryCache(self.get_transport(),
+                                                    1024 * 1024)
+        paths = ["foo", "foo/bla", "foo/ext"]
+        lazy = self.repos.revision_tree(revid)
+        lazy_entries = self.describe_entries(
+            lazy.iter_entries_by_dir(specific_files=paths))
+        lazy_files = self.describe_entries((path, ie) for
+            (path, c, kind, file_id, ie) in
+            lazy.list_files(from_dir="foo", recursive=False))
+        self.assertIs(None, lazy._bzr_inventory)
+        full = self.repos.revision_tree(revid)
+        inv = full.root_inventory
+        self.assertEqual(inv, self.repos.inventory_cache.load(
+            full._inventory_cache_key(full._revmeta)))
+        self.assertEqual(self.describe_entries(
+            full.iter_entries_by_dir(specific_files=paths)), lazy_entries)
+        self.assertEqual(self.describe_entries((path, ie) for
+            (path, c, kind, file_id, ie) in
+            full.list_files(from_dir="foo", recursive=False)), lazy_files)
+        self.assertEqual(["directory", "file"],
+                         [entry[1] for entry in lazy_entries])
+        self.assertEqual(osutils.sha_string("data"), lazy_entries[1][5])
+
+    def count_get_file(self, tree):
+        calls = []
+        get_file = tree.transport.get_file
+        def counting_get_file(path, stream, revnum):
+            calls.append(path)
+            return get_file(path, stream, revnum)
+        tree.transport.get_file = counting_get_file
+        return calls
+
+    def test_metadata_without_contents(self):
+        calls = self.count_get_file(self.tree)
+        self.assertEqual("file", self.tree.kind("foo/bla"))
+        self.assertEqual("directory", self.tree.kind("foo"))
+        self.assertEqual({}, self.tree.get_file_properties("foo/bla"))
+        self.assertFalse(self.tree.is_executable("foo/bla"))
+        self.assertEqual([], calls)
+        self.assertEqual("data", self.tree.get_file_text("foo/bla"))
+        self.assertEqual("data", self.tree.get_file_text("foo/bla"))
+        self.assertEqual(["foo/bla"], calls)
+
+    def test_properties_with_contents(self):
+        self.client_set_prop("dc/foo/bla", "svn:executable", "*")
+        self.client_commit("dc", "My Message")
+        tree = self.repos.revision_tree(self.repos.generate_revision_id(3,
+            self.branch.get_branch_path(), self.repos.get_mapping()))
+        calls = self.count_get_file(tree)
+        self.assertEqual("file", tree.kind("foo/bla"))
+        self.assertEqual({"svn:executable": "*"},
+                         tree.get_file_properties("foo/bla"))
+        self.assertTrue(tree.is_executable("foo/bla"))
+        self.assertEqual("data", tree.get_file_text("foo/bla"))
+        self.assertEqual(["foo/bla"], calls)
+
+    def test_inventory_cache(self):
+        self.repos.inventory_cache = InventoryCache(self.get_transport(),
+                                                    1024 * 1024)
+        inv = self.tree.root_inventory
+        revid = self.tree.get_revision_id()
+        tree = self.repos.revision_tree(revid)
+        # The inventory is loaded from the cache rather than the server
+        self.overrideAttr(tree._repository.svn_transport, "get_connection",
+                          None)
+        self.assertEqual(inv, tree.root_inventory)
+        self.assertEqual(revid, tree.root_inventory.revision_id)
+
+
+class InventoryCacheTests(TestCaseWithMemoryTransport):
+
+    def setUp(self):
+        super(InventoryCacheTests, self).setUp()
+        self.cache = InventoryCache(self.get_transport(), 1024 * 1024)
+
+    def make_inventory(self, revid, names):
+        inv = Inventory(root_id="root-id", revision_id=revid)
+        inv.root.revision = revid
+        for name in names:
+            ie = inv.add_path(name, 'file', "%s-id" % name)
+            ie.revision = revid
+            ie.text_sha1 = osutils.sha_string(name)
+            ie.text_size = len(name)
+        return inv
+
+    def test_missing(self):
+        self.assertRaises(KeyError, self.cache.load, "svn-v4:uuid:trunk:1")
+
+    def test_unsupported_kind(self):
+        inv = self.make_inventory("svn-v4:uuid:trunk:1", ["foo"])
+        ie = TreeReference("ext-id", "ext", "root-id",
+                           revision="svn-v4:uuid:trunk:1",
+                           reference_revision=CURRENT_REVISION)
+        inv.add(ie)
+        self.cache.save("svn-v4:uuid:trunk:1", None, inv)
+        self.assertRaises(KeyError, self.cache.load, "svn-v4:uuid:trunk:1")
+
+    def test_save_load(self):
+        inv1 = self.make_inventory("rev1", ["a"])
+        self.cache.save("rev1", None, inv1)
+        inv2 = self.make_inventory("rev2", ["a", "b"])
+        self.cache.save("rev2", "rev1", inv2)
+        self.assertEqual(inv1, self.cache.load("rev1"))
+        self.assertEqual(inv2, self.cache.load("rev2"))
+
+    def test_max_size(self):
+        self.cache.max_size = 1
+        self.cache.save("rev1", None, self.make_inventory("rev1", ["a"]))
+        self.cache.save("rev2", "rev1", self.make_inventory("rev2", ["b"]))
+        self.assertRaises(KeyError, self.cache.load, "rev1")
+        self.cache.load("rev2")
+
+    def test_disabled(self):
+        self.cache.max_size = 0
+        self.cache.save("rev1", None, self.make_inventory("rev1", ["a"]))
+        self.assertRaises(KeyError, self.cache.load, "rev1")
+
+
+class PristineSha1CacheTests(TestCaseInTempDir):
+
+    def test_missing_file(self):
+        cache = PristineSha1Cache("cache")
+        self.assertRaises(KeyError, cache.lookup, "md5")
+
+    def test_add_write_read(self):
+        cache = PristineSha1Cache("cache")
+        cache.add("md5", "sha1", 42)
+        cache.write()
+        cache = PristineSha1Cache("cache")
+        self.assertEquals(("sha1", 42), cache.lookup("md5"))
+
+    def test_drops_unused(self):
+        cache = PristineSha1Cache("cache")
+        cache.add("md5a", "sha1a", 1)
+        cache.add("md5b", "sha1b", 2)
+        cache.write()
+        cache.read()
+        cache.lookup("md5a")
+        cache.write()
+        cache = PristineSha1Cache("cache")
+        self.assertEquals(("sha1a", 1), cache.lookup("md5a"))
+        self.assertRaises(KeyError, cache.lookup, "md5b")
+
+    def test_unchanged_not_written(self):
+        cache = PristineSha1Cache("cache")
+        cache.add("md5", "sha1", 42)
+        cache.write()
+        cache = PristineSha1Cache("cache")
+        cache.lookup("md5")
+        cache.add("md5", "sha1", 42)
+        self.assertFalse(cache.needs_write)
+        self.overrideAttr(atomicfile, "AtomicFile", None)
+        cache.write()
+
+    def test_unknown_format(self):
+        self.build_tree_contents([("cache", "### some other format\n")])
+        cache = PristineSha1Cache("cache")
+        self.assertRaises(KeyError, cache.lookup, "some")
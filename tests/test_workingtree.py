@@ -234,6 +234,54 @@ class TestWorkingTree(SubversionTestCase):
         tree.lock_read()
         tree.unlock()
 
+    def test_unlock_cleanup_fails(self):
+        tree = self.make_svn_branch_and_tree('a', 'dc')
+        tree.lock_write()
+        def cleanup():
+            raise IOError("cleanup failed")
+        self.overrideAttr(tree, "_cleanup", cleanup)
+        self.assertRaises(IOError, tree.unlock)
+        self.assertFalse(tree.is_locked())
+        self.assertFalse(tree.branch.is_locked())
+
+    def test_hashcache_written_on_unlock(self):
+        tree = self.make_svn_branch_and_tree('a', 'dc')
+        self.build_tree({"dc/bl": "data"})
+        # Files modified in the last few seconds are not cached
+        os.utime("dc/bl", (1000000000, 1000000000))
+        self.client_add("dc/bl")
+        tree = WorkingTree.open("dc")
+        with tree.lock_read():
+            self.assertEqual(osutils.sha_string("data"),
+                             tree.get_file_sha1("bl"))
+            self.assertTrue(tree._hashcache.needs_write)
+        self.assertFalse(tree._hashcache.needs_write)
+        # The next process finds the sha1 in the cache
+        tree = WorkingTree.open("dc")
+        with tree.lock_read():
+            tree.get_file_sha1("bl")
+        self.assertEqual(1, tree._hashcache.hit_count)
+
+    def test_iter_entries_hashed_in_order(self):
+        tree = self.make_svn_branch_and_tree('a', 'dc')
+        self.build_tree({"dc/d/": None})
+        for i in range(20):
+            self.build_tree({"dc/d/f%d" % i: "data %d" % i})
+        self.client_add("dc/d")
+        tree = WorkingTree.open("dc")
+        with tree.lock_read():
+            expected = [(path, ie.text_sha1) for (path, ie) in
+                tree._iter_hashed_entries(tree._iter_unhashed_entries(),
+                                          threads=1)]
+            tree._hashcache.clear()
+            self.overrideAttr(osutils, "local_concurrency", lambda: 4)
+            self.assertEqual(expected,
+                [(path, ie.text_sha1) for (path, ie) in
+                    tree._iter_hashed_entries(tree._iter_unhashed_entries(),
+                                              max_in_flight=1)])
+        self.assertEqual(osutils.sha_string("data 3"),
+                         dict(expected)["d/f3"])
+
     def test_get_ignore_list_empty(self):
         tree = self.make_svn_branch_and_tree('a', 'dc')
         self.assertEqual(set([".svn"] + svn_config.get_default_ignores()),
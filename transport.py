@@ -31,13 +31,26 @@ from subvertpy.ra import RemoteAccess
 from subvertpy.subr import (
     uri_canonicalize as svn_uri_canonicalize,
     )
+import atexit
+from collections import (
+    OrderedDict,
+    defaultdict,
+    deque,
+    )
+from io import BytesIO
+import json
+import marshal
+import Queue
 import sys
+import threading
+import time
 import urllib
 import urlparse
 
 import breezy
 from breezy import (
     debug,
+    trace,
     ui,
     urlutils,
     )
@@ -206,6 +219,7 @@ class SubversionProgressReporter(object):
     def __init__(self, url):
         self._scheme = urlparse.urlsplit(url)[0]
         self._last_progress = 0
+        self.transferred = 0
         # This variable isn't used yet as of bzr 1.12, and finding
         # the right Transport object will be tricky in bzr-svn's case
         # so just setting it to None for now.
@@ -219,6 +233,7 @@ class SubversionProgressReporter(object):
         if changed < 0:
             raise AssertionError("changed was %d (%d -> %d)" % (changed, self._last_progress, progress))
         self._last_progress = progress
+        self.transferred += changed
         ui.ui_factory.report_transport_activity(self, changed, None)
 
 
@@ -237,14 +252,27 @@ def convert_relocate_error(url, num, msg):
 
 
 def Connection(url, auth=None, config=None, readonly=False):
-    progress_cb = SubversionProgressReporter(url).update
+    if url.startswith("svn+replay:"):
+        from .ratrace import open_replay_connection
+        ret = open_replay_connection(url)
+        if readonly:
+            ret = ReadonlyRemoteAccess(ret)
+        return ret
+    progress = SubversionProgressReporter(url)
     try:
         ret = RemoteAccess(_url_escape_uri(url), auth=auth,
                 client_string_func=breezy.plugins.svn.get_client_string,
-                progress_cb=progress_cb,
+                progress_cb=progress.update,
                 config=config)
         if 'transport' in debug.debug_flags:
             ret = MutteringRemoteAccess(ret)
+        if 'svn-ra-stats' in debug.debug_flags:
+            ret = InstrumentedRemoteAccess(ret, get_ra_stats(), progress)
+        from .ratrace import get_trace_writer
+        writer = get_trace_writer()
+        if writer is not None:
+            from .ratrace import RecordingRemoteAccess
+            ret = RecordingRemoteAccess(ret, writer)
         if readonly:
             ret = ReadonlyRemoteAccess(ret)
     except subvertpy.SubversionException as e:
@@ -265,14 +293,115 @@ def Connection(url, auth=None, config=None, readonly=False):
     return ret
 
 
+# Number of files to retrieve concurrently in SvnRaTransport.iter_files
+FILE_FETCH_CONCURRENCY = 4
+
+
+class _FileFetchRequest(object):
+    """Retrieval of a single file by a worker thread."""
+
+    __slots__ = ('path', 'revnum', 'result', 'error', 'done')
+
+    def __init__(self, path, revnum):
+        self.path = path
+        self.revnum = revnum
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self, conn):
+        stream = BytesIO()
+        try:
+            (fetched_rev, props) = conn.get_file(self.path, stream,
+                                                 self.revnum)
+        except:
+            self.error = sys.exc_info()
+        else:
+            stream.seek(0)
+            self.result = (self.path, self.revnum, props, stream)
+        self.done.set()
+
+    def get(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+def _file_fetch_worker(conn, queue, subsystem):
+    # Attribute the requests to the subsystem the files were requested by
+    _ra_subsystem.name = subsystem
+    while True:
+        request = queue.get()
+        if request is None:
+            return
+        request.run(conn)
+
+
+# Maximum size in bytes of the persistent cache of RA responses
+RA_CACHE_MAX_SIZE = 32 * 1024 * 1024
+
+
+class RemoteAccessCache(object):
+    """Cache of responses to RA requests for fixed revisions.
+
+    Responses for a specific revision never change, so they can be
+    cached indefinitely. Values are opaque byte strings.
+    """
+
+    def lookup(self, kind, path, revnum, extra):
+        """Look up a cached response.
+
+        :param kind: Name of the request
+        :param path: Path relative to the repository root
+        :param revnum: Revision number
+        :param extra: Byte string with other request arguments
+        :return: Cached response
+        :raises KeyError: if the response is not cached
+        """
+        raise NotImplementedError(self.lookup)
+
+    def insert(self, kind, path, revnum, extra, value):
+        """Store a response.
+
+        :param kind: Name of the request
+        :param path: Path relative to the repository root
+        :param revnum: Revision number
+        :param extra: Byte string with other request arguments
+        :param value: Response, as byte string
+        """
+        raise NotImplementedError(self.insert)
+
+
+# Maximum number of idle connections to keep in a connection pool
+CONNECTION_POOL_SIZE = 8
+# Number of seconds after which idle connections are discarded
+CONNECTION_IDLE_TIMEOUT = 300
+# Number of seconds after which idle connections are checked before reuse
+CONNECTION_HEALTH_CHECK_AGE = 60
+
+
 class ConnectionPool(object):
-    """Collection of connections to a Subversion repository."""
+    """Collection of connections to a Subversion repository.
+
+    Idle connections are indexed by URL and kept in least recently used
+    order. At most max_size idle connections are kept; connections that
+    have been idle for longer than idle_timeout are discarded.
+    """
 
-    def __init__(self, url, readonly=False):
+    def __init__(self, url, readonly=False, max_size=CONNECTION_POOL_SIZE,
+                 idle_timeout=CONNECTION_IDLE_TIMEOUT):
         self.start_url = url
-        self.connections = set()
+        # connection -> time it was returned to the pool, oldest first
+        self.connections = OrderedDict()
+        # url -> list of idle connections for that url
+        self._by_url = {}
         self.readonly = readonly
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
         self.auth_baton = create_auth_baton(url)
+        self.stats = {"created": 0, "reused": 0, "reparented": 0,
+                      "expired": 0, "evicted": 0}
 
     def set_credentials(self, credentials):
         if isinstance(credentials, dict):
@@ -285,57 +414,123 @@ class ConnectionPool(object):
         if password is not None:
             self.auth_baton.set_parameter(AUTH_PARAM_DEFAULT_PASSWORD, password)
 
+    def _now(self):
+        return time.time()
+
+    def _connect(self, url):
+        self.stats["created"] += 1
+        return Connection(url, self.auth_baton, readonly=self.readonly)
+
+    def _remove(self, c):
+        del self.connections[c]
+        conns = self._by_url[c.url]
+        conns.remove(c)
+        if not conns:
+            del self._by_url[c.url]
+
+    def _is_healthy(self, c, idle):
+        if idle > self.idle_timeout:
+            self.stats["expired"] += 1
+            return False
+        if idle > CONNECTION_HEALTH_CHECK_AGE:
+            try:
+                c.get_latest_revnum()
+            except subvertpy.SubversionException as e:
+                mutter("discarding broken connection to %s: %s", c.url, e)
+                self.stats["expired"] += 1
+                return False
+        return True
+
+    def _take(self, c):
+        """Take a connection out of the pool.
+
+        :return: True if the connection can be used, False if it was
+            discarded
+        """
+        idle = self._now() - self.connections[c]
+        self._remove(c)
+        assert not c.busy, "busy connection in pool"
+        return self._is_healthy(c, idle)
+
+    def _take_url(self, url):
+        """Take an idle connection for a specific URL out of the pool.
+
+        :return: Connection, or None if there was no usable connection
+        """
+        while url in self._by_url:
+            c = self._by_url[url][-1]
+            if self._take(c):
+                return c
+        return None
+
+    def _take_oldest(self):
+        """Take the least recently used idle connection out of the pool.
+
+        :return: Connection, or None if there was no usable connection
+        """
+        while self.connections:
+            c = next(iter(self.connections))
+            if self._take(c):
+                return c
+        return None
+
     def get_any(self):
-        try:
-            c = self.connections.pop()
-        except KeyError:
-            return Connection(self.start_url, self.auth_baton,
-                readonly=self.readonly)
-        else:
-            assert not c.busy, "busy connection in pool"
-            return c
+        while self.connections:
+            c = next(reversed(self.connections))
+            if self._take(c):
+                self.stats["reused"] += 1
+                return c
+        return self._connect(self.start_url)
 
     def new(self, url):
         # Nothing available? Just pick an existing one and reparent:
-        if len(self.connections) == 0:
-            return Connection(url, self.auth_baton, readonly=self.readonly)
-        c = self.connections.pop()
+        c = self._take_oldest()
+        if c is None:
+            return self._connect(url)
         try:
             c.reparent(_url_escape_uri(url))
-            return c
         except NotImplementedError:
-            self.connections.add(c)
-            return Connection(url, self.auth_baton, readonly=self.readonly)
+            self.add(c)
+            return self._connect(url)
         except:
-            self.connections.add(c)
+            self.add(c)
             raise
+        self.stats["reparented"] += 1
+        return c
 
     def get_parent(self, url):
-        # Check if there is an existing connection we can use
-        for c in self.connections:
-            assert not c.busy, "busy connection in pool"
-            assert not c.url.endswith("/"), "%r ends with a /" % c.url
-            assert isinstance(url, text_type)
-            if url == c.url or url.startswith(c.url+"/"):
-                self.connections.remove(c)
+        assert isinstance(url, text_type)
+        # Check if there is an existing connection for url or one of its
+        # parents we can use
+        parent = url.rstrip("/")
+        while True:
+            c = self._take_url(parent)
+            if c is not None:
+                self.stats["reused"] += 1
                 relpath = urlutils.relative_url(c.url+"/", url.rstrip("/")+"/")
                 if relpath == ".":
                     relpath = ""
                 return c, relpath.rstrip("/")
+            if "/" not in parent:
+                break
+            parent = parent.rsplit("/", 1)[0]
         return self.new(url), ""
 
     def get(self, url):
         # Check if there is an existing connection we can use
-        for c in self.connections:
-            assert not c.busy, "busy connection in pool"
-            if c.url == url:
-                self.connections.remove(c)
-                return c
+        c = self._take_url(url)
+        if c is not None:
+            self.stats["reused"] += 1
+            return c
         return self.new(url)
 
     def add(self, connection):
         assert not connection.busy, "adding busy connection in pool"
-        self.connections.add(connection)
+        self.connections[connection] = self._now()
+        self._by_url.setdefault(connection.url, []).append(connection)
+        while len(self.connections) > self.max_size:
+            self._remove(next(iter(self.connections)))
+            self.stats["evicted"] += 1
 
 
 class SvnRaTransport(Transport):
@@ -369,6 +564,10 @@ class SvnRaTransport(Transport):
             if credentials is not None:
                 assert isinstance(credentials, dict)
                 self.connections.set_credentials(credentials)
+        if from_transport is None:
+            self._response_cache = None
+        else:
+            self._response_cache = from_transport._response_cache
         self._repos_root = None
         self._uuid = None
         self.capabilities = {}
@@ -378,6 +577,33 @@ class SvnRaTransport(Transport):
     def is_readonly(self):
         return self.connections.readonly
 
+    def set_response_cache(self, cache):
+        """Set the cache to use for responses for fixed revisions.
+
+        :param cache: RemoteAccessCache, or None to disable caching
+        """
+        self._response_cache = cache
+
+    def _cached_request(self, kind, path, revnum, extra, fn, *args):
+        if self._response_cache is None or revnum < 0:
+            # Requests for HEAD can return different results over time
+            return fn(*args)
+        repos_path = urlutils.join(self.svn_url, path)[
+            len(self.get_svn_repos_root()):].strip("/")
+        try:
+            return marshal.loads(self._response_cache.lookup(
+                kind, repos_path, revnum, extra))
+        except KeyError:
+            pass
+        ret = fn(*args)
+        try:
+            value = marshal.dumps(ret)
+        except ValueError:
+            # Not a plain Python type
+            return ret
+        self._response_cache.insert(kind, repos_path, revnum, extra, value)
+        return ret
+
     def get_any_connection(self):
         return self.connections.get_any()
 
@@ -526,6 +752,10 @@ class SvnRaTransport(Transport):
 
     @convert_svn_error
     def get_dir(self, path, revnum, fields=0):
+        return self._cached_request("get_dir", path, revnum, b"%d" % fields,
+            self._get_dir, path, revnum, fields)
+
+    def _get_dir(self, path, revnum, fields):
         conn, relpath = self.get_path_connection(path)
         try:
             return conn.get_dir(relpath, revnum, fields)
@@ -539,6 +769,60 @@ class SvnRaTransport(Transport):
         finally:
             self.add_connection(conn)
 
+    def iter_files(self, requests, concurrency=FILE_FETCH_CONCURRENCY):
+        """Retrieve the contents of multiple files.
+
+        Files are retrieved concurrently over separate connections, but
+        returned in the order they were requested.
+
+        :param requests: Iterable over (path, revnum) tuples, with paths
+            relative to this transport
+        :param concurrency: Maximum number of files to retrieve at once
+        :return: Iterator over (path, revnum, props, stream) tuples
+        """
+        if concurrency <= 1:
+            for (path, revnum) in requests:
+                stream = BytesIO()
+                (fetched_rev, props) = self.get_file(path, stream, revnum)
+                stream.seek(0)
+                yield (path, revnum, props, stream)
+            return
+        if 'svn-ra-stats' in debug.debug_flags:
+            subsystem = find_ra_subsystem(sys._getframe())
+        else:
+            subsystem = None
+        queue = Queue.Queue()
+        conns = []
+        threads = []
+        try:
+            # Keep a bounded number of files in flight, so that memory use
+            # doesn't depend on the number of requests
+            pending = deque()
+            for (path, revnum) in requests:
+                if len(threads) < concurrency:
+                    # Only open as many connections as there are files
+                    conn = self.get_connection()
+                    conns.append(conn)
+                    thread = threading.Thread(target=_file_fetch_worker,
+                                              args=(conn, queue, subsystem))
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+                request = _FileFetchRequest(path, revnum)
+                queue.put(request)
+                pending.append(request)
+                if len(pending) >= concurrency * 2:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+            for conn in conns:
+                self.add_connection(conn)
+
     def get_file_revs(self, path, start_revnum, end_revnum, handler,
                       include_merged_revisions=False):
         conn, relpath = self.get_path_connection(path)
@@ -560,6 +844,10 @@ class SvnRaTransport(Transport):
         return dirents.keys()
 
     def check_path(self, path, revnum):
+        return self._cached_request("check_path", path, revnum, b"",
+            self._check_path, path, revnum)
+
+    def _check_path(self, path, revnum):
         conn, relpath = self.get_path_connection(path)
         try:
             return conn.check_path(relpath, revnum)
@@ -626,6 +914,11 @@ class SvnRaTransport(Transport):
             self.add_connection(conn)
 
     def get_locations(self, path, peg_revnum, revnums):
+        return self._cached_request("get_locations", path, peg_revnum,
+            b" ".join([b"%d" % r for r in revnums]),
+            self._get_locations, path, peg_revnum, revnums)
+
+    def _get_locations(self, path, peg_revnum, revnums):
         conn, relpath = self.get_path_connection(path)
         try:
             return conn.get_locations(relpath, peg_revnum, revnums)
@@ -858,6 +1151,230 @@ class MutteringRemoteAccess(object):
         return self.actual.replay(revision, low_water_mark, editor, send_deltas)
 
 
+# Upper bounds, in milliseconds, of the buckets of RA latency histograms
+RA_LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# RA methods that are instrumented by InstrumentedRemoteAccess
+INSTRUMENTED_RA_METHODS = set(["get_log", "iter_log", "get_dir", "get_file",
+    "get_file_revs", "do_update", "do_switch", "do_diff", "replay",
+    "replay_range", "get_locations", "rev_proplist", "check_path", "stat",
+    "get_latest_revnum"])
+
+# Modules that are reported as the subsystem issuing RA requests
+RA_SUBSYSTEMS = set(["branch", "commit", "fetch", "fileids", "layout",
+    "logwalker", "metagraph", "push", "repository", "revids", "revmeta",
+    "tags", "tree", "workingtree"])
+
+
+# Subsystem that RA requests made by the current thread are attributed to,
+# for worker threads that make requests on behalf of another thread
+_ra_subsystem = threading.local()
+
+
+def find_ra_subsystem(frame):
+    """Find the subsystem a RA request originates from.
+
+    Requests are attributed to the outermost subsystem on the stack, so
+    that e.g. requests made by the layout code on behalf of the tags code
+    are counted for the tags.
+
+    :param frame: Stack frame to start looking in
+    :return: Name of the outermost module in RA_SUBSYSTEMS on the stack,
+        or "other"
+    """
+    subsystem = getattr(_ra_subsystem, "name", None)
+    if subsystem is not None:
+        return subsystem
+    prefix = __name__.rsplit(".", 1)[0] + "."
+    ret = "other"
+    while frame is not None:
+        name = frame.f_globals.get("__name__", "")
+        if name.startswith(prefix):
+            subsystem = name[len(prefix):].split(".", 1)[0]
+            if subsystem in RA_SUBSYSTEMS:
+                ret = subsystem
+        frame = frame.f_back
+    return ret
+
+
+class RemoteAccessStats(object):
+    """Call counts, bytes transferred and latency histograms of RA calls.
+
+    Enabled with -Dsvn-ra-stats.
+    """
+
+    def __init__(self, buckets=RA_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.calls = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.histograms = {}
+
+    def add(self, subsystem, method, elapsed, nbytes=0):
+        """Record a RA call.
+
+        :param subsystem: Subsystem that issued the call
+        :param method: Name of the RA method
+        :param elapsed: Time spent, in seconds
+        :param nbytes: Number of bytes transferred
+        """
+        key = (subsystem, method)
+        self.calls[key] += 1
+        self.bytes[key] += nbytes
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            histogram = self.histograms[key] = [0] * (len(self.buckets) + 1)
+        ms = elapsed * 1000
+        for i, bound in enumerate(self.buckets):
+            if ms <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[-1] += 1
+
+    def as_dict(self):
+        ret = {}
+        for (subsystem, method) in self.calls:
+            ret.setdefault(subsystem, {})[method] = {
+                "calls": self.calls[subsystem, method],
+                "bytes": self.bytes[subsystem, method],
+                "latency_ms": dict(zip(
+                    ["<=%d" % b for b in self.buckets] +
+                    [">%d" % self.buckets[-1]],
+                    self.histograms[subsystem, method]))}
+        return ret
+
+    def write(self, f):
+        """Write the statistics as JSON to a file-like object."""
+        json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+_ra_stats = None
+def get_ra_stats():
+    """Return the RA statistics for this process.
+
+    The statistics are written to a JSON file in the current directory
+    when the process exits.
+    """
+    global _ra_stats
+    if _ra_stats is None:
+        _ra_stats = RemoteAccessStats()
+        atexit.register(_write_ra_stats, _ra_stats)
+    return _ra_stats
+
+
+def _write_ra_stats(stats):
+    path = "svn-ra-stats-%s.json" % time.strftime("%Y%m%d%H%M%S")
+    f = open(path, 'w')
+    try:
+        stats.write(f)
+    finally:
+        f.close()
+    trace.note("RA statistics written to %s.", path)
+
+
+class _InstrumentedReporter(object):
+    """Reporter wrapper that records a RA call once the report is done.
+
+    The editor is driven when the report is finished, so the time spent
+    and bytes transferred for do_update, do_switch and do_diff are only
+    known at that point.
+    """
+
+    def __init__(self, actual, record, start):
+        self.actual = actual
+        self._record = record
+        self._start = start
+
+    def __getattr__(self, name):
+        return getattr(self.actual, name)
+
+    def _done(self):
+        if self._record is not None:
+            self._record(time.time() - self._start)
+            self._record = None
+
+    def finish(self, *args, **kwargs):
+        try:
+            return self.actual.finish(*args, **kwargs)
+        finally:
+            self._done()
+
+    def abort(self, *args, **kwargs):
+        try:
+            return self.actual.abort(*args, **kwargs)
+        finally:
+            self._done()
+
+
+def _iter_instrumented(it, record, elapsed):
+    """Iterate over the results of a RA call, recording it once done.
+
+    Only the time spent waiting for results is counted.
+    """
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = next(it)
+            finally:
+                elapsed += time.time() - start
+            yield item
+    except StopIteration:
+        return
+    finally:
+        record(elapsed)
+
+
+class InstrumentedRemoteAccess(object):
+    """RemoteAccess wrapper that records statistics about RA calls."""
+
+    busy = property(lambda self: self.actual.busy)
+    url = property(lambda self: self.actual.url)
+
+    def __init__(self, actual, stats, progress=None):
+        self.actual = actual
+        self.stats = stats
+        self.progress = progress
+
+    def _start(self, subsystem, name):
+        """Start measuring a RA call.
+
+        :return: Function to call with the time spent once the call is done
+        """
+        if self.progress is not None:
+            transferred = self.progress.transferred
+        def record(elapsed):
+            if self.progress is not None:
+                nbytes = self.progress.transferred - transferred
+            else:
+                nbytes = 0
+            self.stats.add(subsystem, name, elapsed, nbytes)
+        return record
+
+    def __getattr__(self, name):
+        fn = getattr(self.actual, name)
+        if name not in INSTRUMENTED_RA_METHODS:
+            return fn
+        def wrapper(*args, **kwargs):
+            record = self._start(find_ra_subsystem(sys._getframe(1)), name)
+            start = time.time()
+            try:
+                ret = fn(*args, **kwargs)
+            except:
+                record(time.time() - start)
+                raise
+            if name in ("do_update", "do_switch", "do_diff"):
+                return _InstrumentedReporter(ret, record, start)
+            elif name == "iter_log":
+                return _iter_instrumented(iter(ret), record,
+                                          time.time() - start)
+            record(time.time() - start)
+            return ret
+        return wrapper
+
+
 def create_branch_prefix(transport, revprops, bp_parts, existing_bp_parts=None):
     """Create a branch prefixes (e.g. "branches")
 
@@ -17,6 +17,7 @@
 
 from __future__ import absolute_import
 
+import errno
 from io import BytesIO
 import os
 import subvertpy
@@ -25,10 +26,18 @@ from subvertpy import (
     properties,
     wc,
     )
+from subvertpy.ra import (
+    DIRENT_CREATED_REV,
+    DIRENT_HAS_PROPS,
+    DIRENT_KIND,
+    DIRENT_SIZE,
+    )
 import urllib
 
 from breezy import (
+    atomicfile,
     errors,
+    lru_cache,
     rules,
     osutils,
     urlutils,
@@ -42,9 +51,20 @@ from breezy.branch import Branch
 from breezy.bzr.inventory import (
     Inventory,
     InventoryDirectory,
+    InventoryFile,
+    InventoryLink,
     TreeReference,
     )
 from breezy.bzr.inventorytree import find_ids_across_trees
+from breezy.bzr.knit import (
+    make_file_factory,
+    )
+from breezy.bzr.versionedfile import (
+    ConstantMapper,
+    )
+from breezy.bzr.xml8 import (
+    serializer_v8,
+    )
 from breezy.osutils import (
     md5,
     )
@@ -335,6 +355,136 @@ def inventory_add_external(inv, parent_id, path, revid, ref_revnum, url):
     inv.add(ie)
 
 
+INVENTORY_CACHE_VERSION = 1
+
+
+class InventoryCache(object):
+    """Cache of revision tree inventories.
+
+    Inventories are stored in a knit as XML, keyed by the revision id of
+    the foreign revision in the mapping that was used, so that they are
+    delta-compressed against the inventory of their left hand side parent.
+    When the knit grows beyond the maximum size, it is discarded.
+    """
+
+    def __init__(self, cache_transport, max_size):
+        self.transport = cache_transport
+        self.max_size = max_size
+        self._name = "inventories-v%d" % INVENTORY_CACHE_VERSION
+        self._open()
+
+    def _open(self):
+        mapper = ConstantMapper(self._name)
+        self.knit = make_file_factory(False, mapper)(self.transport)
+
+    def _size(self):
+        size = 0
+        for suffix in (".knit", ".kndx"):
+            try:
+                size += self.transport.stat(self._name + suffix).st_size
+            except errors.NoSuchFile:
+                pass
+        return size
+
+    def _clear(self):
+        mutter('discarding inventory cache')
+        for suffix in (".knit", ".kndx"):
+            try:
+                self.transport.delete(self._name + suffix)
+            except errors.NoSuchFile:
+                pass
+        self._open()
+
+    def load(self, key):
+        """Load an inventory.
+
+        :param key: Revision id of the foreign revision
+        :raises KeyError: if the inventory is not cached
+        :return: Inventory
+        """
+        record = self.knit.get_record_stream([(key,)], 'unordered',
+                                             True).next()
+        if record.storage_kind == 'absent':
+            raise KeyError(key)
+        return serializer_v8.read_inventory_from_string(
+            record.get_bytes_as('fulltext'))
+
+    def save(self, key, parent_key, inv):
+        """Store an inventory.
+
+        :param key: Revision id of the foreign revision
+        :param parent_key: Revision id of the left hand side parent, or None
+        :param inv: Inventory to store
+        """
+        if self.max_size <= 0:
+            return
+        if self.knit.get_parent_map([(key,)]):
+            return
+        for path, ie in inv.iter_entries():
+            if ie.kind not in serializer_v8.supported_kinds:
+                mutter('not caching inventory %s with %s entry %s',
+                       key, ie.kind, path)
+                return
+        if self._size() > self.max_size:
+            self._clear()
+        if parent_key is None:
+            parents = []
+        else:
+            parents = [(parent_key,)]
+        self.knit.add_lines((key,), parents, osutils.split_lines(
+            serializer_v8.write_inventory_to_string(inv)))
+
+
+# Metadata retrieved for the entries of a directory when looking up
+# individual paths without building the full inventory
+LAZY_DIRENT_FIELDS = (DIRENT_KIND | DIRENT_SIZE | DIRENT_HAS_PROPS |
+                      DIRENT_CREATED_REV)
+
+
+# Maximum size in bytes of the file contents kept per SvnRevisionTree
+TREE_CONTENTS_CACHE_SIZE = 10 * 1024 * 1024
+
+
+def _versioned_properties(props):
+    """Strip the entry and working copy properties returned by the server."""
+    return dict((k, v) for (k, v) in props.iteritems()
+                if not k.startswith(properties.PROP_ENTRY_PREFIX) and
+                   not k.startswith(properties.PROP_WC_PREFIX))
+
+
+def _by_dir_key(path):
+    """Sort key matching the order of Inventory.iter_entries_by_dir."""
+    if path == u"":
+        return ((), None)
+    (dirname, basename) = osutils.split(path)
+    if dirname == u"":
+        return ((), basename)
+    return (tuple(dirname.split(u"/")), basename)
+
+
+class LazyInventoryFile(InventoryFile):
+    """File entry that only retrieves its text when text_sha1 is accessed."""
+
+    __slots__ = ['_tree', '_path']
+
+    def __init__(self, tree, path, file_id, name, parent_id):
+        self._tree = tree
+        self._path = path
+        super(LazyInventoryFile, self).__init__(file_id, name, parent_id)
+
+    def _get_text_sha1(self):
+        text_sha1 = InventoryFile.text_sha1.__get__(self, InventoryFile)
+        if text_sha1 is None:
+            text_sha1 = osutils.sha_string(self._tree._get_contents(self._path))
+            InventoryFile.text_sha1.__set__(self, text_sha1)
+        return text_sha1
+
+    def _set_text_sha1(self, text_sha1):
+        InventoryFile.text_sha1.__set__(self, text_sha1)
+
+    text_sha1 = property(_get_text_sha1, _set_text_sha1)
+
+
 class SvnRevisionTree(SvnRevisionTreeCommon):
     """A tree that existed in a historical Subversion revision."""
 
@@ -348,12 +498,31 @@ class SvnRevisionTree(SvnRevisionTreeCommon):
         self.file_properties = {}
         self.transport = repository.svn_transport.clone(
             self._revmeta.metarev.branch_path)
+        self._dirents = {}
+        self._entries = {}
+        self._properties = {}
+        self._contents = lru_cache.LRUSizeCache(TREE_CONTENTS_CACHE_SIZE)
+
+    def _inventory_cache_key(self, revmeta):
+        return self.mapping.revision_id_foreign_to_bzr(
+            revmeta.metarev.get_foreign_revid())
 
     @property
     def root_inventory(self):
         # FIXME
         if self._bzr_inventory is not None:
             return self._bzr_inventory
+        inventory_cache = self._repository.inventory_cache
+        if inventory_cache is not None:
+            try:
+                inv = inventory_cache.load(
+                    self._inventory_cache_key(self._revmeta))
+            except KeyError:
+                pass
+            else:
+                inv.revision_id = self.get_revision_id()
+                self._bzr_inventory = inv
+                return inv
         self._bzr_inventory = Inventory()
         self._bzr_inventory.revision_id = self.get_revision_id()
         root_repos = self._repository.svn_transport.get_svn_repos_root()
@@ -371,8 +540,166 @@ class SvnRevisionTree(SvnRevisionTreeCommon):
                 raise
         finally:
             self._repository.svn_transport.add_connection(conn)
+        if inventory_cache is not None:
+            parent_revmeta = self._revmeta.get_lhs_parent_revmeta(self.mapping)
+            if parent_revmeta is None:
+                parent_key = None
+            else:
+                parent_key = self._inventory_cache_key(parent_revmeta)
+            inventory_cache.save(self._inventory_cache_key(self._revmeta),
+                parent_key, self._bzr_inventory)
         return self._bzr_inventory
 
+    def _get_dirents(self, path):
+        """Retrieve the metadata of the children of a directory.
+
+        :param path: Path of the directory
+        :raises NoSuchFile: if path does not exist or is not a directory
+        :return: Dictionary mapping child names to dirents
+        """
+        try:
+            return self._dirents[path]
+        except KeyError:
+            pass
+        try:
+            (dirents, fetched_rev, props) = self.transport.get_dir(path,
+                self._revmeta.metarev.revnum, LAZY_DIRENT_FIELDS)
+        except subvertpy.SubversionException as e:
+            msg, num = e.args
+            if num in (subvertpy.ERR_FS_NOT_FOUND,
+                       subvertpy.ERR_FS_NOT_DIRECTORY):
+                raise errors.NoSuchFile(path)
+            raise
+        ret = {}
+        for name, dirent in dirents.iteritems():
+            if isinstance(name, bytes):
+                name = name.decode("utf-8")
+            ret[name] = dirent
+        self._dirents[path] = ret
+        self._properties.setdefault(path, _versioned_properties(props))
+        return ret
+
+    def _get_dirent(self, path):
+        """Retrieve the metadata of a path from its parent directory.
+
+        :raises NoSuchFile: if path does not exist
+        """
+        (parent_path, name) = osutils.split(path)
+        try:
+            return self._get_dirents(parent_path)[name]
+        except KeyError:
+            raise errors.NoSuchFile(path)
+
+    def _get_contents(self, path):
+        """Retrieve the contents of a file.
+
+        The properties of the file are remembered and its contents are
+        kept in a bounded cache, so that looking at the properties,
+        kind or contents of a file only retrieves it once.
+        """
+        try:
+            return self._contents[path]
+        except KeyError:
+            pass
+        stream = BytesIO()
+        (fetched_rev, props) = self.transport.get_file(path, stream,
+            self._revmeta.metarev.revnum)
+        contents = stream.getvalue()
+        self._properties[path] = _versioned_properties(props)
+        self._contents[path] = contents
+        return contents
+
+    def _get_properties(self, path):
+        try:
+            return self._properties[path]
+        except KeyError:
+            pass
+        if path == u"":
+            self._get_dirents(path)
+            return self._properties[path]
+        dirent = self._get_dirent(path)
+        if not dirent['has_props']:
+            props = {}
+        elif dirent['kind'] == subvertpy.NODE_DIR:
+            self._get_dirents(path)
+            return self._properties[path]
+        else:
+            self._get_contents(path)
+            return self._properties[path]
+        self._properties[path] = props
+        return props
+
+    def _is_symlink(self, path, props):
+        return (properties.PROP_SPECIAL in props and
+                self._get_contents(path).startswith(b"link "))
+
+    def _make_entry(self, path, name, parent_id, dirent):
+        file_id, revision_id = self.lookup_id(path)
+        if dirent['kind'] == subvertpy.NODE_DIR:
+            ie = InventoryDirectory(file_id, name, parent_id)
+        else:
+            # The executable bit and symlinks are stored as properties
+            props = self._get_properties(path)
+            if self._is_symlink(path, props):
+                ie = InventoryLink(file_id, name, parent_id)
+                ie.symlink_target = self._get_contents(path)[len("link "):]
+            else:
+                ie = LazyInventoryFile(self, path, file_id, name, parent_id)
+                ie.text_size = dirent['size']
+                ie.executable = (properties.PROP_EXECUTABLE in props)
+        ie.revision = revision_id
+        return ie
+
+    def _get_entry(self, path):
+        """Return the inventory entry for a path.
+
+        Unless the full inventory has already been built, this only
+        retrieves the parent directory of path. The text of files is only
+        retrieved when their text_sha1 is accessed, and directory entries
+        have no children.
+
+        :raises NoSuchFile: if path does not exist
+        """
+        if self._bzr_inventory is not None:
+            file_id = self._bzr_inventory.path2id(path)
+            if file_id is None:
+                raise errors.NoSuchFile(path)
+            return self._bzr_inventory.get_entry(file_id)
+        try:
+            return self._entries[path]
+        except KeyError:
+            pass
+        if path == u"":
+            file_id, revision_id = self.lookup_id(path)
+            ie = InventoryDirectory(file_id, u"", None)
+            ie.revision = revision_id
+        else:
+            dirent = self._get_dirent(path)
+            (parent_path, name) = osutils.split(path)
+            parent_id = self._get_entry(parent_path).file_id
+            ie = self._make_entry(path, name, parent_id, dirent)
+        self._entries[path] = ie
+        return ie
+
+    def _get_child_entries(self, path):
+        """Return the inventory entries of the children of a directory.
+
+        :return: List of (name, entry) tuples, sorted by name
+        """
+        parent = self._get_entry(path)
+        if parent.kind != 'directory':
+            return []
+        ret = []
+        for name, dirent in sorted(self._get_dirents(path).iteritems()):
+            child_path = osutils.pathjoin(path, name) if path else name
+            try:
+                ie = self._entries[child_path]
+            except KeyError:
+                ie = self._make_entry(child_path, name, parent.file_id, dirent)
+                self._entries[child_path] = ie
+            ret.append((name, ie))
+        return ret
+
     def all_file_ids(self):
         return set(self.root_inventory.iter_all_ids())
 
@@ -380,6 +707,16 @@ class SvnRevisionTree(SvnRevisionTreeCommon):
         return set(p for p, e in self.iter_entries_by_dir())
 
     def iter_entries_by_dir(self, specific_files=None):
+        if specific_files is not None and self._bzr_inventory is None:
+            # Only look up the requested paths
+            entries = {}
+            for path in specific_files:
+                try:
+                    entries[path] = self._get_entry(path)
+                except errors.NoSuchFile:
+                    pass
+            return iter(sorted(entries.iteritems(),
+                               key=lambda item: _by_dir_key(item[0])))
         if specific_files is not None:
             specific_file_ids = []
             for path in specific_files:
@@ -393,27 +730,33 @@ class SvnRevisionTree(SvnRevisionTreeCommon):
             specific_file_ids=specific_file_ids)
 
     def kind(self, path, file_id=None):
-        stream = BytesIO()
-        try:
-            (fetched_rev, props) = self.transport.get_file(path,
-                    stream, self._revmeta.metarev.revnum)
-        except subvertpy.SubversionException as e:
-            msg, num = e.args
-            if num == subvertpy.ERR_FS_NOT_FILE:
-                return "directory"
-            raise
-        stream.seek(0)
-        if props.has_key(properties.PROP_SPECIAL) and stream.read(5) == "link ":
-            return "symlink"
-        return "file"
+        return self._get_entry(path).kind
+
+    def iter_child_entries(self, path, file_id=None):
+        if self._bzr_inventory is not None:
+            return super(SvnRevisionTree, self).iter_child_entries(path,
+                file_id)
+        return iter([ie for (name, ie) in self._get_child_entries(path)])
 
     def get_file_size(self, path, file_id=None):
-        if file_id is None:
-            file_id = self.path2id(path)
-        # FIXME: More efficient implementation?
-        return self.root_inventory.get_entry(file_id).text_size
+        return self._get_entry(path).text_size
 
     def list_files(self, include_root=False, from_dir=None, recursive=True):
+        if not recursive and self._bzr_inventory is None:
+            # Only retrieve the directory that is being listed
+            if from_dir is None:
+                if include_root:
+                    ie = self._get_entry(u"")
+                    yield u"", 'V', ie.kind, ie.file_id, ie
+                from_dir = u""
+            try:
+                children = self._get_child_entries(from_dir)
+            except errors.NoSuchFile:
+                # Directory not versioned
+                return
+            for name, ie in children:
+                yield name, 'V', ie.kind, ie.file_id, ie
+            return
         # FIXME
         # The only files returned by this are those from the version
         inv = self.root_inventory
@@ -432,37 +775,20 @@ class SvnRevisionTree(SvnRevisionTreeCommon):
             yield path, 'V', entry.kind, entry.file_id, entry
 
     def get_file(self, path, file_id=None):
-        stream = BytesIO()
-        (fetched_rev, props) = self.transport.get_file(path,
-                stream, self._revmeta.metarev.revnum)
-        if properties.PROP_SPECIAL in props and stream.read(5) == b"link ":
+        contents = self._get_contents(path)
+        if self._is_symlink(path, self._get_properties(path)):
             return BytesIO()
-        stream.seek(0)
-        return stream
+        return BytesIO(contents)
 
     def get_file_stream_by_path(self, path):
-        stream = BytesIO()
-        (fetched_rev, props) = self.transport.get_file(path,
-                stream, self._revmeta.metarev.revnum)
-        stream.seek(0)
-        return stream
+        return BytesIO(self._get_contents(path))
 
     def get_file_text(self, path, file_id=None):
         with self.get_file(path, file_id) as my_file:
             return my_file.read()
 
     def get_file_properties(self, path, file_id=None):
-        try:
-            (fetched_rev, props) = self.transport.get_file(path,
-                    BytesIO(), self._revmeta.metarev.revnum)
-        except subvertpy.SubversionException as e:
-            msg, num = e.args
-            if num == subvertpy.ERR_FS_NOT_FILE:
-                (dirents, fetched_rev, props) = self.transport.get_dir(
-                    path, self._revmeta.metarev.revnum)
-            else:
-                raise
-        return props
+        return self._get_properties(path)
 
     def has_filename(self, path):
         kind = self.transport.check_path(path, self._revmeta.metarev.revnum)
@@ -603,6 +929,92 @@ class FileTreeEditor(object):
         return delta.apply_txdelta_handler("", self.file_stream)
 
 
+PRISTINE_SHA1_CACHE_HEADER = "### bzr-svn pristine sha1 cache v1\n"
+
+
+class PristineSha1Cache(object):
+    """Cache of the sha1 and size of pristine texts, keyed by their md5.
+
+    Subversion records the md5 checksum of the pristine text of every
+    entry, so only texts that haven't been seen before have to be read
+    and hashed. When the cache is written, entries that weren't used since
+    it was read are dropped.
+    """
+
+    def __init__(self, path, mode=None):
+        self.path = path
+        self._mode = mode
+        self._map = None
+        self._used = set()
+        self.needs_write = False
+
+    def read(self):
+        self._map = {}
+        self._used = set()
+        self.needs_write = False
+        try:
+            f = open(self.path, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        try:
+            if f.readline() != PRISTINE_SHA1_CACHE_HEADER:
+                mutter("pristine sha1 cache %s has unknown format", self.path)
+                return
+            for line in f:
+                try:
+                    (sha1, size, md5sum) = line.rstrip("\n").split(" ", 2)
+                    self._map[md5sum] = (sha1, int(size))
+                except ValueError:
+                    mutter("discarding corrupt pristine sha1 cache %s",
+                           self.path)
+                    self._map = {}
+                    return
+        finally:
+            f.close()
+
+    def lookup(self, md5sum):
+        """Look up a pristine text.
+
+        :param md5sum: Hex md5 checksum of the text
+        :raises KeyError: if the text is not known
+        :return: Tuple with hex sha1 and size of the text
+        """
+        if self._map is None:
+            self.read()
+        ret = self._map[md5sum]
+        self._used.add(md5sum)
+        return ret
+
+    def add(self, md5sum, sha1, size):
+        if self._map is None:
+            self.read()
+        if self._map.get(md5sum) != (sha1, size):
+            self._map[md5sum] = (sha1, size)
+            self.needs_write = True
+        self._used.add(md5sum)
+
+    def write(self):
+        """Write the cache, if entries were added or are no longer used."""
+        if self._map is None:
+            return
+        if not self.needs_write and len(self._used) == len(self._map):
+            return
+        f = atomicfile.AtomicFile(self.path, 'wb', new_mode=self._mode)
+        try:
+            f.write(PRISTINE_SHA1_CACHE_HEADER)
+            for md5sum in sorted(self._used):
+                (sha1, size) = self._map[md5sum]
+                f.write("%s %d %s\n" % (sha1, size, md5sum))
+            f.commit()
+        finally:
+            if not f.closed:
+                f.abort()
+        self._map = dict((md5sum, self._map[md5sum]) for md5sum in self._used)
+        self.needs_write = False
+
+
 class SvnBasisTree(SvnRevisionTreeCommon):
     """Optimized version of SvnRevisionTree."""
 
@@ -630,7 +1042,9 @@ class SvnBasisTree(SvnRevisionTreeCommon):
         self._bzr_inventory = Inventory(root_id=None)
         if self.get_root_id() is None:
             return self._bzr_inventory
-        def add_file_to_inv(relpath, id, revid, adm):
+        sha1_cache = self.workingtree._pristine_sha1_cache
+        sha1_cache.read()
+        def add_file_to_inv(relpath, id, revid, adm, md5sum):
             if not isinstance(relpath, text_type):
                 raise TypeError(relpath)
             (propchanges, props) = adm.get_prop_diffs(
@@ -645,9 +1059,15 @@ class SvnBasisTree(SvnRevisionTreeCommon):
                 ie.symlink_target = self.get_file_stream_by_path(relpath).read()[len("link "):]
             else:
                 ie = self._bzr_inventory.add_path(relpath, 'file', id)
-                data = osutils.fingerprint_file(self.get_file_stream_by_path(relpath))
-                ie.text_sha1 = data['sha1']
-                ie.text_size = data['size']
+                try:
+                    (ie.text_sha1, ie.text_size) = sha1_cache.lookup(md5sum)
+                except KeyError:
+                    data = osutils.fingerprint_file(
+                        self.get_file_stream_by_path(relpath))
+                    ie.text_sha1 = data['sha1']
+                    ie.text_size = data['size']
+                    if md5sum is not None:
+                        sha1_cache.add(md5sum, ie.text_sha1, ie.text_size)
                 ie.executable = props.has_key(properties.PROP_EXECUTABLE)
             ie.revision = revid
             return ie
@@ -706,10 +1126,19 @@ class SvnBasisTree(SvnRevisionTreeCommon):
                 else:
                     (subid, subrevid) = find_ids(entry)
                     if subid is not None:
-                        add_file_to_inv(subrelpath, subid, subrevid, adm)
+                        add_file_to_inv(subrelpath, subid, subrevid, adm,
+                                        entry.checksum)
 
         with self.workingtree._get_wc() as adm:
             add_dir_to_inv(u"", adm, None)
+        try:
+            sha1_cache.write()
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EPERM, errno.EACCES):
+                raise
+            # Not being able to write the cache is not fatal
+            mutter('Could not write pristine sha1 cache for %s: %s',
+                   self.workingtree.basedir, e)
         return self._bzr_inventory
 
     def has_filename(self, path):
@@ -26,8 +26,11 @@ from collections import (
 import errno
 import os
 import posixpath
+import Queue
 import stat
 import subvertpy
+import sys
+import threading
 
 from subvertpy import (
     ERR_BAD_FILENAME,
@@ -80,6 +83,9 @@ from breezy.errors import (
     UnsupportedOperation,
     UninitializableFormat,
     )
+from breezy.filters import (
+    internal_size_sha_file_byname,
+    )
 from breezy.lock import (
     LogicalLockResult,
     )
@@ -126,6 +132,7 @@ from breezy.plugins.svn.transport import (
     )
 from breezy.plugins.svn.tree import (
     BasisTreeIncomplete,
+    PristineSha1Cache,
     SvnBasisTree,
     SubversionTree,
     SubversionTreeDirectory,
@@ -198,6 +205,106 @@ def apply_prop_changes(orig_props, prop_changes):
     return orig_props
 
 
+# Maximum total size in bytes of the files being hashed at the same time
+HASH_MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024
+
+# Maximum number of entries waiting for their files to be hashed
+HASH_MAX_PENDING = 1000
+
+
+class SvnHashCache(hashcache.HashCache):
+    """Hash cache that supports hashing files outside of the cache."""
+
+    def __init__(self, *args, **kwargs):
+        super(SvnHashCache, self).__init__(*args, **kwargs)
+        self._digests = {}
+
+    def lookup(self, path, stat_value):
+        """Look up the sha1 of a regular file without reading it.
+
+        :return: sha1, or None if the file is not in the cache or has
+            changed since it was added
+        """
+        file_fp = self._fingerprint(osutils.pathjoin(self.root, path),
+                                    stat_value)
+        if not file_fp or not stat.S_ISREG(stat_value.st_mode):
+            return None
+        try:
+            (cache_sha1, cache_fp) = self._cache[path]
+        except KeyError:
+            return None
+        if cache_fp != file_fp:
+            return None
+        self.stat_count += 1
+        self.hit_count += 1
+        return cache_sha1
+
+    def get_sha1(self, path, stat_value=None, digest=None):
+        """See HashCache.get_sha1.
+
+        :param digest: sha1 of the file contents, if they have already been
+            hashed
+        """
+        if digest is None:
+            return super(SvnHashCache, self).get_sha1(path, stat_value)
+        abspath = osutils.pathjoin(self.root, path)
+        self._digests[abspath] = digest
+        try:
+            return super(SvnHashCache, self).get_sha1(path, stat_value)
+        finally:
+            del self._digests[abspath]
+
+    def _really_sha1_file(self, abspath, filters):
+        try:
+            return self._digests[abspath]
+        except KeyError:
+            return super(SvnHashCache, self)._really_sha1_file(abspath,
+                                                               filters)
+
+
+class _HashRequest(object):
+    """Hashing of the contents of a single file by a worker thread."""
+
+    __slots__ = ('relpath', 'ie', 'stat_value', 'abspath', 'filters',
+                 'digest', 'error', 'done')
+
+    def __init__(self, relpath, ie, stat_value):
+        self.relpath = relpath
+        self.ie = ie
+        self.stat_value = stat_value
+        self.abspath = None
+        self.filters = None
+        self.digest = None
+        self.error = None
+        self.done = None
+
+    def run(self):
+        try:
+            self.digest = internal_size_sha_file_byname(self.abspath,
+                                                        self.filters)[1]
+        except:
+            self.error = sys.exc_info()
+        self.done.set()
+
+    def finished(self):
+        return self.done is None or self.done.is_set()
+
+    def get(self):
+        if self.done is not None:
+            self.done.wait()
+            if self.error is not None:
+                raise self.error[0], self.error[1], self.error[2]
+        return self.digest
+
+
+def _hash_worker(queue):
+    while True:
+        request = queue.get()
+        if request is None:
+            return
+        request.run()
+
+
 class Walker(object):
     """Iterator of a Subversion working copy.
 
@@ -273,17 +380,28 @@ class SvnWorkingTree(SubversionTree, WorkingTree):
         control_transport = controldir.transport.clone('bzr')
         self._transport = control_transport
         cache_filename = control_transport.local_abspath('stat-cache')
-        self._hashcache = hashcache.HashCache(self.basedir, cache_filename,
+        self._hashcache = SvnHashCache(self.basedir, cache_filename,
             self.controldir._get_file_mode(),
             self._content_filter_stack_provider())
         self._hashcache.read()
+        self._pristine_sha1_cache = PristineSha1Cache(
+            control_transport.local_abspath('pristine-sha1-cache'),
+            self.controldir._get_file_mode())
         self._lock_count = 0
         self._lock_mode = None
         self._control_files = None
         self.views = self._make_views()
 
     def _cleanup(self):
-        pass
+        if self._hashcache.needs_write:
+            try:
+                self._hashcache.write()
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EPERM, errno.EACCES):
+                    raise
+                # Not being able to write the cache is not fatal
+                mutter('Could not write hashcache for %s: %s',
+                       self.basedir, e)
 
     @property
     def mapping(self):
@@ -692,6 +810,18 @@ class SvnWorkingTree(SubversionTree, WorkingTree):
         raise NoSuchId(self, file_id)
 
     def _ie_from_entry(self, relpath, entry, parent_id):
+        (ie, stat_value) = self._unhashed_ie_from_entry(relpath, entry,
+                                                        parent_id)
+        if stat_value is not None:
+            ie.text_sha1 = self._hashcache.get_sha1(relpath, stat_value)
+        return ie
+
+    def _unhashed_ie_from_entry(self, relpath, entry, parent_id):
+        """Create an inventory entry, without hashing the file contents.
+
+        :return: Tuple with inventory entry and, if the sha1 of the file
+            still has to be determined, the stat value of the file
+        """
         assert type(parent_id) is str or parent_id is None
         if not isinstance(relpath, text_type):
             raise TypeError(relpath)
@@ -701,32 +831,60 @@ class SvnWorkingTree(SubversionTree, WorkingTree):
         if entry.kind == subvertpy.NODE_DIR:
             ie = SubversionTreeDirectory(file_id, basename, parent_id)
             ie.revision = revid
-            return ie
+            return (ie, None)
         elif os.path.islink(abspath):
             ie = SubversionTreeLink(file_id, basename, parent_id)
             ie.revision = revid
             target_path = os.readlink(abspath.encode(osutils._fs_enc))
             ie.symlink_target = target_path.decode(osutils._fs_enc)
-            return ie
+            return (ie, None)
         else:
             ie = SubversionTreeFile(file_id, basename, parent_id)
             ie.revision = revid
             try:
-                data = osutils.fingerprint_file(
-                    open(abspath.encode(osutils._fs_enc)))
-            except IOError as e:
-                if e.errno == errno.EISDIR:
-                    ie = SubversionTreeDirectory(file_id, basename, parent_id)
-                    ie.revision = None
-                    return ie
-                elif e.errno == errno.ENOENT:
-                    return None
+                stat_value = os.lstat(abspath.encode(osutils._fs_enc))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    return (None, None)
                 raise
-            else:
-                ie.text_sha1 = data['sha1']
-                ie.text_size = data['size']
-                ie.executable = self.is_executable(relpath)
-                return ie
+            if stat.S_ISDIR(stat_value.st_mode):
+                ie = SubversionTreeDirectory(file_id, basename, parent_id)
+                ie.revision = None
+                return (ie, None)
+            ie.text_size = stat_value.st_size
+            ie.executable = self.is_executable(relpath)
+            ie.text_sha1 = self._get_unmodified_sha1(relpath, entry,
+                                                     stat_value)
+            if ie.text_sha1 is None:
+                return (ie, stat_value)
+            return (ie, None)
+
+    def _get_unmodified_sha1(self, relpath, entry, stat_value):
+        """Determine the sha1 of a file that Subversion knows is unmodified.
+
+        Subversion records the modification time and size of a working file
+        when it last matched its pristine text. If neither has changed, the
+        sha1 of the pristine text can be used without reading the file.
+
+        :return: sha1 of the file, or None if it has to be hashed
+        """
+        # Older versions of subvertpy don't provide these
+        text_time = getattr(entry, "text_time", None)
+        working_size = getattr(entry, "working_size", None)
+        if (not text_time or working_size is None or working_size < 0 or
+            entry.checksum is None):
+            return None
+        if (stat_value.st_size != working_size or
+            abs(stat_value.st_mtime * 1000000 - text_time) >= 1):
+            return None
+        if self._content_filter_stack(relpath):
+            # The pristine text is not necessarily the canonical form
+            return None
+        try:
+            (sha1, size) = self._pristine_sha1_cache.lookup(entry.checksum)
+        except KeyError:
+            return None
+        return sha1
 
     def iter_child_entries(self, path, file_id=None):
         """See Tree.iter_child_entries."""
@@ -752,21 +910,93 @@ class SvnWorkingTree(SubversionTree, WorkingTree):
                     if ie is not None:
                         yield path, ie
         else:
-            fileids = {}
-            w = Walker(self)
-            for relpath, entry in w:
-                if entry.schedule == SCHEDULE_DELETE:
-                    continue
-                if not isinstance(relpath, text_type):
-                    raise TypeError(relpath)
-                if relpath == u"":
-                    parent_id = None
-                else:
-                    parent_id = fileids[os.path.dirname(relpath)]
-                ie = self._ie_from_entry(relpath, entry, parent_id)
-                if ie is not None:
-                    fileids[relpath] = ie.file_id
-                    yield relpath, ie
+            for (relpath, ie) in self._iter_hashed_entries(
+                    self._iter_unhashed_entries()):
+                yield relpath, ie
+
+    def _iter_unhashed_entries(self):
+        fileids = {}
+        w = Walker(self)
+        for relpath, entry in w:
+            if entry.schedule == SCHEDULE_DELETE:
+                continue
+            if not isinstance(relpath, text_type):
+                raise TypeError(relpath)
+            if relpath == u"":
+                parent_id = None
+            else:
+                parent_id = fileids[os.path.dirname(relpath)]
+            (ie, stat_value) = self._unhashed_ie_from_entry(relpath, entry,
+                                                            parent_id)
+            if ie is not None:
+                fileids[relpath] = ie.file_id
+                yield relpath, ie, stat_value
+
+    def _iter_hashed_entries(self, entries, threads=None,
+                             max_in_flight=HASH_MAX_IN_FLIGHT_BYTES):
+        """Determine the sha1s of the files of inventory entries.
+
+        Files that are not in the hash cache are hashed by a pool of
+        threads, as hashlib releases the GIL while hashing. Looking up
+        content filters and updating the hash cache happen on the calling
+        thread. Entries are returned in the order they were passed in.
+
+        :param entries: Iterable over (relpath, ie, stat_value) tuples;
+            the sha1 is determined for entries with a stat value
+        :param threads: Number of threads to hash files with; defaults
+            to the number of CPUs
+        :param max_in_flight: Maximum total size of the files being
+            hashed at the same time
+        :return: Iterator over (relpath, ie) tuples
+        """
+        if threads is None:
+            threads = osutils.local_concurrency()
+        queue = Queue.Queue()
+        workers = []
+        pending = deque()
+        in_flight = [0]
+        def finish(request):
+            digest = request.get()
+            if request.done is not None:
+                in_flight[0] -= request.stat_value.st_size
+            if request.stat_value is not None:
+                request.ie.text_sha1 = self._hashcache.get_sha1(
+                    request.relpath, request.stat_value, digest)
+            return (request.relpath, request.ie)
+        try:
+            for (relpath, ie, stat_value) in entries:
+                request = _HashRequest(relpath, ie, stat_value)
+                if stat_value is not None:
+                    ie.text_sha1 = self._hashcache.lookup(relpath, stat_value)
+                    if ie.text_sha1 is not None:
+                        request.stat_value = None
+                    elif threads > 1 and stat.S_ISREG(stat_value.st_mode):
+                        if not workers:
+                            for i in range(threads):
+                                thread = threading.Thread(
+                                    target=_hash_worker, args=(queue,))
+                                thread.daemon = True
+                                thread.start()
+                                workers.append(thread)
+                        request.abspath = self.abspath(relpath)
+                        request.filters = self._content_filter_stack(relpath)
+                        request.done = threading.Event()
+                        queue.put(request)
+                        in_flight[0] += stat_value.st_size
+                pending.append(request)
+                # Keep the files being hashed and the entries waiting for
+                # them bounded
+                while pending and (pending[0].finished() or
+                        in_flight[0] > max_in_flight or
+                        len(pending) > HASH_MAX_PENDING):
+                    yield finish(pending.popleft())
+            while pending:
+                yield finish(pending.popleft())
+        finally:
+            for thread in workers:
+                queue.put(None)
+            for thread in workers:
+                thread.join()
 
     def extras(self):
         """See WorkingTree.extras."""
@@ -1286,11 +1516,15 @@ class SvnWorkingTree(SubversionTree, WorkingTree):
 
     def unlock(self):
         self._lock_count -= 1
-        if self._lock_count == 0:
-            self._lock_mode = None
-            self._cleanup()
-            self._reset_data()
-        self.branch.unlock()
+        try:
+            if self._lock_count == 0:
+                self._lock_mode = None
+                try:
+                    self._cleanup()
+                finally:
+                    self._reset_data()
+        finally:
+            self.branch.unlock()
 
     def _is_executable_from_path_and_stat_from_stat(self, path, stat_result):
         mode = stat_result.st_mode